@@ -0,0 +1,304 @@
+"""
+Benchmark do início de aula, de ponta a ponta, sem serviços externos.
+
+Cada professor faz a sequência real:
+    /create-room -> /enviar-id-aula -> (aluno) /buscar-id-professor -> /registrar-aula
+e, num segundo cenário, a que a sala virtual do professor usa com o pool de
+salas já cheio (sem chamadas ao 100ms durante a medição):
+    /sala-do-vinculo -> /enviar-id-aula -> (aluno) /buscar-id-professor -> /registrar-aula
+com o Firestore em memória (DB_BACKEND=memoria) e a API do 100ms substituída
+por stub_100ms.py, a correr num servidor local com latência e erros
+configuráveis.
+
+Para cada nível de concorrência (por omissão 10, 50 e 200 professores em
+simultâneo) e cada cenário mostra:
+- tempo até o aluno ter o link da sala (p50/p95/p99/máx) e até a aula
+  ficar registada
+- contenção nos documentos contadores (CONTAS_100MS/contador e
+  estatisticas/dashboard): escritas, pico de escritas por segundo no mesmo
+  documento (o Firestore aguenta ~1/s sustentado) e espera pelo alocador
+- chamadas ao 100ms e novas tentativas do gateway
+
+Uso:
+    python benchmark_aula.py
+    python benchmark_aula.py --professores 10 50 200 --latencia-ms 150 --erros 0.05
+
+O que a aplicação escreve em disco (templates/pro-info.html, professores.json
+e os recibos em static/) fica numa pasta temporária com cópias de templates/ e
+static/, apagada no fim.
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+os.environ["DB_BACKEND"] = "memoria"
+os.environ.setdefault("PEDIDO_LENTO_S", "3600")
+
+
+def _pasta_temporaria() -> str:
+    """Pasta de trabalho com cópias de templates/ e static/ (a aplicação usa caminhos relativos)."""
+    origem = os.path.dirname(os.path.abspath(__file__))
+    pasta = tempfile.mkdtemp(prefix="benchmark_aula_")
+    for nome in ("templates", "static"):
+        shutil.copytree(os.path.join(origem, nome), os.path.join(pasta, nome))
+    return pasta
+
+
+def _porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# tem de ser antes de importar main: o import já escreve professores.json e pro-info.html.
+# Só no processo principal: os workers de recibos ("spawn") voltam a importar
+# este ficheiro e herdam a pasta de trabalho e as variáveis de ambiente.
+PASTA = PORTA_STUB = None
+if __name__ == "__main__":
+    PASTA = _pasta_temporaria()
+    os.chdir(PASTA)
+    os.environ["PROFESSORES_JSON"] = os.path.join(PASTA, "professores.json")
+
+    PORTA_STUB = _porta_livre()
+    os.environ["HMS_API_BASE"] = f"http://127.0.0.1:{PORTA_STUB}"
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+
+import main  # noqa: E402
+import stub_100ms  # noqa: E402
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+CONTADORES = ("CONTAS_100MS/contador", "estatisticas/dashboard")
+
+
+# ============================
+# 🔹 STUB 100ms
+# ============================
+def iniciar_stub() -> uvicorn.Server:
+    servidor = uvicorn.Server(uvicorn.Config(
+        stub_100ms.app, host="127.0.0.1", port=PORTA_STUB, log_level="warning"
+    ))
+    threading.Thread(target=servidor.run, daemon=True).start()
+    while not servidor.started:
+        time.sleep(0.05)
+    return servidor
+
+
+# ============================
+# 🔹 CONTENÇÃO NOS CONTADORES
+# ============================
+class MedidorContadores:
+    """Regista as escritas nos documentos contadores e a espera pelo alocador de contas."""
+
+    def __init__(self):
+        self.escritas = {caminho: [] for caminho in CONTADORES}
+        self.esperas_alocador = []
+
+        aplicar = main.db._aplicar
+
+        def aplicar_medido(escritas):
+            agora = time.perf_counter()
+            for _, caminho, _, _ in escritas:
+                if caminho in self.escritas:
+                    self.escritas[caminho].append(agora)
+            return aplicar(escritas)
+
+        main.db._aplicar = aplicar_medido
+
+        alocar = main.get_account_and_increment
+
+        async def alocar_medido():
+            inicio = time.perf_counter()
+            try:
+                return await alocar()
+            finally:
+                self.esperas_alocador.append(time.perf_counter() - inicio)
+
+        main.get_account_and_increment = alocar_medido
+
+    def limpar(self):
+        for lista in self.escritas.values():
+            lista.clear()
+        self.esperas_alocador.clear()
+
+    def resumo(self) -> dict:
+        resultado = {}
+        for caminho, tempos in self.escritas.items():
+            por_segundo = {}
+            for t in tempos:
+                por_segundo[int(t)] = por_segundo.get(int(t), 0) + 1
+            resultado[caminho] = (len(tempos), max(por_segundo.values(), default=0))
+        return resultado
+
+
+# ============================
+# 🔹 DADOS DE TESTE
+# ============================
+def preparar(professores: int) -> list:
+    """Recomeça do zero com 'professores' professores, cada um com um aluno."""
+    db = main.db
+    db.limpar()
+    main.init_contas_100ms()
+    main.alocador_100ms._restantes = 0
+    main.gateway_100ms._metricas.clear()
+    main.gestor_salas_100ms._salas.clear()
+
+    pares = []
+    batch = db.batch()
+    for i in range(professores):
+        email = f"prof{i}@sab.ao"
+        aluno = f"aluno {i}"
+        pares.append((email, aluno))
+        batch.set(db.collection("professores_online").document(email), {
+            "nome": f"Professor {i}", "email": email, "salario": {"saldo_atual": 0}
+        })
+        batch.set(db.collection("alunos").document(main.chave_aluno(aluno)), {
+            "nome": aluno, "nome_normalizado": aluno, "senha": "123", "vinculado": True, "professor": email
+        })
+        batch.set(db.collection("alunos_professor").document(f"{email}_aluno_{i}"), {
+            "professor": email, "aluno": aluno, "aulas_dadas": 0, "aulas": []
+        })
+        if (i + 1) % 150 == 0:
+            batch.commit()
+            batch = db.batch()
+    batch.commit()
+    main.migracao_ids.migrar()
+    main.reconciliar_estatisticas()
+    db.aguardar_avisos()
+    return pares
+
+
+# ============================
+# 🔹 INÍCIO DE AULA
+# ============================
+async def iniciar_aula(cliente: httpx.AsyncClient, professor: str, aluno: str, pool: bool = False) -> dict:
+    inicio = time.perf_counter()
+
+    if pool:
+        # como templates/sala_virtual_professor.html quando a URL traz o aluno
+        r = await cliente.post("/sala-do-vinculo", json={"professor": professor, "aluno": aluno})
+    else:
+        r = await cliente.post("/create-room", json={"name": f"{professor}-{aluno}"})
+    if r.status_code != 200:
+        return {"erro": f"{'sala-do-vinculo' if pool else 'create-room'} {r.status_code}"}
+    sala = r.json()
+
+    r = await cliente.post("/enviar-id-aula", json={
+        "aluno": aluno,
+        "professor": professor,
+        "room_id": sala["room_id"],
+        "prebuilt_link": sala["prebuilt_links"]["guest"]
+    })
+    if r.status_code != 200:
+        return {"erro": f"enviar-id-aula {r.status_code}"}
+
+    r = await cliente.get("/buscar-id-professor", params={"aluno": aluno})
+    if r.status_code != 200 or r.json().get("room_id") != sala["room_id"]:
+        return {"erro": f"buscar-id-professor {r.status_code}"}
+    ate_link = time.perf_counter() - inicio
+
+    r = await cliente.post("/registrar-aula", json={"professor": professor, "aluno": aluno})
+    if r.status_code != 200:
+        return {"erro": f"registrar-aula {r.status_code}"}
+
+    return {"ate_link": ate_link, "total": time.perf_counter() - inicio}
+
+
+def _percentil(valores: list, p: float) -> float:
+    if not valores:
+        return 0.0
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def _ms(valores: list) -> str:
+    return " ".join(
+        f"{nome}={_percentil(valores, p) * 1000:.0f}"
+        for nome, p in (("p50", 50), ("p95", 95), ("p99", 99), ("max", 100))
+    )
+
+
+async def cenario(cliente: httpx.AsyncClient, medidor: MedidorContadores, professores: int, pool: bool):
+    pares = preparar(professores)
+    if pool:
+        # o pool enche antes da medição, como faz a tarefa de fundo
+        await main.gestor_salas_100ms.reabastecer()
+        main.gateway_100ms._metricas.clear()
+    medidor.limpar()
+
+    inicio = time.perf_counter()
+    resultados = await asyncio.gather(*(iniciar_aula(cliente, p, a, pool) for p, a in pares))
+    duracao = time.perf_counter() - inicio
+
+    ok = [r for r in resultados if "erro" not in r]
+    erros = {}
+    for r in resultados:
+        if "erro" in r:
+            erros[r["erro"]] = erros.get(r["erro"], 0) + 1
+
+    print()
+    rota = "/sala-do-vinculo, pool cheio" if pool else "/create-room"
+    print(f"=== {professores} professores em simultâneo, {rota} ({duracao:.2f}s) ===")
+    print(f"aulas iniciadas: {len(ok)}/{professores}" + (f"  erros: {erros}" if erros else ""))
+    print(f"tempo até ao link (ms):   {_ms([r['ate_link'] for r in ok])}")
+    print(f"aula registada (ms):      {_ms([r['total'] for r in ok])}")
+    print(f"espera pelo alocador (ms): {_ms(medidor.esperas_alocador)}")
+    for caminho, (total, pico) in medidor.resumo().items():
+        print(f"{caminho}: {total} escritas, pico {pico}/s no mesmo documento")
+    for operacao, m in main.gateway_100ms.metricas().items():
+        print(
+            f"100ms {operacao}: {m['chamadas']} chamadas, {m['erros']} falhadas, "
+            f"{m['novas_tentativas']} novas tentativas, média {m['media_ms']} ms"
+        )
+
+
+async def principal(args):
+    stub_100ms.config.latencia_ms = args.latencia_ms
+    stub_100ms.config.variacao_ms = args.variacao_ms
+    stub_100ms.config.erros = args.erros
+    stub_100ms.config.limite = args.limite
+    stub_100ms.config.visibilidade_ms = args.visibilidade_ms
+    servidor = iniciar_stub()
+    print(f"🧪 Stub 100ms em {os.environ['HMS_API_BASE']} ({stub_100ms.config.como_dict()})")
+
+    try:
+        async with main.app.router.lifespan_context(main.app):
+            # o pool de salas criaria salas em paralelo e misturava-se com o que se mede
+            main.gestor_salas_100ms.parar()
+            medidor = MedidorContadores()
+            transporte = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(transport=transporte, base_url="http://bench", timeout=120) as cliente:
+                # aquecimento: ligações ao stub, tokens e o arranque do pool de recibos
+                # não devem contar no primeiro cenário
+                await iniciar_aula(cliente, *preparar(1)[0])
+                await asyncio.sleep(1)
+
+                for professores in args.professores:
+                    await cenario(cliente, medidor, professores, pool=False)
+                    await cenario(cliente, medidor, professores, pool=True)
+    finally:
+        servidor.should_exit = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark do início de aula com stub do 100ms.")
+    parser.add_argument("--professores", type=int, nargs="+", default=[10, 50, 200])
+    parser.add_argument("--latencia-ms", type=float, default=120)
+    parser.add_argument("--variacao-ms", type=float, default=40)
+    parser.add_argument("--erros", type=float, default=0.0, help="fração de respostas 500 do stub")
+    parser.add_argument("--limite", type=float, default=0.0, help="fração de respostas 429 do stub")
+    parser.add_argument("--visibilidade-ms", type=float, default=0.0)
+    try:
+        asyncio.run(principal(parser.parse_args()))
+    finally:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        shutil.rmtree(PASTA, ignore_errors=True)
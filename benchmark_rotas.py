@@ -0,0 +1,323 @@
+"""
+Benchmark das rotas mais usadas, sem Firestore real (DB_BACKEND=memoria).
+
+Popula o backend em memória com milhares de alunos, centenas de professores,
+vínculos com histórico de chat e comprovativos de pagamento, e depois faz
+pedidos concorrentes à aplicação (ASGI, sem rede) a:
+
+    /login, /perfil/{nome}, /verificar-notificacao, /buscar-mensagens,
+    /registrar-aula, /upload_comprovativo e /estatisticas-dashboard
+
+No fim mostra, por rota: pedidos/s, latência p50/p95/p99 e operações
+Firestore por pedido (as mesmas contagens de /metrics).
+
+O que a aplicação escreve em disco (templates/pro-info.html, professores.json
+e os recibos em static/) fica numa pasta temporária com cópias de templates/ e
+static/, apagada no fim. O pool de salas 100ms é parado e HMS_API_BASE aponta
+para stub_100ms.py: nada sai para a API real.
+
+Uso:
+    python benchmark_rotas.py
+    python benchmark_rotas.py --alunos 5000 --professores 500 --pedidos 3000 --concorrencia 100
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+os.environ["DB_BACKEND"] = "memoria"
+# o relatório de pedidos lentos não interessa durante o benchmark
+os.environ.setdefault("PEDIDO_LENTO_S", "3600")
+os.environ.setdefault("FIRESTORE_ORCAMENTO_LEITURAS", "1000000")
+os.environ.setdefault("FIRESTORE_ORCAMENTO_IDAS", "1000000")
+
+
+def _pasta_temporaria() -> str:
+    """Pasta de trabalho com cópias de templates/ e static/ (a aplicação usa caminhos relativos)."""
+    origem = os.path.dirname(os.path.abspath(__file__))
+    pasta = tempfile.mkdtemp(prefix="benchmark_rotas_")
+    for nome in ("templates", "static"):
+        shutil.copytree(os.path.join(origem, nome), os.path.join(pasta, nome))
+    return pasta
+
+
+def _porta_livre() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+# tem de ser antes de importar main: o import já escreve professores.json e pro-info.html.
+# Só no processo principal: os workers de recibos ("spawn") voltam a importar
+# este ficheiro e herdam a pasta de trabalho e as variáveis de ambiente.
+PASTA = PORTA_STUB = None
+if __name__ == "__main__":
+    PASTA = _pasta_temporaria()
+    os.chdir(PASTA)
+    os.environ["PROFESSORES_JSON"] = os.path.join(PASTA, "professores.json")
+
+    PORTA_STUB = _porta_livre()
+    os.environ["HMS_API_BASE"] = f"http://127.0.0.1:{PORTA_STUB}"
+
+import httpx  # noqa: E402
+import uvicorn  # noqa: E402
+
+import main  # noqa: E402
+import stub_100ms  # noqa: E402
+
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+DISCIPLINAS = ["Matemática", "Física", "Química", "Português", "Inglês", "Biologia"]
+PDF_FALSO = b"%PDF-1.4\n1 0 obj<<>>endobj\ntrailer<<>>\n%%EOF\n"
+
+
+# ============================
+# 🔹 STUB 100ms
+# ============================
+def iniciar_stub() -> uvicorn.Server:
+    servidor = uvicorn.Server(uvicorn.Config(
+        stub_100ms.app, host="127.0.0.1", port=PORTA_STUB, log_level="warning"
+    ))
+    threading.Thread(target=servidor.run, daemon=True).start()
+    while not servidor.started:
+        time.sleep(0.05)
+    return servidor
+
+
+# ============================
+# 🔹 DADOS DE TESTE
+# ============================
+def _gravar(escritas: list):
+    """Grava [(referencia, dados)] em batches de 400."""
+    for i in range(0, len(escritas), 400):
+        batch = main.db.batch()
+        for ref, dados in escritas[i:i + 400]:
+            batch.set(ref, dados)
+        batch.commit()
+
+
+def popular(alunos: int, professores: int, mensagens: int) -> dict:
+    db = main.db
+    inicio = datetime.now() - timedelta(days=30)
+
+    emails = [f"prof{i}@sab.ao" for i in range(professores)]
+    escritas = []
+    for i, email in enumerate(emails):
+        dados = {
+            "nome": f"Professor {i}",
+            "email": email,
+            "senha": "123",
+            "disciplinas": random.sample(DISCIPLINAS, 2),
+            "latitude": -8.8 + random.uniform(-0.3, 0.3),
+            "longitude": 13.2 + random.uniform(-0.3, 0.3),
+            "online": random.random() < 0.5,
+            "alunos_vinculados": [],
+            "horario": {},
+        }
+        escritas.append((db.collection("professores_online").document(email), dados))
+        escritas.append((db.collection("professores_online2").document(email), dados))
+
+    nomes = [f"aluno {i}" for i in range(alunos)]
+    fichas = []
+    for i, nome in enumerate(nomes):
+        fichas.append({
+            "nome": nome,
+            "nome_normalizado": nome,
+            "email": f"aluno{i}@sab.ao",
+            "senha": "123",
+            "disciplina": random.choice(DISCIPLINAS),
+            "bairro": "Talatona",
+            "municipio": "Luanda",
+            "provincia": "Luanda",
+            "vinculado": False,
+            "online": False,
+            "status_conta": "Ativada",
+            "notificacao": False,
+        })
+
+    # metade dos alunos com professor, histórico de chat e pagamentos
+    vinculos = []
+    for i, nome in enumerate(nomes[:alunos // 2]):
+        professor = emails[i % professores]
+        vinculo_id = f"{professor}_{nome.replace(' ', '_')}"
+        vinculos.append((professor, nome))
+        escritas.append((db.collection("alunos_professor").document(vinculo_id), {
+            "professor": professor,
+            "aluno": nome,
+            "dados_aluno": {"nome": nome, "disciplina": random.choice(DISCIPLINAS)},
+            "vinculado_em": inicio.isoformat(),
+            "aulas_dadas": random.randint(0, 20),
+            "aulas": [],
+        }))
+        for m in range(mensagens):
+            momento = (inicio + timedelta(minutes=m * 37)).isoformat(timespec="microseconds")
+            escritas.append((
+                db.collection("alunos_professor").document(vinculo_id).collection("mensagens").document(),
+                {"remetente": random.choice([nome, professor]), "mensagem": f"mensagem {m}", "timestamp": momento}
+            ))
+        fichas[i].update({"vinculado": True, "professor": professor})
+        chave = main.chave_aluno(nome)
+        escritas.append((db.collection("comprovativos_pagamento").document(chave), {
+            "comprovativos": [f"antigo_{chave}_{m}.pdf" for m in range(3)]
+        }))
+
+    escritas.extend((db.collection("alunos").document(main.chave_aluno(ficha["nome"])), ficha) for ficha in fichas)
+    _gravar(escritas)
+    main.reindexar_alunos()
+    # os dados já usam os IDs canónicos: só marca a migração como concluída
+    main.migracao_ids.migrar()
+    main.reconciliar_estatisticas()
+    db.aguardar_avisos()
+    return {"alunos": nomes, "professores": emails, "vinculos": vinculos}
+
+
+# ============================
+# 🔹 PEDIDOS
+# ============================
+def _pedidos(dados: dict, total: int) -> list:
+    """Funções de pedido, sorteadas segundo a mistura de tráfego."""
+    alunos, vinculos = dados["alunos"], dados["vinculos"]
+    pagamentos = iter(range(total))
+
+    def login(c):
+        nome = random.choice(alunos)
+        return c.post("/login", data={"nome": nome, "senha": "123"})
+
+    def perfil(c):
+        return c.get(f"/perfil/{random.choice(alunos)}")
+
+    def notificacao(c):
+        return c.post("/verificar-notificacao", json={"aluno": random.choice(alunos)})
+
+    def mensagens(c):
+        professor, aluno = random.choice(vinculos)
+        return c.get(f"/buscar-mensagens/{professor}/{aluno}")
+
+    def aula(c):
+        professor, aluno = random.choice(vinculos)
+        return c.post("/registrar-aula", json={"professor": professor, "aluno": aluno})
+
+    def comprovativo(c):
+        _, aluno = random.choice(vinculos)
+        ficheiro = f"comprovativo_{next(pagamentos)}.pdf"
+        return c.post(
+            "/upload_comprovativo",
+            data={"aluno_nome": aluno, "banco": "bai", "meses": "1"},
+            files={"comprovativo": (ficheiro, PDF_FALSO, "application/pdf")}
+        )
+
+    def dashboard(c):
+        return c.get("/estatisticas-dashboard")
+
+    # pesos aproximados do tráfego real: leituras muito mais frequentes que escritas
+    mistura = [
+        (login, 15), (perfil, 25), (notificacao, 25), (mensagens, 20),
+        (aula, 5), (comprovativo, 2), (dashboard, 8)
+    ]
+    funcoes = [f for f, _ in mistura]
+    pesos = [p for _, p in mistura]
+    return random.choices(funcoes, weights=pesos, k=total)
+
+
+async def executar(dados: dict, total: int, concorrencia: int) -> tuple:
+    fila = asyncio.Queue()
+    for pedido in _pedidos(dados, total):
+        fila.put_nowait(pedido)
+
+    latencias = {}
+    erros = {}
+
+    async def trabalhador(cliente):
+        while not fila.empty():
+            pedido = fila.get_nowait()
+            inicio = time.perf_counter()
+            resposta = await pedido(cliente)
+            duracao = time.perf_counter() - inicio
+            rota = pedido.__name__
+            latencias.setdefault(rota, []).append(duracao)
+            if resposta.status_code >= 500:
+                erros[rota] = erros.get(rota, 0) + 1
+
+    transporte = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transporte, base_url="http://bench", follow_redirects=False) as cliente:
+        inicio = time.perf_counter()
+        await asyncio.gather(*(trabalhador(cliente) for _ in range(concorrencia)))
+        duracao = time.perf_counter() - inicio
+    return latencias, erros, duracao
+
+
+def _percentil(valores: list, p: float) -> float:
+    ordenados = sorted(valores)
+    return ordenados[min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))]
+
+
+def relatorio(latencias: dict, erros: dict, duracao: float):
+    total = sum(len(v) for v in latencias.values())
+    print()
+    print(f"{total} pedidos em {duracao:.2f}s -> {total / duracao:.1f} pedidos/s")
+    print()
+    print(f"{'pedido':<14}{'n':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'erros':>7}")
+    for nome, valores in sorted(latencias.items()):
+        print(
+            f"{nome:<14}{len(valores):>6}"
+            f"{_percentil(valores, 50) * 1000:>9.1f}"
+            f"{_percentil(valores, 95) * 1000:>9.1f}"
+            f"{_percentil(valores, 99) * 1000:>9.1f}"
+            f"{erros.get(nome, 0):>7}"
+        )
+
+    print()
+    print(f"{'rota':<46}{'pedidos':>8}{'leituras':>10}{'consultas':>10}{'docs':>8}{'escritas':>9}{'idas':>7}")
+    for (rota, metodo), m in sorted(main.metricas_rotas._rotas.items()):
+        n = m["pedidos"] or 1
+        print(
+            f"{metodo + ' ' + rota:<46}{m['pedidos']:>8}"
+            f"{m['leituras'] / n:>10.1f}{m['consultas'] / n:>10.1f}"
+            f"{m['documentos'] / n:>8.1f}{m['escritas'] / n:>9.1f}{m['idas'] / n:>7.1f}"
+        )
+    print("(operações Firestore por pedido)")
+
+
+async def principal(args):
+    random.seed(args.semente)
+    servidor = iniciar_stub()
+    try:
+        # corre os eventos de arranque/paragem da aplicação (índices, presença, watchers)
+        async with main.app.router.lifespan_context(main.app):
+            # o pool de salas não faz parte das rotas medidas
+            main.gestor_salas_100ms.parar()
+
+            inicio = time.perf_counter()
+            dados = popular(args.alunos, args.professores, args.mensagens)
+            print(f"📦 Dados de teste criados em {time.perf_counter() - inicio:.1f}s")
+
+            # só interessam as métricas dos pedidos do benchmark
+            main.metricas_rotas._rotas.clear()
+
+            latencias, erros, duracao = await executar(dados, args.pedidos, args.concorrencia)
+            relatorio(latencias, erros, duracao)
+    finally:
+        servidor.should_exit = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark das rotas mais usadas com Firestore em memória.")
+    parser.add_argument("--alunos", type=int, default=3000)
+    parser.add_argument("--professores", type=int, default=300)
+    parser.add_argument("--mensagens", type=int, default=20, help="mensagens de chat por vínculo")
+    parser.add_argument("--pedidos", type=int, default=2000)
+    parser.add_argument("--concorrencia", type=int, default=50)
+    parser.add_argument("--semente", type=int, default=42)
+    try:
+        asyncio.run(principal(parser.parse_args()))
+    finally:
+        os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        shutil.rmtree(PASTA, ignore_errors=True)
@@ -0,0 +1,606 @@
+"""
+Imitação em memória do cliente Firestore usado por main.py (DB_BACKEND=memoria).
+
+Cobre o que a aplicação usa: collection/document (com subcoleções), where
+(posicional ou filter=FieldFilter), order_by, limit, select, stream/get,
+count(), get_all, add/set(merge)/update/create/delete, batches, transações,
+on_snapshot e os valores especiais Increment, ArrayUnion, ArrayRemove,
+SERVER_TIMESTAMP e DELETE_FIELD. As consultas percorrem a coleção inteira:
+serve para medir quantas operações cada rota faz, não para ser rápido.
+
+Os avisos de on_snapshot são entregues por uma thread própria, tal como no
+cliente verdadeiro, para que os callbacks nunca corram dentro de uma escrita.
+"""
+
+import copy
+import enum
+import queue
+import random
+import string
+import threading
+from datetime import datetime, timezone
+
+try:
+    from google.cloud.firestore_v1 import transforms as _transforms
+except ImportError:  # a imitação também funciona sem o SDK instalado
+    _transforms = None
+
+
+class NaoEncontrado(Exception):
+    pass
+
+
+class JaExiste(Exception):
+    pass
+
+
+class TipoMudanca(enum.Enum):
+    ADDED = 1
+    MODIFIED = 2
+    REMOVED = 3
+
+
+DOCUMENT_ID = "__name__"
+DESCENDING = "DESCENDING"
+ASCENDING = "ASCENDING"
+
+
+def _agora():
+    return datetime.now(timezone.utc)
+
+
+def _novo_id() -> str:
+    return "".join(random.choices(string.ascii_letters + string.digits, k=20))
+
+
+# ---------- valores especiais ----------
+def _especial(valor) -> str:
+    """Nome do valor especial do Firestore ('' se for um valor normal)."""
+    if _transforms is not None:
+        if valor is _transforms.SERVER_TIMESTAMP:
+            return "SERVER_TIMESTAMP"
+        if valor is _transforms.DELETE_FIELD:
+            return "DELETE_FIELD"
+    nome = type(valor).__name__
+    if nome in ("Increment", "ArrayUnion", "ArrayRemove", "Maximum", "Minimum"):
+        return nome
+    if nome == "Sentinel":
+        descricao = getattr(valor, "description", "").lower()
+        return "DELETE_FIELD" if "delete" in descricao else "SERVER_TIMESTAMP"
+    return ""
+
+
+def _aplicar_valor(atual, valor):
+    """Resultado de escrever 'valor' num campo que tinha 'atual' (ou _AUSENTE)."""
+    tipo = _especial(valor)
+    if not tipo:
+        if isinstance(valor, dict):
+            return {k: _aplicar_valor(_AUSENTE, v) for k, v in valor.items() if _especial(v) != "DELETE_FIELD"}
+        return copy.deepcopy(valor)
+    if tipo == "SERVER_TIMESTAMP":
+        return _agora()
+    if tipo == "Increment":
+        base = atual if isinstance(atual, (int, float)) and not isinstance(atual, bool) else 0
+        return base + valor.value
+    if tipo in ("Maximum", "Minimum"):
+        if not isinstance(atual, (int, float)):
+            return valor.value
+        return max(atual, valor.value) if tipo == "Maximum" else min(atual, valor.value)
+    lista = list(atual) if isinstance(atual, list) else []
+    if tipo == "ArrayUnion":
+        for item in valor.values:
+            if item not in lista:
+                lista.append(copy.deepcopy(item))
+        return lista
+    if tipo == "ArrayRemove":
+        return [item for item in lista if item not in valor.values]
+    return _AUSENTE
+
+
+class _Ausente:
+    def __repr__(self):
+        return "<ausente>"
+
+
+_AUSENTE = _Ausente()
+
+
+def _ler_campo(dados: dict, caminho: str):
+    atual = dados
+    for parte in caminho.split("."):
+        if not isinstance(atual, dict) or parte not in atual:
+            return _AUSENTE
+        atual = atual[parte]
+    return atual
+
+
+def _escrever_campo(dados: dict, caminho: str, valor):
+    partes = caminho.split(".")
+    atual = dados
+    for parte in partes[:-1]:
+        if not isinstance(atual.get(parte), dict):
+            atual[parte] = {}
+        atual = atual[parte]
+    if _especial(valor) == "DELETE_FIELD":
+        atual.pop(partes[-1], None)
+        return
+    atual[partes[-1]] = _aplicar_valor(atual.get(partes[-1], _AUSENTE), valor)
+
+
+def _fundir(destino: dict, dados: dict):
+    """set(merge=True): mapas aninhados são fundidos, o resto é substituído."""
+    for chave, valor in dados.items():
+        if isinstance(valor, dict) and not _especial(valor) and isinstance(destino.get(chave), dict):
+            _fundir(destino[chave], valor)
+        elif _especial(valor) == "DELETE_FIELD":
+            destino.pop(chave, None)
+        else:
+            destino[chave] = _aplicar_valor(destino.get(chave, _AUSENTE), valor)
+
+
+# ---------- snapshots ----------
+class InstantaneoMemoria:
+    def __init__(self, referencia, dados, criado_em=None, atualizado_em=None, campos=None):
+        self.reference = referencia
+        self.id = referencia.id
+        self.exists = dados is not None
+        self._dados = dados
+        self._campos = campos
+        self.create_time = criado_em
+        self.update_time = atualizado_em
+        self.read_time = _agora()
+
+    def to_dict(self):
+        if self._dados is None:
+            return None
+        if self._campos is not None:
+            projecao = {}
+            for campo in self._campos:
+                valor = _ler_campo(self._dados, campo)
+                if valor is not _AUSENTE:
+                    _escrever_campo(projecao, campo, valor)
+            return projecao
+        return copy.deepcopy(self._dados)
+
+    def get(self, campo: str):
+        valor = _ler_campo(self._dados or {}, campo)
+        if valor is _AUSENTE:
+            raise KeyError(campo)
+        return copy.deepcopy(valor)
+
+
+class _Mudanca:
+    def __init__(self, tipo: TipoMudanca, documento, antigo: int = -1, novo: int = -1):
+        self.type = tipo
+        self.document = documento
+        self.old_index = antigo
+        self.new_index = novo
+
+
+class _Observacao:
+    def __init__(self, cliente, chave):
+        self._cliente = cliente
+        self._chave = chave
+
+    def unsubscribe(self):
+        self._cliente._remover_ouvinte(self._chave)
+
+
+# ---------- consultas ----------
+class ConsultaMemoria:
+    def __init__(self, cliente, caminho: str, parent=None, filtros=(), ordem=(), limite=None, campos=None):
+        self._client = cliente
+        self._caminho = caminho
+        self._parent = parent if parent is not None else self
+        self._field_filters = list(filtros)
+        self._orders = list(ordem)
+        self._limit = limite
+        self._campos = campos
+
+    def _copia(self, **alteracoes):
+        atributos = {
+            "parent": self._parent, "filtros": self._field_filters, "ordem": self._orders,
+            "limite": self._limit, "campos": self._campos
+        }
+        atributos.update(alteracoes)
+        return ConsultaMemoria(self._client, self._caminho, **atributos)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copia(filtros=self._field_filters + [(field_path, op_string, value)])
+
+    def order_by(self, field_path, direction=ASCENDING):
+        return self._copia(ordem=self._orders + [(field_path, str(direction).upper())])
+
+    def limit(self, quantidade: int):
+        return self._copia(limite=quantidade)
+
+    def select(self, campos):
+        return self._copia(campos=list(campos))
+
+    # ---------- avaliação ----------
+    @staticmethod
+    def _valor(doc_id: str, dados: dict, campo: str):
+        if campo == DOCUMENT_ID:
+            return doc_id
+        return _ler_campo(dados, campo)
+
+    @staticmethod
+    def _comparar(valor, operador: str, alvo) -> bool:
+        if valor is _AUSENTE:
+            return False
+        if isinstance(alvo, DocumentoMemoria):
+            alvo = alvo.id
+        try:
+            if operador == "==":
+                return valor == alvo
+            if operador == "!=":
+                return valor != alvo
+            if operador == "<":
+                return valor < alvo
+            if operador == "<=":
+                return valor <= alvo
+            if operador == ">":
+                return valor > alvo
+            if operador == ">=":
+                return valor >= alvo
+            if operador == "in":
+                return valor in alvo
+            if operador == "not-in":
+                return valor not in alvo
+            if operador == "array_contains":
+                return isinstance(valor, list) and alvo in valor
+            if operador == "array_contains_any":
+                return isinstance(valor, list) and any(a in valor for a in alvo)
+        except TypeError:
+            return False
+        raise ValueError(f"Operador não suportado: {operador}")
+
+    def _resultados(self) -> list:
+        """[(doc_id, dados)] que satisfazem a consulta, já ordenados e limitados."""
+        documentos = self._client._documentos_de(self._caminho)
+        linhas = []
+        for doc_id, dados in documentos:
+            if all(self._comparar(self._valor(doc_id, dados, c), op, v) for c, op, v in self._field_filters):
+                linhas.append((doc_id, dados))
+
+        for campo, direcao in reversed(self._orders):
+            linhas = [l for l in linhas if self._valor(l[0], l[1], campo) is not _AUSENTE]
+            linhas.sort(key=lambda l: self._valor(l[0], l[1], campo), reverse=direcao == DESCENDING)
+
+        if self._limit is not None:
+            linhas = linhas[:self._limit]
+        return linhas
+
+    def _instantaneos(self) -> list:
+        with self._client._lock:
+            return [
+                self._client._instantaneo(f"{self._caminho}/{doc_id}", campos=self._campos)
+                for doc_id, _ in self._resultados()
+            ]
+
+    def stream(self, transaction=None):
+        for instantaneo in self._instantaneos():
+            yield instantaneo
+
+    def get(self, transaction=None):
+        return list(self.stream())
+
+    def count(self, alias=None):
+        return AgregacaoMemoria(self, alias)
+
+    def on_snapshot(self, callback):
+        return self._client._adicionar_ouvinte(("consulta", self), callback)
+
+
+class ResultadoAgregacao:
+    def __init__(self, alias: str, value):
+        self.alias = alias
+        self.value = value
+
+
+class AgregacaoMemoria:
+    """consulta.count(): get() devolve [[ResultadoAgregacao]], como o AggregationQuery."""
+
+    def __init__(self, consulta: ConsultaMemoria, alias=None):
+        self._consulta = consulta
+        self._alias = alias or "field_1"
+
+    def get(self, transaction=None):
+        with self._consulta._client._lock:
+            total = len(self._consulta._resultados())
+        return [[ResultadoAgregacao(self._alias, total)]]
+
+
+class ColecaoMemoria(ConsultaMemoria):
+    def __init__(self, cliente, caminho: str):
+        super().__init__(cliente, caminho)
+        self.id = caminho.rsplit("/", 1)[-1]
+        self.path = caminho
+
+    def document(self, document_id=None):
+        return DocumentoMemoria(self._client, f"{self._caminho}/{document_id or _novo_id()}")
+
+    def add(self, dados: dict, document_id=None):
+        referencia = self.document(document_id)
+        referencia.create(dados)
+        return _agora(), referencia
+
+    def list_documents(self):
+        return [self.document(doc_id) for doc_id, _ in self._client._documentos_de(self._caminho)]
+
+
+class DocumentoMemoria:
+    def __init__(self, cliente, caminho: str):
+        self._client = cliente
+        self.path = caminho
+        self.id = caminho.rsplit("/", 1)[-1]
+
+    @property
+    def parent(self):
+        return ColecaoMemoria(self._client, self.path.rsplit("/", 1)[0])
+
+    def collection(self, nome: str):
+        return ColecaoMemoria(self._client, f"{self.path}/{nome}")
+
+    def get(self, field_paths=None, transaction=None):
+        with self._client._lock:
+            return self._client._instantaneo(self.path, campos=field_paths)
+
+    def set(self, dados: dict, merge=False):
+        self._client._aplicar([("set", self.path, dados, bool(merge))])
+
+    def update(self, dados: dict):
+        self._client._aplicar([("update", self.path, dados, False)])
+
+    def create(self, dados: dict):
+        self._client._aplicar([("create", self.path, dados, False)])
+
+    def delete(self):
+        self._client._aplicar([("delete", self.path, None, False)])
+
+    def on_snapshot(self, callback):
+        return self._client._adicionar_ouvinte(("documento", self.path), callback)
+
+    def __eq__(self, outro):
+        return isinstance(outro, DocumentoMemoria) and outro.path == self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+
+# ---------- escritas agrupadas ----------
+class LoteMemoria:
+    def __init__(self, cliente):
+        self._client = cliente
+        self._write_pbs = []
+
+    def set(self, referencia, dados: dict, merge=False):
+        self._write_pbs.append(("set", referencia.path, dados, bool(merge)))
+
+    def update(self, referencia, dados: dict):
+        self._write_pbs.append(("update", referencia.path, dados, False))
+
+    def create(self, referencia, dados: dict):
+        self._write_pbs.append(("create", referencia.path, dados, False))
+
+    def delete(self, referencia):
+        self._write_pbs.append(("delete", referencia.path, None, False))
+
+    def commit(self):
+        if len(self._write_pbs) > 500:
+            raise ValueError("Um batch aceita no máximo 500 escritas.")
+        self._client._aplicar(self._write_pbs)
+        resultado = [_agora()] * len(self._write_pbs)
+        self._write_pbs = []
+        return resultado
+
+
+class TransacaoMemoria(LoteMemoria):
+    def _commit(self):
+        return self.commit()
+
+
+# ---------- cliente ----------
+class ClienteMemoria:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._colecoes = {}   # caminho da coleção -> {id: dados}
+        self._tempos = {}     # caminho do documento -> (criado_em, atualizado_em)
+        self._ouvintes = {}   # chave -> (alvo, callback, estado anterior)
+        self._proximo_ouvinte = 0
+        self._avisos = queue.Queue()
+        self._thread_avisos = None
+
+    # ---------- API pública ----------
+    def collection(self, caminho: str):
+        return ColecaoMemoria(self, caminho)
+
+    def document(self, caminho: str):
+        return DocumentoMemoria(self, caminho)
+
+    def batch(self):
+        return LoteMemoria(self)
+
+    def transaction(self):
+        return TransacaoMemoria(self)
+
+    def get_all(self, referencias, field_paths=None, transaction=None):
+        with self._lock:
+            instantaneos = [self._instantaneo(ref.path, campos=field_paths) for ref in referencias]
+        for instantaneo in instantaneos:
+            yield instantaneo
+
+    def executar_transacao(self, funcao, *args):
+        """Equivalente a firestore.transactional(funcao)(db.transaction(), *args)."""
+        with self._lock:
+            transacao = TransacaoMemoria(self)
+            resultado = funcao(transacao, *args)
+            transacao._commit()
+            return resultado
+
+    def limpar(self):
+        with self._lock:
+            self._colecoes.clear()
+            self._tempos.clear()
+
+    # ---------- armazenamento ----------
+    @staticmethod
+    def _separar(caminho: str):
+        colecao, doc_id = caminho.rsplit("/", 1)
+        return colecao, doc_id
+
+    def _documentos_de(self, caminho_colecao: str) -> list:
+        with self._lock:
+            return list(self._colecoes.get(caminho_colecao, {}).items())
+
+    def _instantaneo(self, caminho: str, campos=None):
+        colecao, doc_id = self._separar(caminho)
+        dados = self._colecoes.get(colecao, {}).get(doc_id)
+        criado_em, atualizado_em = self._tempos.get(caminho, (None, None))
+        return InstantaneoMemoria(
+            DocumentoMemoria(self, caminho), dados, criado_em, atualizado_em,
+            campos=list(campos) if campos is not None else None
+        )
+
+    def _aplicar(self, escritas: list):
+        """Aplica as escritas de forma atómica (todas ou nenhuma)."""
+        with self._lock:
+            novos = {}
+            for operacao, caminho, dados, merge in escritas:
+                colecao, doc_id = self._separar(caminho)
+                atual = novos[caminho] if caminho in novos else self._colecoes.get(colecao, {}).get(doc_id)
+
+                if operacao == "delete":
+                    novos[caminho] = None
+                elif operacao == "create":
+                    if atual is not None:
+                        raise JaExiste(f"O documento já existe: {caminho}")
+                    novos[caminho] = _aplicar_valor(_AUSENTE, dados)
+                elif operacao == "update":
+                    if atual is None:
+                        raise NaoEncontrado(f"Documento não encontrado: {caminho}")
+                    resultado = copy.deepcopy(atual)
+                    for campo, valor in dados.items():
+                        _escrever_campo(resultado, campo, valor)
+                    novos[caminho] = resultado
+                elif merge and atual is not None:
+                    resultado = copy.deepcopy(atual)
+                    _fundir(resultado, dados)
+                    novos[caminho] = resultado
+                else:
+                    resultado = {}
+                    _fundir(resultado, dados)
+                    novos[caminho] = resultado
+
+            agora = _agora()
+            for caminho, dados in novos.items():
+                colecao, doc_id = self._separar(caminho)
+                if dados is None:
+                    self._colecoes.get(colecao, {}).pop(doc_id, None)
+                    self._tempos.pop(caminho, None)
+                else:
+                    self._colecoes.setdefault(colecao, {})[doc_id] = dados
+                    criado_em = self._tempos.get(caminho, (agora, agora))[0]
+                    self._tempos[caminho] = (criado_em, agora)
+
+            if self._ouvintes:
+                self._avisar({caminho.rsplit("/", 1)[0] for caminho in novos}, set(novos))
+
+    # ---------- on_snapshot ----------
+    # Os dicionários guardados nunca são alterados no lugar (cada escrita cria
+    # um novo), por isso o estado de cada ouvinte guarda só referências.
+    def _estado_alvo(self, alvo) -> dict:
+        tipo, objeto = alvo
+        if tipo == "documento":
+            colecao, doc_id = self._separar(objeto)
+            dados = self._colecoes.get(colecao, {}).get(doc_id)
+            return {objeto: dados} if dados is not None else {}
+        return {f"{objeto._caminho}/{doc_id}": dados for doc_id, dados in objeto._resultados()}
+
+    def _estado_atualizado(self, alvo, anterior: dict, documentos: set) -> dict:
+        tipo, objeto = alvo
+        if tipo == "documento" or objeto._limit is not None or objeto._orders:
+            return self._estado_alvo(alvo)
+
+        # consulta sem ordem nem limite: basta reavaliar os documentos escritos
+        atual = dict(anterior)
+        for caminho in documentos:
+            colecao, doc_id = self._separar(caminho)
+            if colecao != objeto._caminho:
+                continue
+            dados = self._colecoes.get(colecao, {}).get(doc_id)
+            if dados is not None and all(
+                objeto._comparar(objeto._valor(doc_id, dados, c), op, v) for c, op, v in objeto._field_filters
+            ):
+                atual[caminho] = dados
+            else:
+                atual.pop(caminho, None)
+        return atual
+
+    def _adicionar_ouvinte(self, alvo, callback):
+        with self._lock:
+            chave = self._proximo_ouvinte
+            self._proximo_ouvinte += 1
+            estado = self._estado_alvo(alvo)
+            self._ouvintes[chave] = (alvo, callback, estado)
+            self._enfileirar(alvo, callback, {}, estado, set(estado), inicial=True)
+        return _Observacao(self, chave)
+
+    def _remover_ouvinte(self, chave):
+        with self._lock:
+            self._ouvintes.pop(chave, None)
+
+    def _avisar(self, colecoes: set, documentos: set):
+        for chave, (alvo, callback, anterior) in list(self._ouvintes.items()):
+            tipo, objeto = alvo
+            afetado = objeto in documentos if tipo == "documento" else objeto._caminho in colecoes
+            if not afetado:
+                continue
+            atual = self._estado_atualizado(alvo, anterior, documentos)
+            self._ouvintes[chave] = (alvo, callback, atual)
+            self._enfileirar(alvo, callback, anterior, atual, set(anterior) | set(atual))
+
+    def _enfileirar(self, alvo, callback, anterior: dict, atual: dict, caminhos: set, inicial: bool = False):
+        mudancas = []
+        for caminho in sorted(caminhos):
+            antes, depois = anterior.get(caminho), atual.get(caminho)
+            if antes is None and depois is not None:
+                mudancas.append(_Mudanca(TipoMudanca.ADDED, self._fotografia(caminho, depois)))
+            elif antes is not None and depois is None:
+                mudancas.append(_Mudanca(TipoMudanca.REMOVED, self._fotografia(caminho, antes)))
+            elif antes is not None and antes is not depois and antes != depois:
+                mudancas.append(_Mudanca(TipoMudanca.MODIFIED, self._fotografia(caminho, depois)))
+        if not mudancas and not inicial:
+            return
+
+        tipo, objeto = alvo
+        if tipo == "documento":
+            docs = [self._fotografia(objeto, atual.get(objeto))]
+        else:
+            docs = [self._fotografia(c, d) for c, d in atual.items()]
+        self._avisos.put((callback, docs, mudancas))
+        self._garantir_thread_avisos()
+
+    def _fotografia(self, caminho: str, dados):
+        return InstantaneoMemoria(DocumentoMemoria(self, caminho), dados)
+
+    def _garantir_thread_avisos(self):
+        if self._thread_avisos is None or not self._thread_avisos.is_alive():
+            self._thread_avisos = threading.Thread(target=self._entregar_avisos, daemon=True)
+            self._thread_avisos.start()
+
+    def _entregar_avisos(self):
+        while True:
+            callback, docs, mudancas = self._avisos.get()
+            try:
+                callback(docs, mudancas, _agora())
+            except Exception as e:
+                print("⚠️ Erro num callback de on_snapshot (memória):", e)
+            finally:
+                self._avisos.task_done()
+
+    def aguardar_avisos(self):
+        """Espera que todos os avisos de on_snapshot pendentes tenham sido entregues."""
+        self._avisos.join()
@@ -1,23 +1,34 @@
 import os
 import json
 import uuid
+import hashlib
 import re
+import math
 import pytz
 import unicodedata
 import shutil
 import time
 import jwt
 import unicodedata
+import asyncio
+import threading
+import contextvars
+import sys
+import multiprocessing
 from fastapi import Body
 from datetime import datetime, timedelta, timezone
 from collections import OrderedDict
-from urllib.parse import unquote
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import quote, unquote
 from jinja2 import Environment, FileSystemLoader
 
+import anyio
 import httpx
 from dotenv import load_dotenv
-from fastapi import FastAPI, Request, Form, UploadFile, File, Body, Query, HTTPException
-from fastapi.responses import JSONResponse, RedirectResponse, FileResponse, HTMLResponse
+from fastapi import FastAPI, Request, Form, UploadFile, File, Body, Query, HTTPException, Depends, WebSocket, WebSocketDisconnect
+from starlette.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, RedirectResponse, FileResponse, HTMLResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
@@ -26,12 +37,9 @@ from typing import List, Optional
 
 import firebase_admin
 from firebase_admin import credentials, firestore
-from google.cloud.firestore_v1.base_query import FieldFilter
 
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
 from fpdf import FPDF
 from pydantic import BaseModel
@@ -43,8 +51,14 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 # --- Firebase ---
+# DB_BACKEND=memoria troca o Firestore por uma imitação em memória
+# (firestore_memoria.py), para benchmarks e desenvolvimento sem projeto Firebase.
+DB_BACKEND = os.environ.get("DB_BACKEND", "firestore")
 firebase_json = os.environ.get("FIREBASE_KEY")
-if firebase_json and not firebase_admin._apps:
+if DB_BACKEND == "memoria":
+    from firestore_memoria import ClienteMemoria
+    db = ClienteMemoria()
+elif firebase_json and not firebase_admin._apps:
     try:
         firebase_info = json.loads(firebase_json)
         if "private_key" in firebase_info:
@@ -59,7 +73,7 @@ else:
 
 # --- Paths ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-PROFESSORES_JSON = os.path.join(BASE_DIR, "professores.json")
+PROFESSORES_JSON = os.environ.get("PROFESSORES_JSON", os.path.join(BASE_DIR, "professores.json"))
 ALUNOS_JSON = os.path.join(BASE_DIR, "alunos.json")
 
 # --- FastAPI app ---
@@ -95,6 +109,446 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# ============================
+# 🔹 POOL DE THREADS DO FIRESTORE
+# ============================
+# O cliente do Firestore é síncrono. As rotas que o usam são "def" (o FastAPI
+# executa-as no pool de threads do anyio) e as rotas "async" mandam as chamadas
+# bloqueantes para o mesmo pool através de em_thread(). Assim uma ida lenta ao
+# Firestore não bloqueia o event loop do worker.
+FIRESTORE_THREADS = int(os.environ.get("FIRESTORE_THREADS", "40"))
+
+
+@app.on_event("startup")
+async def configurar_pool_firestore():
+    limitador = anyio.to_thread.current_default_thread_limiter()
+    limitador.total_tokens = FIRESTORE_THREADS
+    print(f"🧵 Pool de threads do Firestore: {FIRESTORE_THREADS} threads")
+
+
+async def em_thread(funcao, *args, **kwargs):
+    """Executa uma chamada bloqueante no pool de threads, fora do event loop."""
+    return await run_in_threadpool(funcao, *args, **kwargs)
+
+
+async def corpo_json(request: Request) -> dict:
+    """Lê o corpo JSON no event loop para que a rota possa ser síncrona."""
+    try:
+        dados = await request.json()
+    except Exception:
+        return {}
+    return dados if isinstance(dados, dict) else {}
+
+
+@app.get("/status-pool-firestore")
+async def status_pool_firestore():
+    estatisticas = anyio.to_thread.current_default_thread_limiter().statistics()
+    return {
+        "threads_total": estatisticas.total_tokens,
+        "threads_ocupadas": estatisticas.borrowed_tokens,
+        "tarefas_em_espera": estatisticas.tasks_waiting
+    }
+
+
+# ============================
+# 🔹 MÉTRICAS POR ROTA (/metrics)
+# ============================
+# Um middleware abre um "consumo" por pedido (numa ContextVar, que o FastAPI
+# copia para o pool de threads) e, no fim, soma-o às métricas do template da rota.
+# As classes do cliente Firestore são instrumentadas uma vez: leituras de
+# documentos, consultas, documentos devolvidos pelas consultas, escritas e tempo
+# gasto. O Gateway100ms soma o tempo das chamadas externas. Chamadas fora de um
+# pedido (on_snapshot, ciclos de fundo) contam na rota "(fundo)".
+METRICAS_BALDES = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICAS_CONTADORES = ("leituras", "consultas", "documentos", "escritas", "idas")
+
+# Orçamento por pedido: documentos lidos (leituras + documentos devolvidos por
+# consultas) e idas ao servidor. Acima dele, ou acima de PEDIDO_LENTO_S, o
+# pedido gera um relatório com cada operação (coleção, filtros, documentos,
+# tempo, linha que a fez). Com FIRESTORE_ORCAMENTO_ESTRITO=1 (testes) o pedido
+# que passa do orçamento falha com 500.
+FIRESTORE_ORCAMENTO_LEITURAS = int(os.environ.get("FIRESTORE_ORCAMENTO_LEITURAS", "500"))
+FIRESTORE_ORCAMENTO_IDAS = int(os.environ.get("FIRESTORE_ORCAMENTO_IDAS", "30"))
+FIRESTORE_ORCAMENTO_ESTRITO = os.environ.get("FIRESTORE_ORCAMENTO_ESTRITO", "0") == "1"
+PEDIDO_LENTO_S = float(os.environ.get("PEDIDO_LENTO_S", "2.0"))
+RELATORIO_MAX_OPERACOES = 200
+
+_consumo_pedido = contextvars.ContextVar("consumo_pedido", default=None)
+_dentro_firestore = threading.local()
+
+
+def novo_consumo(detalhar: bool = False) -> dict:
+    consumo = {
+        **{campo: 0 for campo in METRICAS_CONTADORES},
+        "firestore_s": 0.0,
+        "externo": {}
+    }
+    if detalhar:
+        consumo["operacoes"] = []
+        consumo["operacoes_omitidas"] = 0
+    return consumo
+
+
+class MetricasRotas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rotas = {}
+        self._fundo = novo_consumo()
+        self._caches = {}  # nome -> função que devolve {resultado: total}
+
+    def _somar(self, destino: dict, consumo: dict):
+        for campo in METRICAS_CONTADORES:
+            destino[campo] += consumo[campo]
+        destino["firestore_s"] += consumo["firestore_s"]
+        for servico, (chamadas, segundos) in consumo["externo"].items():
+            atual = destino["externo"].get(servico, (0, 0.0))
+            destino["externo"][servico] = (atual[0] + chamadas, atual[1] + segundos)
+
+    def registrar_pedido(self, rota: str, metodo: str, status: int, duracao: float, consumo: dict):
+        with self._lock:
+            m = self._rotas.get((rota, metodo))
+            if m is None:
+                m = self._rotas[(rota, metodo)] = {
+                    **novo_consumo(),
+                    "status": {},
+                    "baldes": [0] * len(METRICAS_BALDES),
+                    "soma_s": 0.0,
+                    "pedidos": 0
+                }
+            m["pedidos"] += 1
+            m["status"][status] = m["status"].get(status, 0) + 1
+            m["soma_s"] += duracao
+            for i, limite in enumerate(METRICAS_BALDES):
+                if duracao <= limite:
+                    m["baldes"][i] += 1
+            self._somar(m, consumo)
+
+    def consumo_atual(self) -> dict:
+        consumo = _consumo_pedido.get()
+        return consumo if consumo is not None else self._fundo
+
+    def contar_firestore(self, campo: str, quantidade: int = 1, segundos: float = 0.0, idas: int = 0):
+        consumo = self.consumo_atual()
+        with self._lock:
+            consumo[campo] += quantidade
+            consumo["idas"] += idas
+            consumo["firestore_s"] += segundos
+
+    def abrir_operacao(self, operacao: str, descricao: dict) -> Optional[dict]:
+        """Regista uma operação no relatório do pedido atual (None fora de pedidos)."""
+        consumo = _consumo_pedido.get()
+        if consumo is None or "operacoes" not in consumo:
+            return None
+        detalhe = {"operacao": operacao, **descricao, "documentos": 0, "segundos": 0.0, "origem": _origem_chamada()}
+        with self._lock:
+            if len(consumo["operacoes"]) >= RELATORIO_MAX_OPERACOES:
+                consumo["operacoes_omitidas"] += 1
+                return None
+            consumo["operacoes"].append(detalhe)
+        return detalhe
+
+    def registrar_cache(self, nome: str, contadores):
+        """Expõe em /metrics os contadores de uma cache em memória (acertos, falhas...)."""
+        self._caches[nome] = contadores
+
+    def registrar_externo(self, servico: str, segundos: float):
+        consumo = self.consumo_atual()
+        with self._lock:
+            chamadas, total = consumo["externo"].get(servico, (0, 0.0))
+            consumo["externo"][servico] = (chamadas + 1, total + segundos)
+
+    def prometheus(self) -> str:
+        def rotulos(**valores) -> str:
+            partes = []
+            for nome, valor in valores.items():
+                valor = str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+                partes.append(f'{nome}="{valor}"')
+            return "{" + ",".join(partes) + "}"
+
+        with self._lock:
+            rotas = [((rota, metodo), {**m, "externo": dict(m["externo"]), "status": dict(m["status"])})
+                     for (rota, metodo), m in self._rotas.items()]
+            rotas.append((("(fundo)", ""), {**self._fundo, "externo": dict(self._fundo["externo"])}))
+
+        linhas = [
+            "# HELP sabapp_http_pedidos_total Pedidos HTTP por rota, método e status.",
+            "# TYPE sabapp_http_pedidos_total counter",
+        ]
+        for (rota, metodo), m in rotas:
+            for status, total in sorted(m.get("status", {}).items()):
+                linhas.append(f"sabapp_http_pedidos_total{rotulos(rota=rota, metodo=metodo, status=status)} {total}")
+
+        linhas += [
+            "# HELP sabapp_http_latencia_segundos Latência dos pedidos HTTP por rota.",
+            "# TYPE sabapp_http_latencia_segundos histogram",
+        ]
+        for (rota, metodo), m in rotas:
+            if "baldes" not in m:
+                continue
+            for limite, total in zip(METRICAS_BALDES, m["baldes"]):
+                linhas.append(f"sabapp_http_latencia_segundos_bucket{rotulos(rota=rota, metodo=metodo, le=limite)} {total}")
+            linhas.append(f"sabapp_http_latencia_segundos_bucket{rotulos(rota=rota, metodo=metodo, le='+Inf')} {m['pedidos']}")
+            linhas.append(f"sabapp_http_latencia_segundos_sum{rotulos(rota=rota, metodo=metodo)} {m['soma_s']:.6f}")
+            linhas.append(f"sabapp_http_latencia_segundos_count{rotulos(rota=rota, metodo=metodo)} {m['pedidos']}")
+
+        linhas += [
+            "# HELP sabapp_firestore_operacoes_total Operações Firestore por rota (leituras, consultas, documentos devolvidos, escritas).",
+            "# TYPE sabapp_firestore_operacoes_total counter",
+        ]
+        for (rota, metodo), m in rotas:
+            for campo in METRICAS_CONTADORES:
+                linhas.append(f"sabapp_firestore_operacoes_total{rotulos(rota=rota, metodo=metodo, tipo=campo)} {m[campo]}")
+
+        linhas += [
+            "# HELP sabapp_firestore_segundos_total Tempo gasto em chamadas ao Firestore por rota.",
+            "# TYPE sabapp_firestore_segundos_total counter",
+        ]
+        for (rota, metodo), m in rotas:
+            linhas.append(f"sabapp_firestore_segundos_total{rotulos(rota=rota, metodo=metodo)} {m['firestore_s']:.6f}")
+
+        for metrica, ajuda, indice in (
+            ("sabapp_externo_chamadas_total", "Chamadas a serviços externos por rota.", 0),
+            ("sabapp_externo_segundos_total", "Tempo gasto em serviços externos por rota.", 1),
+        ):
+            linhas += [f"# HELP {metrica} {ajuda}", f"# TYPE {metrica} counter"]
+            for (rota, metodo), m in rotas:
+                for servico, valores in sorted(m["externo"].items()):
+                    valor = valores[indice]
+                    texto = f"{valor:.6f}" if isinstance(valor, float) else str(valor)
+                    linhas.append(f"{metrica}{rotulos(rota=rota, metodo=metodo, servico=servico)} {texto}")
+
+        linhas += [
+            "# HELP sabapp_cache_total Consultas às caches em memória por resultado.",
+            "# TYPE sabapp_cache_total counter",
+        ]
+        for nome, contadores in sorted(self._caches.items()):
+            for resultado, total in sorted(contadores().items()):
+                linhas.append(f"sabapp_cache_total{rotulos(cache=nome, resultado=resultado)} {total}")
+
+        return "\n".join(linhas) + "\n"
+
+
+metricas_rotas = MetricasRotas()
+
+
+_FUNCOES_INSTRUMENTACAO = {"envolvido", "_iterar_contando"}
+
+
+def _origem_chamada() -> str:
+    """Primeira linha de main.py fora da instrumentação que levou a esta chamada."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        codigo = frame.f_code
+        if codigo.co_filename == __file__ and codigo.co_name not in _FUNCOES_INSTRUMENTACAO:
+            return f"{codigo.co_name}:{frame.f_lineno}"
+        frame = frame.f_back
+    return "?"
+
+
+def _descrever_consulta(query, *args) -> dict:
+    filtros = [" ".join(str(f).split())[:200] for f in getattr(query, "_field_filters", ()) or ()]
+    parente = getattr(query, "_parent", None)
+    return {
+        "colecao": getattr(parente, "id", "?"),
+        "filtros": filtros,
+        "limite": getattr(query, "_limit", None)
+    }
+
+
+def _descrever_documento(ref, *args) -> dict:
+    return {"documento": getattr(ref, "path", "?")}
+
+
+def _descrever_get_all(cliente, referencias=(), *args) -> dict:
+    try:
+        referencias = list(referencias)
+    except TypeError:
+        referencias = []
+    return {"documentos_pedidos": len(referencias)}
+
+
+def _instrumentar(classe, nome: str, campo: str, por_item: Optional[str] = None, contar=None, descrever=None):
+    """
+    Envolve classe.nome. 'campo' conta uma vez por chamada; 'por_item' conta cada
+    documento de um resultado iterável; 'contar(self)' dá o número de escritas de
+    um commit. Cada chamada é uma ida ao servidor; 'descrever(self, *args)'
+    descreve-a no relatório do pedido. Chamadas feitas dentro de outra já
+    instrumentada não contam.
+    """
+    original = getattr(classe, nome, None)
+    if original is None or getattr(original, "_instrumentado", False):
+        return
+
+    def envolvido(self, *args, **kwargs):
+        if getattr(_dentro_firestore, "ativo", False):
+            return original(self, *args, **kwargs)
+
+        quantidade = contar(self) if contar else 1
+        try:
+            descricao = descrever(self, *args) if descrever else {}
+        except Exception:
+            descricao = {}
+        detalhe = metricas_rotas.abrir_operacao(f"{classe.__name__}.{nome}", descricao)
+
+        _dentro_firestore.ativo = True
+        inicio = time.perf_counter()
+        try:
+            resultado = original(self, *args, **kwargs)
+        finally:
+            _dentro_firestore.ativo = False
+            duracao = time.perf_counter() - inicio
+        metricas_rotas.contar_firestore(campo, quantidade, duracao, idas=1)
+        if detalhe is not None:
+            detalhe["segundos"] += duracao
+
+        if por_item is None:
+            return resultado
+        if isinstance(resultado, list):
+            metricas_rotas.contar_firestore(por_item, len(resultado))
+            if detalhe is not None:
+                detalhe["documentos"] = len(resultado)
+            return resultado
+        return _iterar_contando(resultado, por_item, detalhe)
+
+    envolvido._instrumentado = True
+    envolvido.__name__ = nome
+    envolvido.__doc__ = original.__doc__
+    setattr(classe, nome, envolvido)
+
+
+def _iterar_contando(iteravel, campo: str, detalhe: Optional[dict] = None):
+    # stream() é preguiçoso: conta cada documento e o tempo passado dentro do next()
+    iterador = iter(iteravel)
+    total, segundos = 0, 0.0
+    try:
+        while True:
+            _dentro_firestore.ativo = True
+            inicio = time.perf_counter()
+            try:
+                item = next(iterador)
+            except StopIteration:
+                return
+            finally:
+                _dentro_firestore.ativo = False
+                segundos += time.perf_counter() - inicio
+            total += 1
+            yield item
+    finally:
+        metricas_rotas.contar_firestore(campo, total, segundos)
+        if detalhe is not None:
+            detalhe["documentos"] = total
+            detalhe["segundos"] += segundos
+
+
+def instrumentar_firestore():
+    if DB_BACKEND == "memoria":
+        from firestore_memoria import (
+            ConsultaMemoria as Query, DocumentoMemoria as DocumentReference,
+            LoteMemoria as WriteBatch, TransacaoMemoria as Transaction, ClienteMemoria as Client,
+            AgregacaoMemoria as AggregationQuery
+        )
+    else:
+        try:
+            from google.cloud.firestore_v1.query import Query
+            from google.cloud.firestore_v1.document import DocumentReference
+            from google.cloud.firestore_v1.batch import WriteBatch
+            from google.cloud.firestore_v1.transaction import Transaction
+            from google.cloud.firestore_v1.client import Client
+            from google.cloud.firestore_v1.aggregation import AggregationQuery
+        except ImportError as e:
+            print("⚠️ Métricas do Firestore indisponíveis:", e)
+            return
+
+    _instrumentar(Query, "stream", "consultas", por_item="documentos", descrever=_descrever_consulta)
+    _instrumentar(Query, "get", "consultas", por_item="documentos", descrever=_descrever_consulta)
+    # get_all é uma ida ao servidor por lote de referências: conta os documentos lidos
+    _instrumentar(Client, "get_all", "leituras", por_item="leituras", contar=lambda c: 0,
+                  descrever=_descrever_get_all)
+    _instrumentar(DocumentReference, "get", "leituras", descrever=_descrever_documento)
+    # count() é faturado como uma leitura por cada 1000 entradas do índice
+    _instrumentar(AggregationQuery, "get", "leituras")
+    for nome in ("set", "update", "delete", "create"):
+        _instrumentar(DocumentReference, nome, "escritas", descrever=_descrever_documento)
+    _instrumentar(WriteBatch, "commit", "escritas", contar=lambda b: len(getattr(b, "_write_pbs", [])))
+    _instrumentar(Transaction, "_commit", "escritas", contar=lambda t: len(getattr(t, "_write_pbs", [])))
+
+
+instrumentar_firestore()
+
+
+def orcamento_esgotado(leituras: int = 0, idas: int = 0) -> bool:
+    """
+    True se o pedido atual passaria do orçamento gastando mais 'leituras'
+    documentos e 'idas' idas ao servidor (rotas de manutenção em lotes param
+    aí e devolvem o cursor). Fora de pedidos nunca esgota.
+    """
+    consumo = _consumo_pedido.get()
+    if consumo is None:
+        return False
+    lidos = consumo["leituras"] + consumo["documentos"]
+    return lidos + leituras > FIRESTORE_ORCAMENTO_LEITURAS or consumo["idas"] + idas > FIRESTORE_ORCAMENTO_IDAS
+
+
+def relatorio_consumo(rota: str, metodo: str, duracao: float, consumo: dict) -> Optional[dict]:
+    """Relatório do pedido se passou do orçamento ou foi lento; None caso contrário."""
+    lidos = consumo["leituras"] + consumo["documentos"]
+    excedidos = []
+    if lidos > FIRESTORE_ORCAMENTO_LEITURAS:
+        excedidos.append("leituras")
+    if consumo["idas"] > FIRESTORE_ORCAMENTO_IDAS:
+        excedidos.append("idas")
+    if not excedidos and duracao < PEDIDO_LENTO_S:
+        return None
+
+    return {
+        "rota": rota,
+        "metodo": metodo,
+        "duracao_s": round(duracao, 3),
+        "excedidos": excedidos,
+        "documentos_lidos": lidos,
+        "orcamento_leituras": FIRESTORE_ORCAMENTO_LEITURAS,
+        "idas": consumo["idas"],
+        "orcamento_idas": FIRESTORE_ORCAMENTO_IDAS,
+        "escritas": consumo["escritas"],
+        "firestore_s": round(consumo["firestore_s"], 3),
+        "operacoes": [
+            {**op, "segundos": round(op["segundos"], 4)} for op in consumo.get("operacoes", [])
+        ],
+        "operacoes_omitidas": consumo.get("operacoes_omitidas", 0)
+    }
+
+
+@app.middleware("http")
+async def medir_pedido(request: Request, call_next):
+    consumo = novo_consumo(detalhar=True)
+    token = _consumo_pedido.set(consumo)
+    inicio = time.perf_counter()
+    status = 500
+    resposta = None
+    try:
+        resposta = await call_next(request)
+        status = resposta.status_code
+    finally:
+        _consumo_pedido.reset(token)
+        duracao = time.perf_counter() - inicio
+        rota = getattr(request.scope.get("route"), "path", "(sem rota)")
+        metricas_rotas.registrar_pedido(rota, request.method, status, duracao, consumo)
+
+    relatorio = relatorio_consumo(rota, request.method, duracao, consumo)
+    if relatorio is not None:
+        logger.warning("Relatório de pedido: %s", json.dumps(relatorio, ensure_ascii=False, default=str))
+        if FIRESTORE_ORCAMENTO_ESTRITO and relatorio["excedidos"]:
+            return JSONResponse(
+                status_code=500,
+                content={"detail": "Orçamento do Firestore excedido", "relatorio": relatorio}
+            )
+    return resposta
+
+
+@app.get("/metrics")
+def metrics():
+    return PlainTextResponse(metricas_rotas.prometheus(), media_type="text/plain; version=0.0.4")
+
 
 def carregar_professores_local():
     if os.path.exists(PROFESSORES_JSON):
@@ -219,48 +673,93 @@ def init_contas_100ms():
         })
         print("🔥 CONTAS_100MS inicializado corretamente.")
 
-init_contas_100ms()
+if db is not None:
+    init_contas_100ms()
 
 
 # ============================
-# 🔹 FUNÇÃO CORRETA (USO ATÉ 50)
+# 🔹 ALOCADOR DE USOS (LEASE POR BLOCOS)
 # ============================
-async def get_account_and_increment():
-    ref = db.collection("CONTAS_100MS").document("contador")
-    doc = ref.get()
+# Cada worker reserva numa transação um bloco de usos da conta atual e vai
+# gastando-o em memória: criar uma sala custa no máximo uma operação no
+# contador, e o documento só é escrito uma vez por bloco.
+# Usos reservados e não gastos (lease expirado, reinício) contam como usados,
+# o que no pior caso antecipa a troca de conta em poucos usos.
+BLOCO_USOS_100MS = int(os.environ.get("BLOCO_USOS_100MS", "5"))
+LEASE_USOS_100MS = int(os.environ.get("LEASE_USOS_100MS", "600"))  # segundos
+
+
+def _transacao(funcao, *args):
+    """Executa funcao(transaction, *args) numa transação do Firestore (com novas tentativas)."""
+    if DB_BACKEND == "memoria":
+        return db.executar_transacao(funcao, *args)
+    return firestore.transactional(funcao)(db.transaction(), *args)
+
 
-    data = doc.to_dict() or {}
+def _reservar_bloco_100ms(transaction, ref, quantidade: int):
+    data = ref.get(transaction=transaction).to_dict() or {}
 
     conta = data.get("conta_atual", 0)
     usos = data.get("usos", {})
-
-    # 🔥 garante que é dict
     if not isinstance(usos, dict):
         usos = {}
+    usos = {str(k): v for k, v in usos.items()}
 
-    conta_str = str(conta)
-
-    # inicializa se não existir
-    if conta_str not in usos:
-        usos[conta_str] = 0
-
-    # troca conta só se atingir limite
-    if usos[conta_str] >= MAX_USOS:
+    # troca conta só se atingir limite (a nova conta recomeça do zero)
+    if usos.get(str(conta), 0) >= MAX_USOS:
         conta = (conta + 1) % len(CONTAS_100MS)
-        conta_str = str(conta)
+        usos[str(conta)] = 0
 
-        if conta_str not in usos:
-            usos[conta_str] = 0
+    reservados = min(quantidade, MAX_USOS - usos.get(str(conta), 0))
+    usos[str(conta)] = usos.get(str(conta), 0) + reservados
 
-    # incrementa uso
-    usos[conta_str] += 1
-
-    ref.update({
+    transaction.update(ref, {
         "conta_atual": conta,
         "usos": usos
     })
+    return conta, reservados
+
+
+class AlocadorContas100ms:
+
+    def __init__(self, bloco: int = BLOCO_USOS_100MS, duracao_lease: int = LEASE_USOS_100MS):
+        self.bloco = max(1, bloco)
+        self.duracao_lease = duracao_lease
+        self._conta = None
+        self._restantes = 0
+        self._expira_em = 0.0
+        self._lock = asyncio.Lock()
+
+    def _lease_valido(self) -> bool:
+        return self._restantes > 0 and time.monotonic() < self._expira_em
+
+    async def alocar(self) -> int:
+        """Devolve a conta a usar e gasta um uso do bloco local."""
+        async with self._lock:
+            if not self._lease_valido():
+                ref = db.collection("CONTAS_100MS").document("contador")
+                self._conta, self._restantes = await em_thread(
+                    _transacao, _reservar_bloco_100ms, ref, self.bloco
+                )
+                self._expira_em = time.monotonic() + self.duracao_lease
+
+            self._restantes -= 1
+            return self._conta
+
+    async def conta_atual(self) -> int:
+        """Conta em uso, sem gastar usos (lê o contador só se não houver lease)."""
+        if self._lease_valido():
+            return self._conta
+
+        doc = await em_thread(db.collection("CONTAS_100MS").document("contador").get)
+        return (doc.to_dict() or {}).get("conta_atual", 0)
 
-    return conta
+
+alocador_100ms = AlocadorContas100ms()
+
+
+async def get_account_and_increment():
+    return await alocador_100ms.alocar()
 
 from starlette.middleware.sessions import SessionMiddleware
 
@@ -281,6 +780,15 @@ ADMIN_USER = "admin"
 ADMIN_PASS = "1234"
 
 
+def admin_autenticado(request: Request) -> bool:
+    """Sessão aberta em /logini (rotas de manutenção que escrevem dados)."""
+    return bool(request.session.get("logged_in"))
+
+
+def acesso_negado_admin() -> JSONResponse:
+    return JSONResponse(status_code=403, content={"detail": "Acesso reservado ao administrador."})
+
+
 def safe_template_response(template_name, context, request=None):
     print("\n====== DEBUG TEMPLATE ======")
 
@@ -321,9 +829,1179 @@ def safe_template_response(template_name, context, request=None):
 
 
 # ===============================
-# ROTA LOGIN
+# 🔹 ÍNDICE DE ALUNOS
+# (nome / email / token de reset → id do documento)
 # ===============================
+ALUNOS_INDICE = "alunos_indice"
+# caminho do ID do documento em order_by/where (FieldPath.document_id())
+ID_DOCUMENTO = "__name__"
+
+
+def chave_nome_aluno(nome) -> str:
+    return str(nome or "").strip().lower()
+
+
+def chave_email_aluno(email) -> str:
+    return str(email or "").strip().lower()
+
+
+def chave_aluno(nome) -> str:
+    """
+    Chave canónica do aluno e ID do seu documento em 'alunos',
+    'comprovativos_pagamento' e 'chamadas_ao_vivo':
+    "  João  da Silva " -> "joao_da_silva" (sem acentos, minúsculas, "_" entre palavras).
+    """
+    texto = unicodedata.normalize("NFKD", str(nome or "")).encode("ascii", "ignore").decode()
+    return re.sub(r"[^a-z0-9]+", "_", texto.lower()).strip("_")
+
+
+def ids_antigos_aluno(nome) -> list:
+    """IDs que as versões anteriores davam ao documento do mesmo aluno."""
+    base = chave_nome_aluno(nome)
+    chave = chave_aluno(nome)
+    candidatos = (
+        base,
+        base.replace(" ", "_"),
+        base.replace("_", " "),
+        base.replace(" ", ""),
+        base.replace(" ", "-"),
+    )
+    return [c for c in dict.fromkeys(candidatos) if c and c != chave and "/" not in c and c not in (".", "..")]
+
+
+def _id_indice(tipo: str, valor: str) -> str:
+    # IDs de documento no Firestore não aceitam "/"
+    return f"{tipo}:{quote(valor, safe='')}"
+
+
+def _entradas_indice(dados: dict) -> dict:
+    entradas = {}
+
+    nome = chave_nome_aluno(dados.get("nome"))
+    if nome:
+        entradas[_id_indice("nome", nome)] = {"tipo": "nome", "valor": nome}
+
+    email = chave_email_aluno(dados.get("email"))
+    if email:
+        entradas[_id_indice("email", email)] = {"tipo": "email", "valor": email}
+
+    token = dados.get("reset_token")
+    if token:
+        entradas[_id_indice("token", token)] = {"tipo": "token", "valor": token}
+
+    return entradas
+
+
+def indexar_aluno(aluno_id: str, dados: dict, batch=None) -> int:
+    """Grava as entradas do índice que apontam para o aluno. Devolve quantas foram escritas."""
+    escritor = batch or db.batch()
+    entradas = _entradas_indice(dados)
+
+    for id_indice, entrada in entradas.items():
+        escritor.set(
+            db.collection(ALUNOS_INDICE).document(id_indice),
+            {**entrada, "aluno_id": aluno_id}
+        )
+
+    if batch is None and entradas:
+        escritor.commit()
+
+    return len(entradas)
+
+
+def remover_indice_aluno(tipo: str, valor: str):
+    if valor:
+        db.collection(ALUNOS_INDICE).document(_id_indice(tipo, valor)).delete()
+
+
+def _resolver_indice(tipo: str, valor: str, campo: str):
+    """Lê a entrada do índice e o documento do aluno (2 leituras, sem scan)."""
+    if not valor:
+        return None
+
+    entrada = db.collection(ALUNOS_INDICE).document(_id_indice(tipo, valor)).get()
+    if not entrada.exists:
+        return None
+
+    aluno_id = (entrada.to_dict() or {}).get("aluno_id")
+    doc = db.collection("alunos").document(aluno_id).get() if aluno_id else None
+
+    # documento já passado para o ID canónico por outro worker
+    if doc and not doc.exists:
+        novo_id = resolver_alias("alunos", aluno_id)
+        doc = db.collection("alunos").document(novo_id).get() if novo_id else None
+
+    if not doc or not doc.exists:
+        remover_indice_aluno(tipo, valor)
+        return None
+
+    # Entrada desatualizada (ex.: email alterado ou token já usado)
+    atual = (doc.to_dict() or {}).get(campo)
+    if tipo == "token":
+        coincide = atual == valor
+    else:
+        coincide = str(atual or "").strip().lower() == valor
+    if not coincide:
+        remover_indice_aluno(tipo, valor)
+        return None
+
+    return doc
+
+
+def _buscar_aluno(tipo: str, valor: str, campo_indice: str, campo_consulta: str):
+    doc = _resolver_indice(tipo, valor, campo_indice)
+    if doc:
+        return doc
+
+    # Registo ainda não indexado: consulta por igualdade e indexa para a próxima vez
+    if not valor:
+        return None
+
+    query = db.collection("alunos").where(campo_consulta, "==", valor).limit(1).stream()
+    doc = next(query, None)
+    if doc:
+        indexar_aluno(doc.id, doc.to_dict() or {})
+    return doc
+
+
+def buscar_aluno_por_nome(nome: str):
+    # point read no ID canónico; o índice de nomes fica para registos ainda não migrados
+    chave = chave_aluno(nome)
+    if chave:
+        doc = db.collection("alunos").document(chave).get()
+        if doc.exists and chave_nome_aluno((doc.to_dict() or {}).get("nome")) == chave_nome_aluno(nome):
+            return doc
+        if not doc.exists and migracao_ids.concluida:
+            return None
+    return _buscar_aluno("nome", chave_nome_aluno(nome), "nome", "nome_normalizado")
+
+
+def buscar_aluno_por_email(email: str):
+    return _buscar_aluno("email", chave_email_aluno(email), "email", "email")
+
+
+def buscar_aluno_por_token(token: str):
+    return _buscar_aluno("token", (token or "").strip(), "reset_token", "reset_token")
+
+
+# O Firestore aceita no máximo 30 valores num filtro 'in'
+LIMITE_IN = 30
+_pool_lotes = ThreadPoolExecutor(max_workers=8, thread_name_prefix="lotes-alunos")
+
+
+def _consultar_lote(campo: str, lote: list) -> list:
+    return list(db.collection("alunos").where(campo, "in", lote).stream())
+
+
+def buscar_alunos_em_lote(campo: str, valores) -> dict:
+    """
+    Resolve vários alunos de uma vez: valor de 'campo' -> dados do aluno.
+    Substitui uma consulta por aluno por consultas 'in' de 30 valores,
+    executadas em paralelo. Valores sem aluno ficam de fora do resultado.
+    """
+    valores = list(dict.fromkeys(v for v in valores if v))
+    if not valores:
+        return {}
+
+    lotes = [valores[i:i + LIMITE_IN] for i in range(0, len(valores), LIMITE_IN)]
+    if len(lotes) == 1:
+        resultados = [_consultar_lote(campo, lotes[0])]
+    else:
+        resultados = _pool_lotes.map(lambda lote: _consultar_lote(campo, lote), lotes)
+
+    alunos = {}
+    for docs in resultados:
+        for doc in docs:
+            dados = doc.to_dict() or {}
+            # como o antigo limit(1): fica o primeiro documento de cada valor
+            alunos.setdefault(dados.get(campo), dados)
+    return alunos
+
+
+def reindexar_alunos(apos: Optional[str] = None, limite: Optional[int] = None) -> dict:
+    """
+    Backfill do índice, retomável: percorre os alunos por ID a partir de 'apos'
+    (no máximo 'limite'; None percorre a coleção toda). Devolve 'proximo' para
+    continuar; None quando chegou ao fim.
+    """
+    alunos_ref = db.collection("alunos")
+    query = alunos_ref.order_by(ID_DOCUMENTO)
+    if apos:
+        query = query.where(ID_DOCUMENTO, ">", alunos_ref.document(apos))
+    if limite:
+        query = query.limit(limite)
+
+    batch = db.batch()
+    pendentes = 0
+    total = 0
+    ultimo_id = None
+
+    for doc in query.stream():
+        dados = doc.to_dict() or {}
+        pendentes += indexar_aluno(doc.id, dados, batch=batch)
+
+        # registos antigos sem nome_normalizado
+        if dados.get("nome") and "nome_normalizado" not in dados:
+            batch.update(doc.reference, {"nome_normalizado": chave_nome_aluno(dados["nome"])})
+            pendentes += 1
+
+        total += 1
+        ultimo_id = doc.id
+
+        # limite de 500 operações por batch
+        if pendentes >= 400:
+            batch.commit()
+            batch = db.batch()
+            pendentes = 0
+
+    if pendentes:
+        batch.commit()
+
+    return {
+        "alunos_indexados": total,
+        "proximo": ultimo_id if limite and total == limite else None
+    }
+
+
+@app.post("/reindexar-alunos")
+def reindexar_alunos_post(request: Request, apos: Optional[str] = None, limite: int = Query(200, ge=1, le=400)):
+    # uma página por pedido (limite documentos lidos, poucos commits): cabe no orçamento
+    if not admin_autenticado(request):
+        return acesso_negado_admin()
+    try:
+        return {"status": "ok", **reindexar_alunos(apos, limite)}
+    except Exception as e:
+        print("❌ Erro ao reindexar alunos:", e)
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+
+# ===============================
+# 🔹 IDS CANÓNICOS (MIGRAÇÃO ONLINE)
+# ===============================
+# Cada rota normalizava o nome do aluno à sua maneira (strip/lower, "_" ou ""
+# ou "-" no lugar dos espaços, sem acentos, uuid4) e o mesmo aluno tinha IDs
+# diferentes em cada coleção, o que obrigava a consultas e scans. Agora o ID é
+# sempre chave_aluno(nome) e as leituras quentes são document(chave).get().
+# migrar_lote() passa os documentos antigos para a chave canónica (um a um, em
+# transação) e deixa em ALIASES_IDS um alias "coleção:id antigo" -> id novo.
+# Enquanto a migração não terminar, documento_aluno() procura também os IDs
+# antigos (no mesmo get_all) e quem vai escrever migra o documento na hora.
+# O fim da migração fica em configuracoes/ids_canonicos, observado por todos
+# os workers.
+COLECOES_CHAVE_ALUNO = ("alunos", "comprovativos_pagamento", "chamadas_ao_vivo")
+ALIASES_IDS = "aliases_ids"
+# mover um documento: 2 leituras na transação, commit, releitura e contador do dashboard
+MOVER_LEITURAS = 3
+MOVER_IDAS = 5
+MIGRACAO_IDS_DOC = ("configuracoes", "ids_canonicos")
+_SUFIXO_DIA = re.compile(r"(.+)_(\d{4}-\d{2}-\d{2})")
+
+
+def _juntar_documentos(antigo: dict, novo: dict) -> dict:
+    """Campos do documento canónico prevalecem; listas (ex.: comprovativos) são unidas."""
+    juntos = {**antigo, **novo}
+    for campo, valor in antigo.items():
+        if isinstance(valor, list) and isinstance(novo.get(campo), list):
+            juntos[campo] = valor + [item for item in novo[campo] if item not in valor]
+    return juntos
+
+
+class MigracaoIds:
+    def __init__(self):
+        self.concluida = False
+        self._watch = None
+
+    def _estado_ref(self):
+        return db.collection(MIGRACAO_IDS_DOC[0]).document(MIGRACAO_IDS_DOC[1])
+
+    def carregar(self):
+        doc = self._estado_ref().get()
+        self.concluida = bool(doc.exists and (doc.to_dict() or {}).get("concluida"))
+        print(f"🔑 IDs canónicos: migração {'concluída' if self.concluida else 'por concluir'}")
+
+    def observar(self):
+        def ao_mudar(docs, mudancas, lido_em):
+            for doc in docs:
+                self.concluida = bool((doc.to_dict() or {}).get("concluida"))
+
+        self._watch = self._estado_ref().on_snapshot(ao_mudar)
+
+    def parar(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    @staticmethod
+    def id_canonico(colecao: str, doc) -> str:
+        dados = doc.to_dict() or {}
+        if colecao == "alunos":
+            return chave_aluno(dados.get("nome") or doc.id)
+        if colecao == "chamadas_ao_vivo":
+            # registrar-chamada guarda um documento por aluno e por dia
+            por_dia = _SUFIXO_DIA.fullmatch(doc.id)
+            if por_dia:
+                return f"{chave_aluno(dados.get('aluno') or por_dia.group(1))}_{por_dia.group(2)}"
+            return chave_aluno(dados.get("aluno") or doc.id)
+        return chave_aluno(doc.id)
+
+    def _mover_em_transacao(self, transaction, colecao: str, antigo_ref, novo_ref):
+        antigo = antigo_ref.get(transaction=transaction)
+        novo = novo_ref.get(transaction=transaction)
+        if not antigo.exists:
+            return "ausente", None
+        dados = antigo.to_dict() or {}
+        if novo.exists:
+            # dois alunos diferentes com a mesma chave: o antigo fica onde está
+            if colecao == "alunos":
+                return "conflito", None
+            dados = _juntar_documentos(dados, novo.to_dict() or {})
+
+        transaction.set(novo_ref, dados)
+        transaction.delete(antigo_ref)
+        transaction.set(db.collection(ALIASES_IDS).document(_id_indice(colecao, antigo_ref.id)), {
+            "colecao": colecao,
+            "antigo": antigo_ref.id,
+            "novo": novo_ref.id,
+            "migrado_em": datetime.now(timezone.utc).isoformat()
+        })
+        if colecao == "alunos":
+            indexar_aluno(novo_ref.id, dados, batch=transaction)
+        return ("junto" if novo.exists else "movido"), antigo.to_dict() or {}
+
+    def _passar(self, colecao: str, doc_antigo, novo_id: str) -> str:
+        novo_ref = db.collection(colecao).document(novo_id)
+        resultado, dados_antigos = _transacao(self._mover_em_transacao, colecao, doc_antigo.reference, novo_ref)
+        if resultado == "junto" and colecao == "chamadas_ao_vivo":
+            # duas chamadas passaram a uma: o contador do dashboard perde uma
+            registrar_transicao_chamada(dados_antigos.get("status"), None)
+        if resultado != "conflito":
+            print(f"🔑 {colecao}/{doc_antigo.id} -> {novo_id} ({resultado})")
+        return resultado
+
+    def mover(self, colecao: str, doc_antigo, novo_id: str):
+        """Passa o documento para o ID canónico; devolve o snapshot no ID novo (ou None em conflito)."""
+        if self._passar(colecao, doc_antigo, novo_id) == "conflito":
+            return None
+        return db.collection(colecao).document(novo_id).get()
+
+    def migrar_lote(self, colecao: Optional[str] = None, apos: Optional[str] = None, limite: int = 100) -> dict:
+        """
+        Migração retomável: percorre no máximo 'limite' documentos de 'colecao'
+        por ID a partir de 'apos' e pára antes de passar do orçamento do pedido.
+        Devolve 'proximo' ({colecao, apos}) para continuar; None quando as três
+        coleções foram percorridas, e nesse caso marca a migração como concluída.
+        """
+        colecao = colecao or COLECOES_CHAVE_ALUNO[0]
+        if colecao not in COLECOES_CHAVE_ALUNO:
+            raise ValueError(f"Coleção sem chave de aluno: {colecao}")
+
+        colecao_ref = db.collection(colecao)
+        query = colecao_ref.order_by(ID_DOCUMENTO)
+        if apos:
+            query = query.where(ID_DOCUMENTO, ">", colecao_ref.document(apos))
+        docs = list(query.limit(limite).stream())
+
+        contagem = {"documentos": 0, "migrados": 0, "conflitos": 0}
+        ultimo_id = apos
+        for doc in docs:
+            novo_id = self.id_canonico(colecao, doc)
+            if novo_id and novo_id != doc.id:
+                if orcamento_esgotado(MOVER_LEITURAS, MOVER_IDAS):
+                    break
+                if self._passar(colecao, doc, novo_id) == "conflito":
+                    contagem["conflitos"] += 1
+                else:
+                    contagem["migrados"] += 1
+            contagem["documentos"] += 1
+            ultimo_id = doc.id
+
+        resultado = {"colecao": colecao, **contagem}
+        if contagem["documentos"] < len(docs) or len(docs) == limite:
+            return {**resultado, "proximo": {"colecao": colecao, "apos": ultimo_id}}
+
+        seguinte = COLECOES_CHAVE_ALUNO.index(colecao) + 1
+        if seguinte < len(COLECOES_CHAVE_ALUNO):
+            return {**resultado, "proximo": {"colecao": COLECOES_CHAVE_ALUNO[seguinte], "apos": None}}
+
+        # os conflitos de 'alunos' continuam acessíveis pelo índice de nomes
+        self._estado_ref().set({
+            "concluida": True,
+            "concluida_em": datetime.now(timezone.utc).isoformat()
+        })
+        self.concluida = True
+        return {**resultado, "proximo": None}
+
+    def migrar(self) -> dict:
+        """Migração completa fora de pedidos (scripts, benchmarks): lote atrás de lote."""
+        resumo = {colecao: {"documentos": 0, "migrados": 0, "conflitos": 0} for colecao in COLECOES_CHAVE_ALUNO}
+        proximo = {"colecao": None, "apos": None}
+        while proximo is not None:
+            lote = self.migrar_lote(proximo["colecao"], proximo["apos"], limite=500)
+            for campo in ("documentos", "migrados", "conflitos"):
+                resumo[lote["colecao"]][campo] += lote[campo]
+            proximo = lote["proximo"]
+        return resumo
+
+
+migracao_ids = MigracaoIds()
+
+
+def resolver_alias(colecao: str, doc_id: str) -> Optional[str]:
+    """ID canónico de um documento migrado (None se o ID nunca foi migrado)."""
+    alias = db.collection(ALIASES_IDS).document(_id_indice(colecao, doc_id)).get()
+    return (alias.to_dict() or {}).get("novo") if alias.exists else None
+
+
+def documento_aluno(colecao: str, nome: str, migrar: bool = False, sufixo: str = ""):
+    """
+    Snapshot (pode não existir) do documento do aluno na coleção, lido por
+    point read em chave_aluno(nome) + sufixo. Antes do fim da migração também
+    procura os IDs antigos no mesmo get_all; migrar=True (quem vai escrever)
+    passa logo o documento antigo para o ID canónico. None se o nome não dá chave.
+    """
+    chave = chave_aluno(nome)
+    if not chave:
+        return None
+    colecao_ref = db.collection(colecao)
+    ref = colecao_ref.document(chave + sufixo)
+    antigos = [] if migracao_ids.concluida else [i + sufixo for i in ids_antigos_aluno(nome)]
+    if not antigos:
+        return ref.get()
+
+    docs = {doc.id: doc for doc in db.get_all([ref] + [colecao_ref.document(i) for i in antigos])}
+    if docs[ref.id].exists:
+        return docs[ref.id]
+    for antigo in antigos:
+        doc = docs.get(antigo)
+        if doc is not None and doc.exists:
+            return (migracao_ids.mover(colecao, doc, ref.id) or doc) if migrar else doc
+    return docs[ref.id]
+
+
+@app.on_event("startup")
+async def carregar_migracao_ids():
+    if db is None:
+        return
+    try:
+        await em_thread(migracao_ids.carregar)
+        migracao_ids.observar()
+    except Exception as e:
+        print("Erro ao carregar estado da migração de IDs:", e)
 
+
+@app.on_event("shutdown")
+async def parar_migracao_ids():
+    migracao_ids.parar()
+
+
+@app.post("/migrar-ids-canonicos")
+def migrar_ids_canonicos_post(
+    request: Request,
+    colecao: Optional[str] = None,
+    apos: Optional[str] = None,
+    limite: int = Query(100, ge=1, le=300)
+):
+    if not admin_autenticado(request):
+        return acesso_negado_admin()
+    if colecao and colecao not in COLECOES_CHAVE_ALUNO:
+        return JSONResponse(status_code=400, content={"detail": f"Coleção inválida: {colecao}"})
+    try:
+        return {"status": "ok", **migracao_ids.migrar_lote(colecao, apos, limite)}
+    except Exception as e:
+        print("❌ Erro ao migrar IDs canónicos:", e)
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+
+# ===============================
+# 🔹 ESTATÍSTICAS DO DASHBOARD
+# (contadores materializados em estatisticas/dashboard)
+# ===============================
+ESTATISTICAS_COLECAO = "estatisticas"
+ESTATISTICAS_DOC = "dashboard"
+
+# estados de chamada contados no dashboard -> campo do contador
+CONTADORES_CHAMADA = {
+    "aceito": "chamadas_aceito",
+    "pendente": "chamadas_pendente",
+    "recusado": "chamadas_recusado",
+}
+
+
+def _estatisticas_ref():
+    return db.collection(ESTATISTICAS_COLECAO).document(ESTATISTICAS_DOC)
+
+
+def _flag(dados: Optional[dict], campo: str) -> int:
+    # o dashboard sempre contou só valores exatamente True
+    return 1 if (dados or {}).get(campo) is True else 0
+
+
+def ajustar_estatisticas(batch=None, **deltas):
+    """Aplica incrementos ao documento de estatísticas (deltas a zero são ignorados)."""
+    campos = {campo: firestore.Increment(valor) for campo, valor in deltas.items() if valor}
+    if not campos:
+        return
+
+    if batch is not None:
+        batch.set(_estatisticas_ref(), campos, merge=True)
+    else:
+        _estatisticas_ref().set(campos, merge=True)
+
+
+def registrar_transicao_aluno(antes: Optional[dict], depois: Optional[dict], batch=None):
+    """antes=None: aluno criado; depois=None: aluno removido."""
+    try:
+        ajustar_estatisticas(
+            batch=batch,
+            alunos_total=(depois is not None) - (antes is not None),
+            alunos_online=_flag(depois, "online") - _flag(antes, "online"),
+            alunos_vinculados=_flag(depois, "vinculado") - _flag(antes, "vinculado"),
+        )
+    except Exception as e:
+        # os contadores nunca devem fazer falhar a rota; a reconciliação corrige
+        print("⚠️ Erro ao atualizar estatísticas de alunos:", e)
+
+
+def registrar_transicao_professor(antes: Optional[dict], depois: Optional[dict], batch=None):
+    try:
+        ajustar_estatisticas(
+            batch=batch,
+            professores_total=(depois is not None) - (antes is not None),
+            professores_online=_flag(depois, "online") - _flag(antes, "online"),
+        )
+    except Exception as e:
+        print("⚠️ Erro ao atualizar estatísticas de professores:", e)
+
+
+def registrar_transicao_chamada(status_antes: Optional[str], status_depois: Optional[str], batch=None):
+    antes = CONTADORES_CHAMADA.get(str(status_antes or "").lower())
+    depois = CONTADORES_CHAMADA.get(str(status_depois or "").lower())
+    if antes == depois:
+        return
+
+    deltas = {}
+    if antes:
+        deltas[antes] = -1
+    if depois:
+        deltas[depois] = deltas.get(depois, 0) + 1
+
+    try:
+        ajustar_estatisticas(batch=batch, **deltas)
+    except Exception as e:
+        print("⚠️ Erro ao atualizar estatísticas de chamadas:", e)
+
+
+def _contar(query) -> int:
+    """Agregação count(): uma ida ao servidor, sem ler os documentos."""
+    return int(query.count().get()[0][0].value)
+
+
+def reconciliar_estatisticas() -> dict:
+    """
+    Reconstrói os contadores do zero com agregações count() (uma por
+    contador): o custo não cresce com o tamanho das coleções.
+    """
+    alunos = db.collection("alunos")
+    professores = db.collection("professores_online")
+    chamadas = db.collection("chamadas_ao_vivo")
+
+    # _flag conta só valores exatamente True; as rotas gravam o status das chamadas em minúsculas
+    contadores = {
+        "alunos_total": _contar(alunos),
+        "alunos_online": _contar(alunos.where("online", "==", True)),
+        "alunos_vinculados": _contar(alunos.where("vinculado", "==", True)),
+        "professores_total": _contar(professores),
+        "professores_online": _contar(professores.where("online", "==", True)),
+        **{campo: _contar(chamadas.where("status", "==", estado)) for estado, campo in CONTADORES_CHAMADA.items()},
+    }
+
+    contadores["reconciliado_em"] = datetime.now(timezone.utc).isoformat()
+    _estatisticas_ref().set(contadores)
+    return contadores
+
+
+@app.post("/reconciliar-estatisticas")
+def reconciliar_estatisticas_post(request: Request):
+    if not admin_autenticado(request):
+        return acesso_negado_admin()
+    try:
+        return {"status": "ok", "estatisticas": reconciliar_estatisticas()}
+    except Exception as e:
+        print("❌ Erro ao reconciliar estatísticas:", e)
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+
+# ============================
+# 🔹 REPOSITÓRIO DE PROFESSORES
+# ============================
+# Os perfis de 'professores_online' e 'professores_online2' ficam em memória,
+# indexados pelo email (minúsculas), e são mantidos por um único on_snapshot
+# por coleção: procurar um professor pelo email é uma consulta a um dicionário.
+# Os índices que dependem destas coleções (presença, geografia, disponibilidade)
+# recebem as mudanças através de ao_mudar() em vez de abrirem outro watcher.
+# Depois de gravar num professor, o worker chama invalidar(email): durante
+# PROFESSORES_SUJO_S segundos (mais do que o atraso do watcher) esse email é
+# lido do Firestore, para a página seguinte não mostrar os dados antigos.
+PROFESSORES_COLECOES = ("professores_online", "professores_online2")
+PROFESSORES_SUJO_S = float(os.environ.get("PROFESSORES_SUJO_S", "5"))
+
+
+def chave_professor(doc) -> str:
+    dados = doc.to_dict() or {}
+    return str(dados.get("email") or doc.id).strip().lower()
+
+
+class _ObservacaoProfessores:
+    def __init__(self, repositorio, colecao: str, callback):
+        self._repositorio = repositorio
+        self._colecao = colecao
+        self._callback = callback
+
+    def unsubscribe(self):
+        self._repositorio._remover_ouvinte(self._colecao, self._callback)
+
+
+class RepositorioProfessores:
+    def __init__(self, sujo_s: float = PROFESSORES_SUJO_S):
+        self.sujo_s = sujo_s
+        self._lock = threading.Lock()
+        self._lock_avisos = threading.RLock()
+        self._por_email = {c: {} for c in PROFESSORES_COLECOES}     # email -> {id do documento: snapshot}
+        self._email_do_doc = {c: {} for c in PROFESSORES_COLECOES}  # id do documento -> email
+        self._sujos = {}                                            # (coleção, email) -> até quando
+        self._ouvintes = {c: [] for c in PROFESSORES_COLECOES}
+        self._watches = []
+        self.carregado = False
+        self._contadores = {"acerto": 0, "acerto_negativo": 0, "falha": 0, "invalidacao": 0}
+
+    # ---------- estado vindo do Firestore ----------
+    def _guardar(self, colecao: str, doc, removido: bool):
+        email = chave_professor(doc)
+        with self._lock:
+            antigo = self._email_do_doc[colecao].pop(doc.id, None)
+            if antigo is not None:
+                docs = self._por_email[colecao].get(antigo, {})
+                docs.pop(doc.id, None)
+                if not docs:
+                    self._por_email[colecao].pop(antigo, None)
+            if not removido and email:
+                self._por_email[colecao].setdefault(email, {})[doc.id] = doc
+                self._email_do_doc[colecao][doc.id] = email
+
+    def carregar(self):
+        docs = {c: list(db.collection(c).stream()) if db is not None else [] for c in PROFESSORES_COLECOES}
+        with self._lock:
+            self._por_email = {c: {} for c in PROFESSORES_COLECOES}
+            self._email_do_doc = {c: {} for c in PROFESSORES_COLECOES}
+        for colecao, lista in docs.items():
+            for doc in lista:
+                self._guardar(colecao, doc, False)
+        self.carregado = True
+        print(f"👩‍🏫 Repositório de professores: {len(docs['professores_online'])} em professores_online, "
+              f"{len(docs['professores_online2'])} em professores_online2")
+
+    def _garantir(self):
+        if not self.carregado:
+            self.carregar()
+
+    def observar(self):
+        for colecao in PROFESSORES_COLECOES:
+            def ao_mudar(docs, mudancas, lido_em, colecao=colecao):
+                for mudanca in mudancas:
+                    removido = mudanca.type.name == "REMOVED"
+                    self._guardar(colecao, mudanca.document, removido)
+                    self._avisar(colecao, mudanca.document, removido)
+
+            self._watches.append(db.collection(colecao).on_snapshot(ao_mudar))
+
+    def parar(self):
+        for watch in self._watches:
+            watch.unsubscribe()
+        self._watches = []
+
+    # ---------- quem depende das coleções ----------
+    def ao_mudar(self, colecao: str, callback):
+        """
+        callback(doc, removido) a cada mudança na coleção; começa por receber
+        todos os documentos atuais. Devolve um objeto com unsubscribe().
+        """
+        self._garantir()
+        with self._lock_avisos:
+            self._ouvintes[colecao].append(callback)
+            for doc in self.documentos(colecao):
+                callback(doc, False)
+        return _ObservacaoProfessores(self, colecao, callback)
+
+    def _remover_ouvinte(self, colecao: str, callback):
+        with self._lock_avisos:
+            if callback in self._ouvintes[colecao]:
+                self._ouvintes[colecao].remove(callback)
+
+    def _avisar(self, colecao: str, doc, removido: bool):
+        with self._lock_avisos:
+            for callback in list(self._ouvintes[colecao]):
+                try:
+                    callback(doc, removido)
+                except Exception as e:
+                    print(f"⚠️ Erro ao avisar mudança em {colecao}:", e)
+
+    # ---------- leitura ----------
+    def _consultar(self, colecao: str, email: str) -> list:
+        if colecao == "professores_online2":
+            # aqui o email é o ID do documento
+            doc = db.collection(colecao).document(email).get()
+            if doc.exists:
+                return [doc]
+        return list(db.collection(colecao).where("email", "==", email).stream())
+
+    def todos_por_email(self, email: str, colecao: str = "professores_online", fresco: bool = False) -> list:
+        """
+        Todos os documentos da coleção com este email (ordem dos IDs, como o Firestore).
+        fresco=True lê do Firestore (leituras antes de uma escrita que depende delas).
+        """
+        email = str(email or "").strip().lower()
+        if not email:
+            return []
+        self._garantir()
+        agora = time.monotonic()
+        with self._lock:
+            sujo = self._sujos.get((colecao, email), 0) > agora
+            if not sujo and not fresco:
+                docs = self._por_email[colecao].get(email)
+                self._contadores["acerto" if docs else "acerto_negativo"] += 1
+                return [docs[doc_id] for doc_id in sorted(docs)] if docs else []
+            self._contadores["falha"] += 1
+        return sorted(self._consultar(colecao, email), key=lambda doc: doc.id)
+
+    def por_email(self, email: str, colecao: str = "professores_online", fresco: bool = False):
+        """Equivalente a where('email', '==', email).limit(1): o snapshot ou None."""
+        docs = self.todos_por_email(email, colecao, fresco)
+        return docs[0] if docs else None
+
+    def dados(self, email: str, colecao: str = "professores_online") -> Optional[dict]:
+        doc = self.por_email(email, colecao)
+        return doc.to_dict() if doc else None
+
+    def por_id(self, doc_id: str, colecao: str = "professores_online"):
+        with self._lock:
+            email = self._email_do_doc[colecao].get(doc_id)
+        if email is None:
+            doc = db.collection(colecao).document(doc_id).get()
+            return doc if doc.exists else None
+        for doc in self.todos_por_email(email, colecao):
+            if doc.id == doc_id:
+                return doc
+        return None
+
+    def documentos(self, colecao: str = "professores_online") -> list:
+        self._garantir()
+        with self._lock:
+            return [doc for docs in self._por_email[colecao].values() for doc in docs.values()]
+
+    def invalidar(self, *emails: str):
+        """Chamar depois de criar, alterar ou apagar estes professores (nas duas coleções)."""
+        agora = time.monotonic()
+        with self._lock:
+            self._contadores["invalidacao"] += 1
+            self._sujos = {chave: ate for chave, ate in self._sujos.items() if ate > agora}
+            for email in emails:
+                email = str(email or "").strip().lower()
+                for colecao in PROFESSORES_COLECOES:
+                    self._sujos[(colecao, email)] = agora + self.sujo_s
+
+    def contadores(self) -> dict:
+        with self._lock:
+            return dict(self._contadores)
+
+    def resumo(self) -> dict:
+        contadores = self.contadores()
+        consultas = contadores["acerto"] + contadores["acerto_negativo"] + contadores["falha"]
+        agora = time.monotonic()
+        with self._lock:
+            tamanhos = {c: sum(len(d) for d in self._por_email[c].values()) for c in PROFESSORES_COLECOES}
+            sujos = sum(1 for ate in self._sujos.values() if ate > agora)
+        return {
+            **tamanhos,
+            "a_observar": bool(self._watches),
+            "sujos": sujos,
+            **contadores,
+            "taxa_acerto": round((consultas - contadores["falha"]) / consultas, 3) if consultas else None
+        }
+
+
+repositorio_professores = RepositorioProfessores()
+metricas_rotas.registrar_cache("professores", repositorio_professores.contadores)
+
+
+@app.on_event("startup")
+async def carregar_repositorio_professores():
+    if db is None:
+        return
+    try:
+        await em_thread(repositorio_professores.carregar)
+        repositorio_professores.observar()
+    except Exception as e:
+        print("Erro ao carregar repositório de professores:", e)
+
+
+@app.on_event("shutdown")
+async def parar_repositorio_professores():
+    repositorio_professores.parar()
+
+
+@app.get("/status-cache-professores")
+def status_cache_professores():
+    return repositorio_professores.resumo()
+
+
+# ===============================
+# 🔹 PRESENÇA (ONLINE / ÚLTIMO ACESSO)
+# ===============================
+# Tabela em memória com o último batimento de cada aluno e professor. Os
+# batimentos só mexem na tabela; a cada PRESENCA_INTERVALO segundos quem passou
+# PRESENCA_TTL sem batimento fica offline e as mudanças vão para o Firestore
+# num batch (com os contadores do dashboard). 'ultimo_ping' de quem continua
+# online é regravado no máximo a cada PRESENCA_PING_GRAVAR segundos.
+# Cada worker observa os alunos online (on_snapshot sobre online == True, não a
+# coleção inteira) e 'professores_online' (através do repositório de
+# professores), por isso vê o que os outros gravaram; antes de expirar alguém relê 'ultimo_ping', caso
+# os batimentos estejam a chegar a outro worker. Quem sai da consulta ficou
+# offline. A tabela começa só com os alunos online; os outros são lidos quando
+# aparecem (batimento, saída ou listas de estado do professor).
+PRESENCA_TTL = int(os.environ.get("PRESENCA_TTL", "120"))
+PRESENCA_INTERVALO = int(os.environ.get("PRESENCA_INTERVALO", "10"))
+PRESENCA_PING_GRAVAR = int(os.environ.get("PRESENCA_PING_GRAVAR", "60"))
+
+PRESENCA_COLECOES = {"aluno": "alunos", "professor": "professores_online"}
+# campos do professor guardados para '/listar-professores-online'
+PRESENCA_CAMPOS_PROFESSOR = ("email", "nome_completo", "telefone", "telefone_alternativo", "foto_perfil")
+
+
+def _instante(valor) -> float:
+    """Timestamp (ISO ou datetime) -> segundos desde a época; 0 se inválido."""
+    if isinstance(valor, str):
+        try:
+            valor = datetime.fromisoformat(valor)
+        except ValueError:
+            return 0.0
+    if not isinstance(valor, datetime):
+        return 0.0
+    if valor.tzinfo is None:
+        valor = valor.replace(tzinfo=timezone.utc)
+    return valor.timestamp()
+
+
+def _iso(instante: float) -> str:
+    return datetime.fromtimestamp(instante, timezone.utc).isoformat()
+
+
+def chave_presenca(tipo: str, dados: dict) -> str:
+    if tipo == "aluno":
+        return dados.get("nome_normalizado") or chave_nome_aluno(dados.get("nome"))
+    return (dados.get("email") or "").strip().lower()
+
+
+class Presenca:
+    def __init__(self, ttl: int = PRESENCA_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._estado = {}
+        self._pendentes = set()
+        self._tarefa = None
+        self._watches = []
+
+    # ---------- estado vindo do Firestore ----------
+    def _aplicar(self, tipo: str, doc_id: str, dados: dict):
+        chave = chave_presenca(tipo, dados)
+        if not chave:
+            return
+        agora = time.time()
+        online = dados.get("online") is True
+        ping = _instante(dados.get("ultimo_ping"))
+        perfil = {campo: dados[campo] for campo in PRESENCA_CAMPOS_PROFESSOR if campo in dados} if tipo == "professor" else {}
+
+        with self._lock:
+            entrada = self._estado.get((tipo, chave))
+            if entrada is None:
+                # quem já estava online tem um TTL para dar sinal de vida
+                self._estado[(tipo, chave)] = {
+                    "doc_id": doc_id,
+                    "online": online,
+                    "online_gravado": online,
+                    "visto": agora if online else ping,
+                    "ping_gravado": ping,
+                    "last_seen": dados.get("last_seen"),
+                    "perfil": perfil
+                }
+                return
+
+            entrada["doc_id"] = doc_id
+            entrada["perfil"] = perfil
+            entrada["ping_gravado"] = max(entrada["ping_gravado"], ping)
+            entrada["visto"] = max(entrada["visto"], ping)
+            if dados.get("last_seen"):
+                entrada["last_seen"] = dados["last_seen"]
+            if (tipo, chave) in self._pendentes:
+                return
+            # mudança gravada por outro worker (ou eco da nossa)
+            entrada["online_gravado"] = online
+            if online and not entrada["online"]:
+                entrada["visto"] = max(entrada["visto"], agora)
+            entrada["online"] = online
+
+    def _remover(self, tipo: str, doc_id: str, dados: dict):
+        with self._lock:
+            chave = (tipo, chave_presenca(tipo, dados))
+            entrada = self._estado.get(chave)
+            # um documento movido (IDs canónicos) chega como novo + removido
+            if entrada is None or entrada["doc_id"] != doc_id:
+                return
+            self._estado.pop(chave, None)
+            self._pendentes.discard(chave)
+
+    def _saiu_da_consulta(self, doc_id: str, dados: dict):
+        """Aluno que deixou de estar online (ou foi apagado) noutro worker."""
+        chave = ("aluno", chave_presenca("aluno", dados))
+        with self._lock:
+            entrada = self._estado.get(chave)
+            if entrada is None or entrada["doc_id"] != doc_id or chave in self._pendentes:
+                return
+            entrada["online_gravado"] = False
+            if entrada["online"]:
+                entrada["online"] = False
+                # o documento já não chega aqui: último acesso é o último sinal conhecido
+                entrada["last_seen"] = _iso(entrada["visto"] or time.time())
+
+    def _mudou(self, tipo: str, doc, removido: bool):
+        dados = doc.to_dict() or {}
+        if removido:
+            self._remover(tipo, doc.id, dados)
+        else:
+            self._aplicar(tipo, doc.id, dados)
+
+    def carregar(self):
+        # só os alunos online, tal como o on_snapshot; os outros entram com _registar
+        for doc in db.collection(PRESENCA_COLECOES["aluno"]).where("online", "==", True).stream():
+            self._aplicar("aluno", doc.id, doc.to_dict() or {})
+        for doc in repositorio_professores.documentos(PRESENCA_COLECOES["professor"]):
+            self._aplicar("professor", doc.id, doc.to_dict() or {})
+
+    def observar(self):
+        def ao_mudar(docs, mudancas, lido_em):
+            for mudanca in mudancas:
+                if mudanca.type.name == "REMOVED":
+                    self._saiu_da_consulta(mudanca.document.id, mudanca.document.to_dict() or {})
+                else:
+                    self._aplicar("aluno", mudanca.document.id, mudanca.document.to_dict() or {})
+
+        online = db.collection(PRESENCA_COLECOES["aluno"]).where("online", "==", True)
+        self._watches.append(online.on_snapshot(ao_mudar))
+        self._watches.append(repositorio_professores.ao_mudar(
+            PRESENCA_COLECOES["professor"], lambda doc, removido: self._mudou("professor", doc, removido)
+        ))
+
+    # ---------- batimentos ----------
+    def _registar(self, tipo: str, chave: str, doc=None):
+        """Põe na tabela alguém que ainda não está lá (alunos offline não chegam pelo on_snapshot)."""
+        if (tipo, chave) in self._estado:
+            return
+        if doc is None and tipo == "aluno":
+            doc = buscar_aluno_por_nome(chave)
+        if doc is not None:
+            self._aplicar(tipo, doc.id, doc.to_dict() or {})
+
+    def registar_alunos(self, nomes) -> int:
+        """Põe na tabela vários alunos de uma vez (consultas 'in'), antes de os consultar."""
+        with self._lock:
+            em_falta = list(dict.fromkeys(
+                chave for chave in (chave_nome_aluno(n) for n in nomes)
+                if chave and ("aluno", chave) not in self._estado
+            ))
+        registados = 0
+        for inicio in range(0, len(em_falta), LIMITE_IN):
+            for doc in _consultar_lote("nome_normalizado", em_falta[inicio:inicio + LIMITE_IN]):
+                self._aplicar("aluno", doc.id, doc.to_dict() or {})
+                registados += 1
+        return registados
+
+    def batimento(self, tipo: str, chave: str, doc=None) -> bool:
+        """Marca online. 'doc' (snapshot) regista alguém que ainda não está na tabela."""
+        self._registar(tipo, chave, doc)
+
+        agora = time.time()
+        with self._lock:
+            entrada = self._estado.get((tipo, chave))
+            if entrada is None:
+                return False
+            entrada["visto"] = agora
+            if not entrada["online"] or agora - entrada["ping_gravado"] >= PRESENCA_PING_GRAVAR:
+                entrada["online"] = True
+                self._pendentes.add((tipo, chave))
+        return True
+
+    def sair(self, tipo: str, chave: str) -> bool:
+        self._registar(tipo, chave)
+        with self._lock:
+            entrada = self._estado.get((tipo, chave))
+            if entrada is None:
+                return False
+            entrada["online"] = False
+            entrada["last_seen"] = _iso(time.time())
+            self._pendentes.add((tipo, chave))
+        return True
+
+    # ---------- leitura ----------
+    def consultar(self, tipo: str, chave: str) -> Optional[dict]:
+        with self._lock:
+            entrada = self._estado.get((tipo, str(chave or "").strip().lower()))
+            if entrada is None:
+                return None
+            return {"online": entrada["online"], "last_seen": entrada["last_seen"]}
+
+    def professores(self) -> list:
+        with self._lock:
+            return [
+                {**entrada["perfil"], "online": entrada["online"]}
+                for (tipo, _), entrada in self._estado.items() if tipo == "professor"
+            ]
+
+    # ---------- expiração e gravação ----------
+    def _expirar(self, agora: float):
+        limite = agora - self.ttl
+        with self._lock:
+            vencidos = [
+                (chave, entrada["doc_id"]) for chave, entrada in self._estado.items()
+                if entrada["online"] and entrada["visto"] < limite and chave not in self._pendentes
+            ]
+        if not vencidos:
+            return
+
+        # os batimentos podem estar a chegar a outro worker: confirma no documento
+        refs = [db.collection(PRESENCA_COLECOES[tipo]).document(doc_id) for (tipo, _), doc_id in vencidos]
+        pings = {}
+        for doc in db.get_all(refs):
+            if doc.exists:
+                pings[doc.reference.path] = _instante((doc.to_dict() or {}).get("ultimo_ping"))
+
+        with self._lock:
+            for ref, (chave, _) in zip(refs, vencidos):
+                entrada = self._estado.get(chave)
+                if entrada is None or not entrada["online"]:
+                    continue
+                entrada["visto"] = max(entrada["visto"], pings.get(ref.path, 0.0))
+                if entrada["visto"] < limite:
+                    entrada["online"] = False
+                    entrada["last_seen"] = _iso(entrada["visto"] or agora)
+                    self._pendentes.add(chave)
+
+    def gravar(self) -> int:
+        if db is None:
+            return 0
+        self._expirar(time.time())
+
+        with self._lock:
+            escritas = []
+            for chave in list(self._pendentes):
+                entrada = self._estado.get(chave)
+                if entrada is None:
+                    self._pendentes.discard(chave)
+                    continue
+                alteracoes = {"online": entrada["online"]}
+                if entrada["online"]:
+                    alteracoes["ultimo_ping"] = _iso(entrada["visto"])
+                else:
+                    alteracoes["last_seen"] = entrada["last_seen"]
+                escritas.append((chave, entrada["doc_id"], alteracoes, entrada["online_gravado"]))
+
+        for inicio in range(0, len(escritas), 400):
+            parte = escritas[inicio:inicio + 400]
+            batch = db.batch()
+            deltas = {"aluno": 0, "professor": 0}
+            for (tipo, _), doc_id, alteracoes, online_gravado in parte:
+                batch.update(db.collection(PRESENCA_COLECOES[tipo]).document(doc_id), alteracoes)
+                deltas[tipo] += int(alteracoes["online"]) - int(online_gravado)
+            ajustar_estatisticas(batch=batch, alunos_online=deltas["aluno"], professores_online=deltas["professor"])
+            batch.commit()
+
+            with self._lock:
+                for chave, _, alteracoes, _ in parte:
+                    entrada = self._estado.get(chave)
+                    if entrada is None:
+                        continue
+                    entrada["online_gravado"] = alteracoes["online"]
+                    if "ultimo_ping" in alteracoes:
+                        entrada["ping_gravado"] = _instante(alteracoes["ultimo_ping"])
+                    # só sai dos pendentes se não mudou durante a gravação
+                    if entrada["online"] == alteracoes["online"]:
+                        self._pendentes.discard(chave)
+
+        return len(escritas)
+
+    async def _ciclo(self):
+        while True:
+            await asyncio.sleep(PRESENCA_INTERVALO)
+            try:
+                await em_thread(self.gravar)
+            except Exception as e:
+                print("⚠️ Erro ao gravar presença:", e)
+
+    def iniciar(self):
+        if self._tarefa is None:
+            self._tarefa = asyncio.get_running_loop().create_task(self._ciclo())
+
+    async def parar(self):
+        if self._tarefa is not None:
+            self._tarefa.cancel()
+            self._tarefa = None
+        for watch in self._watches:
+            watch.unsubscribe()
+        self._watches = []
+        await em_thread(self.gravar)
+
+    def resumo(self) -> dict:
+        with self._lock:
+            online = {"aluno": 0, "professor": 0}
+            for (tipo, _), entrada in self._estado.items():
+                online[tipo] += entrada["online"]
+            return {
+                "alunos_online": online["aluno"],
+                "professores_online": online["professor"],
+                "registos": len(self._estado),
+                "por_gravar": len(self._pendentes)
+            }
+
+
+presenca = Presenca()
+
+
+@app.on_event("startup")
+async def iniciar_presenca():
+    if db is None:
+        return
+    try:
+        await em_thread(presenca.carregar)
+        presenca.observar()
+    except Exception as e:
+        print("Erro ao carregar presença:", e)
+    presenca.iniciar()
+
+
+@app.on_event("shutdown")
+async def parar_presenca():
+    try:
+        await presenca.parar()
+    except Exception as e:
+        print("⚠️ Erro ao gravar presença no shutdown:", e)
+
+
+@app.get("/status-presenca")
+def status_presenca():
+    return presenca.resumo()
+
+
+# ===============================
+# ROTA LOGIN
+# ===============================
 @app.get("/login")
 async def exibir_login(request: Request, sucesso: int = 0):
     try:
@@ -345,16 +2023,14 @@ async def exibir_login(request: Request, sucesso: int = 0):
         )
 
 @app.post("/login")
-async def login(request: Request, nome: str = Form(...), senha: str = Form(...)):
+def login(request: Request, nome: str = Form(...), senha: str = Form(...)):
     try:
-        alunos_ref = db.collection("alunos")
-
         nome_digitado = nome.strip().lower()
         senha_digitada = senha.strip().lower()
 
-        alunos = alunos_ref.stream()
+        aluno = buscar_aluno_por_nome(nome_digitado)
 
-        for aluno in alunos:
+        if aluno:
             dados = aluno.to_dict() or {}
 
             nome_banco = str(dados.get("nome", "")).strip().lower()
@@ -366,10 +2042,7 @@ async def login(request: Request, nome: str = Form(...), senha: str = Form(...))
                     request.session["aluno_logado"] = True
                     request.session["aluno_nome"] = nome_banco
 
-                try:
-                    aluno.reference.update({"online": True})
-                except Exception as e:
-                    print("Firebase erro:", e)
+                presenca.batimento("aluno", chave_presenca("aluno", dados), aluno)
 
                 return RedirectResponse(
                     url=f"/perfil/{dados.get('nome', '')}",
@@ -469,7 +2142,7 @@ async def logini(
         
 
 @app.get("/admin", response_class=HTMLResponse)
-async def painel_admin(request: Request):
+def painel_admin(request: Request):
     try:
         # 🔐 Proteção de sessão
         if not request.session.get("logged_in"):
@@ -518,93 +2191,467 @@ class VinculoIn(BaseModel):
     aluno_nome: str
 
 
-def vinculo_existe(prof_email: str, aluno_nome: str) -> bool:
-    prof_normalizado = prof_email.strip().lower()
-    aluno_normalizado = aluno_nome.strip().lower()
+# ============================
+# 🔹 CACHE DE VÍNCULOS
+# ============================
+# Quase todas as páginas do aluno procuram o mesmo documento de
+# 'alunos_professor' pelo campo 'aluno'. A cache guarda, por valor de 'aluno',
+# todos os vínculos desse aluno (lista vazia = sem vínculo, cache negativa);
+# o vínculo de um par (professor, aluno) sai da mesma entrada.
+# As entradas expiram ao fim de VINCULOS_CACHE_TTL segundos (o limite de
+# atraso entre workers) e são invalidadas em todas as escritas deste worker.
+# Leituras seguidas de escrita (aulas, pagamentos) continuam a ler do
+# Firestore, para não gravar por cima de dados de outro worker.
+VINCULOS_CACHE_TTL = float(os.environ.get("VINCULOS_CACHE_TTL", "60"))
+VINCULOS_CACHE_MAX = int(os.environ.get("VINCULOS_CACHE_MAX", "20000"))
+
+
+class CacheVinculos:
+
+    def __init__(self, ttl: float = VINCULOS_CACHE_TTL, maximo: int = VINCULOS_CACHE_MAX):
+        self.ttl = ttl
+        self.maximo = maximo
+        self._lock = threading.Lock()
+        self._por_aluno = {}     # valor de 'aluno' -> (expira_em, [snapshots])
+        self._aluno_do_doc = {}  # id do documento -> valor de 'aluno' em cache
+        self._geracao = 0        # muda a cada invalidação
+        self._contadores = {"acerto": 0, "acerto_negativo": 0, "falha": 0, "invalidacao": 0}
+
+    def _consultar(self, aluno: str) -> list:
+        return list(db.collection("alunos_professor").where("aluno", "==", aluno).stream())
+
+    def do_aluno(self, aluno: str, fresco: bool = False) -> list:
+        """
+        Todos os vínculos cujo campo 'aluno' é exatamente este valor (ordem dos IDs).
+        fresco=True ignora a entrada em cache (leituras antes de uma escrita).
+        """
+        agora = time.monotonic()
+        with self._lock:
+            entrada = self._por_aluno.get(aluno)
+            if not fresco and entrada is not None and entrada[0] > agora:
+                self._contadores["acerto" if entrada[1] else "acerto_negativo"] += 1
+                return entrada[1]
+            self._contadores["falha"] += 1
+            geracao = self._geracao
+
+        docs = self._consultar(aluno)
+
+        with self._lock:
+            # uma invalidação durante a consulta pode ter tornado o resultado antigo
+            if geracao == self._geracao:
+                if len(self._por_aluno) >= self.maximo:
+                    self._expulsar(agora)
+                self._por_aluno[aluno] = (agora + self.ttl, docs)
+                for doc in docs:
+                    self._aluno_do_doc[doc.id] = aluno
+        return docs
+
+    def primeiro(self, aluno: str, fresco: bool = False):
+        """Equivalente a where('aluno', '==', aluno).limit(1): o snapshot ou None."""
+        docs = self.do_aluno(aluno, fresco)
+        return docs[0] if docs else None
+
+    def do_par(self, professor: str, aluno: str, fresco: bool = False):
+        for doc in self.do_aluno(aluno, fresco):
+            if (doc.to_dict() or {}).get("professor") == professor:
+                return doc
+        return None
 
-    docs = db.collection('alunos_professor') \
-             .where("professor", "==", prof_normalizado) \
-             .where("aluno", "==", aluno_normalizado) \
-             .limit(1).stream()
+    def _expulsar(self, agora: float):
+        expirados = [a for a, (expira_em, _) in self._por_aluno.items() if expira_em <= agora]
+        # sem expirados, sai o quarto mais antigo (ordem de inserção)
+        for aluno in expirados or list(self._por_aluno)[:max(1, self.maximo // 4)]:
+            self._remover(aluno)
+
+    def _remover(self, aluno: str):
+        entrada = self._por_aluno.pop(aluno, None)
+        if entrada:
+            for doc in entrada[1]:
+                self._aluno_do_doc.pop(doc.id, None)
+
+    def invalidar(self, *alunos: str):
+        """Chamar depois de criar, alterar ou apagar vínculos destes alunos (valor do campo 'aluno')."""
+        with self._lock:
+            self._geracao += 1
+            self._contadores["invalidacao"] += 1
+            for aluno in alunos:
+                self._remover(aluno)
+
+    def invalidar_documento(self, doc_id: str):
+        """Para escritas por ID do documento, quando o aluno não é conhecido."""
+        with self._lock:
+            self._geracao += 1
+            self._contadores["invalidacao"] += 1
+            aluno = self._aluno_do_doc.get(doc_id)
+            if aluno is not None:
+                self._remover(aluno)
+
+    def limpar(self):
+        with self._lock:
+            self._geracao += 1
+            self._por_aluno.clear()
+            self._aluno_do_doc.clear()
+
+    def contadores(self) -> dict:
+        with self._lock:
+            return dict(self._contadores)
+
+    def resumo(self) -> dict:
+        contadores = self.contadores()
+        consultas = contadores["acerto"] + contadores["acerto_negativo"] + contadores["falha"]
+        with self._lock:
+            entradas = len(self._por_aluno)
+        return {
+            "entradas": entradas,
+            "ttl_s": self.ttl,
+            **contadores,
+            "taxa_acerto": round((consultas - contadores["falha"]) / consultas, 3) if consultas else None
+        }
 
-    return next(docs, None) is not None
+
+cache_vinculos = CacheVinculos()
+metricas_rotas.registrar_cache("vinculos", cache_vinculos.contadores)
+
+
+@app.get("/status-cache-vinculos")
+def status_cache_vinculos():
+    return cache_vinculos.resumo()
+
+
+def vinculo_existe(prof_email: str, aluno_nome: str, fresco: bool = False) -> Optional[dict]:
+    """Dados do vínculo entre o professor e o aluno (None se não existir)."""
+    doc = cache_vinculos.do_par(prof_email.strip().lower(), aluno_nome.strip().lower(), fresco)
+    return doc.to_dict() if doc else None
+
+
+def dados_vinculo(prof: str, aluno_nome: str, dados_aluno: dict) -> dict:
+    """Documento de 'alunos_professor' para um novo vínculo."""
+    return {
+        'professor': prof,
+        'aluno': aluno_nome,
+        'dados_aluno': {
+            'nome': dados_aluno.get('nome', ''),
+            'disciplina': dados_aluno.get('disciplina', ''),
+            'progresso_ingles': dados_aluno.get('progresso_ingles', 0),
+            'provincia': dados_aluno.get('provincia', '').strip(),
+            'municipio': dados_aluno.get('municipio', '').strip(),
+            'bairro': dados_aluno.get('bairro', '').strip(),
+            'telefone': dados_aluno.get('telefone', '').strip(),
+        },
+        'vinculado_em': datetime.now(timezone.utc).isoformat(),
+        'online': True,
+
+        # Ordem solicitada
+        'notificacao': False,
+        'notificacao_todos': True,
+
+        'aulas_dadas': 0,
+        'total_aulas': 12,
+        'aulas': [],
+        'horario': {},
+        'datas_aulas': []
+    }
 
 
 @app.post('/vincular-aluno', status_code=201)
-async def vincular_aluno(item: VinculoIn):
+def vincular_aluno(item: VinculoIn):
     try:
         prof = item.professor_email.strip().lower()
         aluno_nome_input = item.aluno_nome.strip().lower()
 
-        # Buscar aluno pelo nome normalizado
-        alunos = db.collection("alunos").stream()
-        aluno_doc = None
-        for doc in alunos:
-            dados = doc.to_dict()
-            nome_banco = dados.get("nome", "").strip().lower()
-            if nome_banco == aluno_nome_input:
-                aluno_doc = doc
-                break
+        # Buscar aluno pelo nome normalizado
+        aluno_doc = buscar_aluno_por_nome(aluno_nome_input)
+
+        if not aluno_doc:
+            raise HTTPException(status_code=404, detail="Aluno não encontrado")
+
+        if vinculo_existe(prof, aluno_nome_input, fresco=True):
+            raise HTTPException(status_code=409, detail="Vínculo já existe")
+
+        dados_aluno = aluno_doc.to_dict()
+
+        # Remove campos sensíveis que não devem ir para alunos_professor
+        for campo in ['senha']:
+            dados_aluno.pop(campo, None)
+
+        # Criação do documento com os dados do aluno + vínculo
+        db.collection('alunos_professor').add(dados_vinculo(prof, aluno_nome_input, dados_aluno))
+        cache_vinculos.invalidar(aluno_nome_input)
+
+        # Atualiza o campo vinculado no documento do aluno
+        db.collection("alunos").document(aluno_doc.id).update({
+            "vinculado": True
+        })
+        registrar_transicao_aluno(dados_aluno, {**dados_aluno, "vinculado": True})
+
+        return {"message": "Vínculo criado com sucesso"}
+
+    except HTTPException:
+        raise
+    except Exception as e:
+        print('Erro interno ao vincular aluno:', e)
+        return JSONResponse(
+            status_code=500,
+            content={
+                'detail': 'Erro interno ao criar vínculo. Verifique os dados e tente novamente.'
+            }
+        )
+
+# ============================
+# 🔹 VINCULAÇÃO EM LOTE
+# ============================
+# Ação de administrador, feita por páginas (cada pedido cabe no orçamento do
+# Firestore): primeiro conta-se a carga de cada professor percorrendo
+# 'alunos_professor' ("carga:<id>"), depois os alunos por vincular, por ordem de
+# ID ("alunos:<id>"). A carga fica em configuracoes/vinculacao_lote entre
+# páginas. Em cada página, cada par com a mesma disciplina recebe uma pontuação
+# (sobreposição de horário, província, município e carga) e a atribuição é
+# feita numa só passagem gulosa pelos pares ordenados, respeitando a capacidade
+# de cada professor (os professores vêm do repositório em memória). Os vínculos
+# são gravados em batches.
+VINCULOS_POR_PROFESSOR = int(os.environ.get("VINCULOS_POR_PROFESSOR", "10"))
+VINCULOS_POR_BATCH = 200  # 2 escritas por vínculo + estatísticas, abaixo do limite de 500
+
+PESO_HORARIO = 4.0
+PESO_PROVINCIA = 2.0
+PESO_MUNICIPIO = 1.0
+PESO_CARGA = 1.5
+
+
+def _chave_texto(valor) -> str:
+    return remover_acentos(str(valor or "")).strip().lower()
+
+
+def _popcount(bits: int) -> int:
+    return bin(bits).count("1")
+
+
+def pontuar_par(aluno: dict, professor: dict, capacidade: int) -> float:
+    """Pontuação de um par aluno/professor da mesma disciplina (maior é melhor)."""
+    pontos = 0.0
+
+    bits_aluno = aluno["horario_bits"]
+    livres = professor["livres"]
+    if bits_aluno and livres is not None:
+        pontos += PESO_HORARIO * _popcount(bits_aluno & livres) / _popcount(bits_aluno)
+    else:
+        # sem horário de um dos lados: neutro
+        pontos += PESO_HORARIO / 2
+
+    if aluno["provincia"] and aluno["provincia"] == professor["provincia"]:
+        pontos += PESO_PROVINCIA
+        if aluno["municipio"] and aluno["municipio"] == professor["municipio"]:
+            pontos += PESO_MUNICIPIO
+
+    pontos -= PESO_CARGA * professor["carga"] / max(capacidade, 1)
+    return pontos
+
+
+VINCULACAO_LOTE_DOC = ("configuracoes", "vinculacao_lote")
+
+
+def _estado_vinculacao_ref():
+    return db.collection(VINCULACAO_LOTE_DOC[0]).document(VINCULACAO_LOTE_DOC[1])
+
+
+def contar_carga_vinculos(carga: dict, apos: Optional[str], limite: int) -> tuple:
+    """Soma à carga uma página de vínculos; devolve (lidos, último ID)."""
+    vinculos_ref = db.collection("alunos_professor")
+    query = vinculos_ref.order_by(ID_DOCUMENTO)
+    if apos:
+        query = query.where(ID_DOCUMENTO, ">", vinculos_ref.document(apos))
+
+    lidos = 0
+    ultimo_id = None
+    for doc in query.select(["professor"]).limit(limite).stream():
+        prof = ((doc.to_dict() or {}).get("professor") or "").strip().lower()
+        if prof:
+            carga[prof] = carga.get(prof, 0) + 1
+        lidos += 1
+        ultimo_id = doc.id
+    return lidos, ultimo_id
+
+
+def carregar_alunos_por_vincular(apos: Optional[str], limite: int) -> tuple:
+    """Uma página de alunos com vinculado == False; devolve (alunos, lidos, último ID)."""
+    alunos_ref = db.collection("alunos")
+    query = alunos_ref.where("vinculado", "==", False).order_by(ID_DOCUMENTO)
+    if apos:
+        query = query.where(ID_DOCUMENTO, ">", alunos_ref.document(apos))
+
+    docs = list(query.limit(limite).stream())
+    ultimo_id = docs[-1].id if docs else None
+
+    candidatos = []
+    for doc in docs:
+        dados = doc.to_dict() or {}
+        nome = dados.get("nome_normalizado") or chave_nome_aluno(dados.get("nome"))
+        disciplina = _chave_texto(dados.get("disciplina"))
+        if nome and disciplina:
+            candidatos.append((doc, dados, nome, disciplina))
+
+    # 'vinculado' pode estar desatualizado: confirma nos vínculos (até 30 nomes por consulta)
+    nomes = sorted({nome for _, _, nome, _ in candidatos})
+    vinculados = set()
+    for inicio in range(0, len(nomes), 30):
+        consulta = db.collection("alunos_professor").where("aluno", "in", nomes[inicio:inicio + 30])
+        for doc in consulta.select(["aluno"]).stream():
+            vinculados.add(chave_nome_aluno((doc.to_dict() or {}).get("aluno")))
+
+    alunos = [
+        {
+            "id": doc.id,
+            "nome": nome,
+            "dados": dados,
+            "disciplina": disciplina,
+            "provincia": _chave_texto(dados.get("provincia")),
+            "municipio": _chave_texto(dados.get("municipio")),
+            "horario_bits": bits_do_documento(dados) or 0
+        }
+        for doc, dados, nome, disciplina in candidatos if nome not in vinculados
+    ]
+    return alunos, len(docs), ultimo_id
+
+
+def professores_com_vagas(carga: dict, capacidade: int) -> list:
+    professores = []
+    for doc in repositorio_professores.documentos():
+        dados = doc.to_dict() or {}
+        email = (dados.get("email") or "").strip().lower()
+        disciplina = _chave_texto(dados.get("area_formacao"))
+        if not email or not disciplina or carga.get(email, 0) >= capacidade:
+            continue
+        professores.append({
+            "email": email,
+            "disciplina": disciplina,
+            "provincia": _chave_texto(dados.get("provincia")),
+            "municipio": _chave_texto(dados.get("municipio")),
+            "carga": carga.get(email, 0),
+            "livres": indice_disponibilidade.livres(email)
+        })
+    return professores
+
+
+def calcular_vinculos(alunos: list, professores: list, capacidade: int) -> list:
+    """[(pontuação, aluno, professor)] escolhidos, no máximo um professor por aluno."""
+    por_disciplina = {}
+    for prof in professores:
+        por_disciplina.setdefault(prof["disciplina"], []).append(prof)
+
+    pares = []
+    for aluno in alunos:
+        for prof in por_disciplina.get(aluno["disciplina"], []):
+            pares.append((pontuar_par(aluno, prof, capacidade), aluno, prof))
+
+    pares.sort(key=lambda par: par[0], reverse=True)
+
+    vagas = {prof["email"]: capacidade - prof["carga"] for prof in professores}
+    atribuidos = set()
+    escolhidos = []
+    for pontos, aluno, prof in pares:
+        if aluno["id"] in atribuidos or vagas[prof["email"]] <= 0:
+            continue
+        atribuidos.add(aluno["id"])
+        vagas[prof["email"]] -= 1
+        escolhidos.append((pontos, aluno, prof))
+
+    return escolhidos
 
-        if not aluno_doc:
-            raise HTTPException(status_code=404, detail="Aluno não encontrado")
 
-        if vinculo_existe(prof, aluno_nome_input):
-            raise HTTPException(status_code=409, detail="Vínculo já existe")
+def gravar_vinculos(escolhidos: list) -> int:
+    gravados = 0
+    for inicio in range(0, len(escolhidos), VINCULOS_POR_BATCH):
+        lote = escolhidos[inicio:inicio + VINCULOS_POR_BATCH]
+        batch = db.batch()
+        for _, aluno, prof in lote:
+            dados_aluno = {k: v for k, v in aluno["dados"].items() if k != "senha"}
+            batch.set(db.collection("alunos_professor").document(), dados_vinculo(prof["email"], aluno["nome"], dados_aluno))
+            batch.update(db.collection("alunos").document(aluno["id"]), {"vinculado": True})
+        # todos os alunos do lote estavam com vinculado == False
+        ajustar_estatisticas(batch=batch, alunos_vinculados=len(lote))
+        batch.commit()
+        cache_vinculos.invalidar(*(aluno["nome"] for _, aluno, _ in lote))
+        gravados += len(lote)
+    return gravados
+
+
+def vincular_em_lote(apos: Optional[str], limite: int, capacidade: int, simular: bool) -> dict:
+    """Uma página da vinculação em lote; 'proximo' continua, None quando terminou."""
+    estado_ref = _estado_vinculacao_ref()
+    if apos:
+        fase, _, cursor = apos.partition(":")
+        doc = estado_ref.get()
+        if fase not in ("carga", "alunos") or not doc.exists:
+            raise ValueError("Cursor inválido: recomece sem 'apos'.")
+        carga = (doc.to_dict() or {}).get("carga") or {}
+    else:
+        fase, cursor, carga = "carga", "", {}
 
-        dados_aluno = aluno_doc.to_dict()
+    if fase == "carga":
+        lidos, ultimo_id = contar_carga_vinculos(carga, cursor, limite)
+        estado_ref.set({"carga": carga, "atualizado_em": datetime.now(timezone.utc)})
+        return {
+            "fase": "carga",
+            "vinculos_contados": lidos,
+            "proximo": f"carga:{ultimo_id}" if lidos == limite else "alunos:"
+        }
 
-        # Remove campos sensíveis que não devem ir para alunos_professor
-        for campo in ['senha']:
-            dados_aluno.pop(campo, None)
+    inicio = time.perf_counter()
+    alunos, lidos, ultimo_id = carregar_alunos_por_vincular(cursor, limite)
+    professores = professores_com_vagas(carga, capacidade)
+    escolhidos = calcular_vinculos(alunos, professores, capacidade)
+    duracao_calculo = time.perf_counter() - inicio
 
-        # Criação do documento com os dados do aluno + vínculo
-        db.collection('alunos_professor').add({
-            'professor': prof,
-            'aluno': aluno_nome_input,
-            'dados_aluno': {
-                'nome': dados_aluno.get('nome', ''),
-                'disciplina': dados_aluno.get('disciplina', ''),
-                'progresso_ingles': dados_aluno.get('progresso_ingles', 0),
-                'provincia': dados_aluno.get('provincia', '').strip(),
-                'municipio': dados_aluno.get('municipio', '').strip(),
-                'bairro': dados_aluno.get('bairro', '').strip(),
-                'telefone': dados_aluno.get('telefone', '').strip(),
-            },
-            'vinculado_em': datetime.now(timezone.utc).isoformat(),
-            'online': True,
-
-            # Ordem solicitada
-            'notificacao': False,
-            'notificacao_todos': True,
-
-            'aulas_dadas': 0,
-            'total_aulas': 12,
-            'aulas': [],
-            'horario': {},
-            'datas_aulas': []
-        })
+    gravados = 0 if simular else gravar_vinculos(escolhidos)
 
-        # Atualiza o campo vinculado no documento do aluno
-        db.collection("alunos").document(aluno_doc.id).update({
-            "vinculado": True
-        })
+    # a carga segue para a página seguinte (também a simular, para a proposta ser coerente)
+    for _, _, prof in escolhidos:
+        carga[prof["email"]] = carga.get(prof["email"], 0) + 1
+    estado_ref.set({"carga": carga, "atualizado_em": datetime.now(timezone.utc)})
 
-        return {"message": "Vínculo criado com sucesso"}
+    return {
+        "fase": "alunos",
+        "alunos_por_vincular": len(alunos),
+        "professores_com_vagas": len(professores),
+        "vinculos": [
+            {"aluno": aluno["nome"], "professor": prof["email"], "pontuacao": round(pontos, 3)}
+            for pontos, aluno, prof in escolhidos
+        ],
+        "sem_professor": len(alunos) - len(escolhidos),
+        "gravados": gravados,
+        "simulado": simular,
+        "segundos_calculo": round(duracao_calculo, 3),
+        "proximo": f"alunos:{ultimo_id}" if lidos == limite else None
+    }
 
-    except HTTPException:
-        raise
+
+@app.post("/vincular-em-lote")
+def vincular_em_lote_post(
+    request: Request,
+    dados: dict = Depends(corpo_json),
+    apos: Optional[str] = None,
+    limite: int = Query(200, ge=1, le=400)
+):
+    """
+    Corpo opcional: {"simular": true} devolve a proposta sem gravar; {"capacidade": n}.
+    Chamar sem 'apos' e repetir com o 'proximo' devolvido até vir None.
+    """
+    if not admin_autenticado(request):
+        return acesso_negado_admin()
+    try:
+        simular = bool(dados.get("simular", False))
+        capacidade = int(dados.get("capacidade") or VINCULOS_POR_PROFESSOR)
+        return vincular_em_lote(apos, limite, capacidade, simular)
+
+    except ValueError as e:
+        return JSONResponse(status_code=400, content={"detail": str(e)})
     except Exception as e:
-        print('Erro interno ao vincular aluno:', e)
-        return JSONResponse(
-            status_code=500,
-            content={
-                'detail': 'Erro interno ao criar vínculo. Verifique os dados e tente novamente.'
-            }
-        )
+        print("Erro na vinculação em lote:", e)
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
 
 @app.get('/atualizar-notificacao-todos')
-async def atualizar_notificacao_todos():
+def atualizar_notificacao_todos():
     """
     Define o campo 'notificacao_todos' como True
     em todos os documentos da coleção 'alunos_professor',
@@ -613,12 +2660,24 @@ async def atualizar_notificacao_todos():
     try:
         docs = db.collection('alunos_professor').stream()
         total_atualizados = 0
+        avisados = set()
 
+        # 2 escritas por vínculo (vínculo + aviso aos streams SSE), abaixo das 500 por batch
+        batch = db.batch()
         for doc in docs:
-            db.collection('alunos_professor').document(doc.id).update({
-                'notificacao_todos': True
-            })
+            batch.update(doc.reference, {'notificacao_todos': True})
+            # como cache_vinculos.primeiro: o estado do aluno é o do primeiro vínculo pela ordem dos IDs
+            aluno = chave_nome_aluno((doc.to_dict() or {}).get('aluno'))
+            if aluno and aluno not in avisados:
+                avisados.add(aluno)
+                publicar_notificacao(batch, aluno, estado_notificacao(doc.to_dict(), notificacao_todos=True))
             total_atualizados += 1
+            if total_atualizados % 200 == 0:
+                batch.commit()
+                batch = db.batch()
+        batch.commit()
+
+        cache_vinculos.limpar()
 
         return {
             "message": "Atualização concluída com sucesso.",
@@ -633,14 +2692,12 @@ async def atualizar_notificacao_todos():
         )
         
 @app.get("/perfil_prof", response_class=HTMLResponse)
-async def get_perfil_prof(request: Request, email: str):
+def get_perfil_prof(request: Request, email: str):
     """
     Exibe o perfil do professor com base no email fornecido.
     """
 
-    professores_ref = db.collection("professores_online")
-    query = professores_ref.where("email", "==", email).limit(1).stream()
-    prof_doc = next(query, None)
+    prof_doc = repositorio_professores.por_email(email)
 
     if not prof_doc:
         return render_template(
@@ -674,7 +2731,7 @@ async def get_perfil_prof(request: Request, email: str):
 
 
 @app.post("/perfil_prof", response_class=HTMLResponse)
-async def post_perfil_prof(
+def post_perfil_prof(
     request: Request,
     email: str = Form(...),
     descricao: str = Form(...),
@@ -684,9 +2741,7 @@ async def post_perfil_prof(
     Atualiza descrição e foto do professor.
     """
 
-    professores_ref = db.collection("professores_online")
-    query = professores_ref.where("email", "==", email).limit(1).stream()
-    prof_doc = next(query, None)
+    prof_doc = repositorio_professores.por_email(email)
 
     if not prof_doc:
         return render_template(
@@ -701,6 +2756,7 @@ async def post_perfil_prof(
         "descricao": descricao,
         "foto_perfil": foto_perfil
     })
+    repositorio_professores.invalidar(email)
 
     return RedirectResponse(
         url=f"/perfil_prof?email={email}",
@@ -720,10 +2776,8 @@ async def professores_online_get(request: Request, success: int = 0):
 
 
 @app.get('/alunos-disponiveis/{prof_email}')
-async def alunos_disponiveis(prof_email: str):
-    prof_docs = db.collection('professores_online') \
-                  .where('email', '==', prof_email.strip()).limit(1).stream()
-    prof = next(prof_docs, None)
+def alunos_disponiveis(prof_email: str):
+    prof = repositorio_professores.por_email(prof_email)
     if not prof:
         raise HTTPException(status_code=404, detail='Professor não encontrado')
 
@@ -753,7 +2807,7 @@ async def alunos_disponiveis(prof_email: str):
     return disponiveis
 
 @app.get('/meus-alunos/{prof_email}')
-async def meus_alunos(prof_email: str):
+def meus_alunos(prof_email: str):
     try:
         docs = db.collection('alunos_professor') \
                  .where('professor', '==', prof_email.strip()).stream()
@@ -794,10 +2848,11 @@ class MensagemInfo(BaseModel):
 
 # 🔹 Atualiza coleção e garante campos obrigatórios
 @app.get("/meus-alunos-status/{prof_email}")
-async def meus_alunos_status(prof_email: str):
+def meus_alunos_status(prof_email: str):
     try:
-        docs = db.collection('alunos_professor') \
-                 .where('professor', '==', prof_email.strip().lower()).stream()
+        docs = list(db.collection('alunos_professor')
+                    .where('professor', '==', prof_email.strip().lower()).stream())
+        presenca.registar_alunos((doc.to_dict() or {}).get('aluno') for doc in docs)
 
         alunos = []
         for doc in docs:
@@ -807,13 +2862,13 @@ async def meus_alunos_status(prof_email: str):
             # Garante campos obrigatórios
             if 'dados_aluno' not in d:
                 atualizacoes['dados_aluno'] = {}
-            if 'mensagens' not in d:  # 🔹 agora padronizado
-                atualizacoes['mensagens'] = []
 
             if atualizacoes:
                 db.collection('alunos_professor').document(doc.id).update(atualizacoes)
+                cache_vinculos.invalidar(d.get('aluno'))
 
             dados = d.get('dados_aluno', {})
+            estado = presenca.consultar("aluno", d.get('aluno', ''))
             alunos.append({
                 'nome': dados.get('nome', d.get('aluno', '')),
                 'disciplina': dados.get('disciplina', ''),
@@ -822,7 +2877,7 @@ async def meus_alunos_status(prof_email: str):
                 'municipio': dados.get('municipio', ''),
                 'bairro': dados.get('bairro', ''),
                 'nivel_ingles': dados.get('nivel_ingles', ''),
-                'online': d.get('online', False)
+                'online': estado["online"] if estado else d.get('online', False)
             })
 
         return alunos
@@ -832,11 +2887,285 @@ async def meus_alunos_status(prof_email: str):
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
 
+# ============================
+# 🔹 CHAT EM TEMPO REAL (WEBSOCKET)
+# ============================
+class SalaChat:
+    """
+    Ligações WebSocket abertas por vínculo (professor, aluno).
+    O Firestore continua a ser o armazenamento e o canal entre workers:
+    enquanto houver ligações de um vínculo, este worker mantém um on_snapshot
+    sobre alunos_professor/{id}/mensagens e entrega cada mensagem nova às
+    suas ligações, venha ela de que worker vier.
+    """
+
+    def __init__(self):
+        self._ligacoes = {}  # (professor, aluno) -> set de WebSockets
+        self._watches = {}   # (professor, aluno) -> observação das mensagens
+        self._lock = threading.Lock()
+        self._loop = None
+
+    def entrar(self, professor: str, aluno: str, ws: WebSocket, vinculo_ref, loop):
+        """Abre a observação na primeira ligação do vínculo (bloqueia: chamar via em_thread)."""
+        self._loop = loop
+        chave = (professor, aluno)
+        with self._lock:
+            self._ligacoes.setdefault(chave, set()).add(ws)
+            observar = chave not in self._watches
+            if observar:
+                self._watches[chave] = None  # reservado: só uma observação por vínculo
+
+        if not observar:
+            return
+
+        # só o que for gravado a partir de agora; o histórico vai na ligação
+        inicio = datetime.utcnow().isoformat(timespec="microseconds")
+        query = vinculo_ref.collection("mensagens").where("timestamp", ">", inicio).order_by("timestamp")
+        try:
+            watch = query.on_snapshot(
+                lambda docs, mudancas, lido_em: self._ao_mudar(chave, mudancas)
+            )
+        except Exception:
+            self.sair(professor, aluno, ws)
+            raise
+        with self._lock:
+            if chave in self._watches:
+                self._watches[chave] = watch
+                watch = None
+        if watch is not None:
+            # a última ligação fechou enquanto a observação abria
+            watch.unsubscribe()
+
+    def sair(self, professor: str, aluno: str, ws: WebSocket):
+        chave = (professor, aluno)
+        with self._lock:
+            ligacoes = self._ligacoes.get(chave)
+            if ligacoes is None:
+                return
+            ligacoes.discard(ws)
+            if ligacoes:
+                return
+            del self._ligacoes[chave]
+            watch = self._watches.pop(chave, None)
+        if watch is not None:
+            watch.unsubscribe()
+
+    def parar(self):
+        with self._lock:
+            watches = [w for w in self._watches.values() if w is not None]
+            self._watches.clear()
+        for watch in watches:
+            watch.unsubscribe()
+
+    def _ao_mudar(self, chave: tuple, mudancas):
+        """Callback do on_snapshot (thread do cliente Firestore)."""
+        novas = [m.document.to_dict() for m in mudancas if m.type.name == "ADDED"]
+        if not novas:
+            return
+
+        with self._lock:
+            ligacoes = list(self._ligacoes.get(chave, ()))
+
+        if not ligacoes or self._loop is None:
+            return
+
+        professor, aluno = chave
+        for mensagem in novas:
+            evento = {"tipo": "mensagem", "mensagem": mensagem}
+            for ws in ligacoes:
+                asyncio.run_coroutine_threadsafe(
+                    self._entregar(professor, aluno, ws, evento), self._loop
+                )
+
+    async def _entregar(self, professor: str, aluno: str, ws: WebSocket, evento: dict):
+        try:
+            await ws.send_json(evento)
+        except Exception:
+            # ligação morta: o cliente volta a ligar e recebe o histórico
+            await em_thread(self.sair, professor, aluno, ws)
+
+
+sala_chat = SalaChat()
+
+
+@app.on_event("shutdown")
+async def parar_sala_chat():
+    sala_chat.parar()
+
+
+MENSAGENS_POR_PAGINA = 50
+MENSAGENS_POR_PAGINA_MAX = 200
+
+
+def _timestamp_mensagem(timestamp) -> str:
+    if not timestamp:
+        timestamp = datetime.utcnow()
+    elif hasattr(timestamp, "to_datetime"):
+        timestamp = timestamp.to_datetime()
+
+    return timestamp.isoformat() if isinstance(timestamp, datetime) else str(timestamp)
+
+
+def formatar_mensagens(mensagens: list) -> list:
+    mensagens_formatadas = [
+        {
+            "mensagem": m.get("mensagem"),
+            "remetente": m.get("remetente"),
+            "timestamp": _timestamp_mensagem(m.get("timestamp"))
+        }
+        for m in mensagens
+    ]
+
+    # Ordena as mensagens pelo timestamp
+    mensagens_formatadas.sort(key=lambda x: x["timestamp"])
+    return mensagens_formatadas
+
+
+def _buscar_vinculo_chat(professor: str, aluno: str):
+    return cache_vinculos.do_par(professor, aluno)
+
+
+def _id_mensagem(msg: dict) -> str:
+    """ID determinístico: migrar o mesmo array duas vezes não duplica mensagens."""
+    chave = f"{msg['timestamp']}|{msg['remetente']}|{msg['mensagem']}"
+    return msg["timestamp"].replace(":", "").replace(".", "") + "_" + \
+        hashlib.sha1(chave.encode("utf-8")).hexdigest()[:12]
+
+
+def migrar_mensagens_vinculo(vinculo_doc) -> int:
+    """
+    Passa o array 'mensagens' do vínculo para a subcoleção
+    alunos_professor/{id}/mensagens e apaga o array.
+    Pode ser repetido sem efeitos: os IDs são determinísticos e o array só
+    é apagado depois de todas as mensagens estarem escritas.
+    """
+    dados = vinculo_doc.to_dict() or {}
+    if "mensagens" not in dados:
+        return 0
+
+    mensagens_ref = vinculo_doc.reference.collection("mensagens")
+    mensagens = formatar_mensagens(dados.get("mensagens") or [])
+
+    batch = db.batch()
+    pendentes = 0
+    for msg in mensagens:
+        batch.set(mensagens_ref.document(_id_mensagem(msg)), msg)
+        pendentes += 1
+
+        # limite de 500 operações por batch
+        if pendentes >= 400:
+            batch.commit()
+            batch = db.batch()
+            pendentes = 0
+
+    batch.update(vinculo_doc.reference, {
+        "mensagens": firestore.DELETE_FIELD,
+        "mensagens_migradas": True
+    })
+    batch.commit()
+    cache_vinculos.invalidar(dados.get("aluno"))
+
+    return len(mensagens)
+
+
+def gravar_mensagem(aluno: str, professor: str, mensagem: str, remetente: str) -> Optional[dict]:
+    """Grava a mensagem na subcoleção do vínculo e devolve-a; None se o vínculo não existir."""
+    vinculo_doc = _buscar_vinculo_chat(professor, aluno)
+    if vinculo_doc is None:
+        return None
+
+    nova_mensagem = {
+        "remetente": remetente,
+        "mensagem": mensagem,
+        "timestamp": datetime.utcnow().isoformat(timespec="microseconds")
+    }
+
+    vinculo_doc.reference.collection("mensagens").add(nova_mensagem)
+    return nova_mensagem
+
+
+def ler_mensagens(
+    professor: str,
+    aluno: str,
+    since: Optional[str] = None,
+    before: Optional[str] = None,
+    limite: int = MENSAGENS_POR_PAGINA
+) -> Optional[list]:
+    """
+    Uma página de mensagens por ordem cronológica.
+    - since: só mensagens posteriores (sincronização incremental)
+    - before: página anterior a este timestamp (histórico antigo)
+    - sem cursores: as últimas 'limite' mensagens
+    """
+    vinculo_doc = _buscar_vinculo_chat(professor, aluno)
+    if vinculo_doc is None:
+        return None
+
+    # vínculos ainda com o array antigo são migrados no primeiro acesso; o
+    # documento vem do cache e pode ser anterior à migração feita noutro worker,
+    # por isso migra-se a partir de uma leitura fresca
+    dados = vinculo_doc.to_dict() or {}
+    if "mensagens" in dados and not dados.get("mensagens_migradas"):
+        migrar_mensagens_vinculo(vinculo_doc.reference.get())
+
+    limite = max(1, min(int(limite or MENSAGENS_POR_PAGINA), MENSAGENS_POR_PAGINA_MAX))
+    query = vinculo_doc.reference.collection("mensagens")
+
+    if since:
+        query = query.where("timestamp", ">", since) \
+                     .order_by("timestamp").limit(limite)
+        return [doc.to_dict() for doc in query.stream()]
+
+    if before:
+        query = query.where("timestamp", "<", before)
+
+    query = query.order_by("timestamp", direction=firestore.Query.DESCENDING).limit(limite)
+    mensagens = [doc.to_dict() for doc in query.stream()]
+    mensagens.reverse()
+    return mensagens
+
+
+def migrar_mensagens(apos: Optional[str] = None, limite: int = 200) -> dict:
+    """
+    Migração retomável: percorre os vínculos por ID a partir de 'apos'.
+    Devolve 'proximo' para continuar; None quando chegou ao fim.
+    """
+    vinculos_ref = db.collection("alunos_professor")
+    query = vinculos_ref.order_by(ID_DOCUMENTO)
+    if apos:
+        query = query.where(ID_DOCUMENTO, ">", vinculos_ref.document(apos))
+
+    vinculos = 0
+    mensagens = 0
+    ultimo_id = None
+    for doc in query.limit(limite).stream():
+        mensagens += migrar_mensagens_vinculo(doc)
+        vinculos += 1
+        ultimo_id = doc.id
+
+    return {
+        "vinculos_processados": vinculos,
+        "mensagens_migradas": mensagens,
+        "proximo": ultimo_id if vinculos == limite else None
+    }
+
+
+@app.post("/migrar-mensagens")
+def migrar_mensagens_post(request: Request, apos: Optional[str] = None, limite: int = Query(200, ge=1, le=500)):
+    if not admin_autenticado(request):
+        return acesso_negado_admin()
+    try:
+        resultado = migrar_mensagens(apos, limite)
+        return {"status": "ok", **resultado}
+    except Exception as e:
+        print("❌ Erro ao migrar mensagens:", e)
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+
 # 🔹 Enviar mensagem (aluno → professor ou professor → aluno)
 @app.post("/enviar-mensagem")
-async def enviar_mensagem(request: Request):
+def enviar_mensagem(request: Request, data: dict = Depends(corpo_json)):
     try:
-        data = await request.json()
         aluno = data.get("aluno", "").strip().lower()
         professor = data.get("professor", "").strip().lower()
         mensagem = data.get("mensagem", "").strip()
@@ -847,31 +3176,11 @@ async def enviar_mensagem(request: Request):
         if not aluno or not professor or not mensagem:
             return JSONResponse(status_code=400, content={"detail": "Dados incompletos"})
 
-        # Buscar vínculo entre aluno e professor
-        query = db.collection("alunos_professor") \
-                  .where("aluno", "==", aluno) \
-                  .where("professor", "==", professor) \
-                  .limit(1).stream()
-
-        docs = list(query)
-        if not docs:
+        nova_mensagem = gravar_mensagem(aluno, professor, mensagem, remetente)
+        if nova_mensagem is None:
             print("⚠️ Nenhum vínculo encontrado!")
             return JSONResponse(status_code=404, content={"detail": "Vínculo não encontrado"})
 
-        vinculo_doc = docs[0]
-        doc_ref = db.collection("alunos_professor").document(vinculo_doc.id)
-
-        nova_mensagem = {
-            "remetente": remetente,
-            "mensagem": mensagem,
-            "timestamp": datetime.utcnow().isoformat()
-        }
-
-        # Atualiza o array de mensagens com segurança
-        doc_ref.update({
-            "mensagens": firestore.ArrayUnion([nova_mensagem])
-        })
-
         print("✅ Mensagem enviada com sucesso:", nova_mensagem)
         return {"status": "sucesso", "mensagem": nova_mensagem}
 
@@ -882,78 +3191,101 @@ async def enviar_mensagem(request: Request):
 
 # 🔹 Buscar mensagens trocadas entre professor e aluno
 @app.get("/buscar-mensagens/{professor}/{aluno}")
-async def buscar_mensagens(professor: str, aluno: str):
+def buscar_mensagens(
+    professor: str,
+    aluno: str,
+    since: Optional[str] = None,
+    before: Optional[str] = None,
+    limite: int = Query(MENSAGENS_POR_PAGINA, ge=1, le=MENSAGENS_POR_PAGINA_MAX)
+):
     try:
         aluno_normalizado = aluno.strip().lower()
         professor_normalizado = professor.strip().lower()
 
         print(f"🗂️ Buscando mensagens entre '{professor_normalizado}' e '{aluno_normalizado}'")
 
-        query = db.collection("alunos_professor") \
-                  .where("aluno", "==", aluno_normalizado) \
-                  .where("professor", "==", professor_normalizado) \
-                  .limit(1).stream()
-
-        docs = list(query)
-        if not docs:
+        mensagens_formatadas = ler_mensagens(
+            professor_normalizado, aluno_normalizado, since=since, before=before, limite=limite
+        )
+        if mensagens_formatadas is None:
             print("⚠️ Nenhum vínculo encontrado para carregar mensagens.")
             return []
 
-        vinculo_doc = docs[0]
-        data = vinculo_doc.to_dict()
-        mensagens = data.get("mensagens", [])
+        print(f"💬 {len(mensagens_formatadas)} mensagens encontradas.")
+        return mensagens_formatadas
 
-        mensagens_formatadas = []
-        for m in mensagens:
-            msg = {
-                "mensagem": m.get("mensagem"),
-                "remetente": m.get("remetente"),
-            }
+    except Exception as e:
+        print("❌ Erro ao buscar mensagens:", e)
+        return JSONResponse(status_code=500, content={"detail": str(e)})
 
-            timestamp = m.get("timestamp")
-            if not timestamp:
-                timestamp = datetime.utcnow()
-            elif hasattr(timestamp, "to_datetime"):
-                timestamp = timestamp.to_datetime()
 
-            msg["timestamp"] = (
-                timestamp.isoformat() if isinstance(timestamp, datetime) else str(timestamp)
-            )
+@app.websocket("/ws/chat/{professor}/{aluno}")
+async def chat_websocket(ws: WebSocket, professor: str, aluno: str, since: Optional[str] = None):
+    """
+    Chat do vínculo: ao ligar envia o histórico uma vez (ou só o que passou
+    desde 'since', ao religar); depois cada mensagem recebida é gravada no
+    Firestore e o on_snapshot do vínculo entrega-a às ligações de todos os workers.
+    Eventos: {"tipo": "historico", "mensagens": [...], "since": ...}, {"tipo": "mensagem", "mensagem": {...}}
+    """
+    professor = professor.strip().lower()
+    aluno = aluno.strip().lower()
 
-            mensagens_formatadas.append(msg)
+    await ws.accept()
 
-        # Ordena as mensagens pelo timestamp
-        mensagens_formatadas.sort(key=lambda x: x["timestamp"])
+    vinculo_doc = await em_thread(_buscar_vinculo_chat, professor, aluno)
+    if vinculo_doc is None:
+        await ws.send_json({"tipo": "erro", "detail": "Vínculo não encontrado"})
+        await ws.close(code=4404)
+        return
 
-        print(f"💬 {len(mensagens_formatadas)} mensagens encontradas.")
-        return mensagens_formatadas
+    # Entra antes de ler o histórico para não perder mensagens pelo meio
+    await em_thread(sala_chat.entrar, professor, aluno, ws, vinculo_doc.reference, asyncio.get_running_loop())
+    try:
+        mensagens = await em_thread(ler_mensagens, professor, aluno, since=since)
+        if mensagens is None:
+            await ws.send_json({"tipo": "erro", "detail": "Vínculo não encontrado"})
+            await ws.close(code=4404)
+            return
+
+        await ws.send_json({"tipo": "historico", "mensagens": mensagens, "since": since})
+
+        while True:
+            data = await ws.receive_json()
+            mensagem = str(data.get("mensagem", "")).strip()
+            remetente = str(data.get("remetente", "")).strip().lower()
+            if not mensagem:
+                continue
 
+            nova_mensagem = await em_thread(gravar_mensagem, aluno, professor, mensagem, remetente)
+            if nova_mensagem is None:
+                await ws.send_json({"tipo": "erro", "detail": "Vínculo não encontrado"})
+
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
-        print("❌ Erro ao buscar mensagens:", e)
-        return JSONResponse(status_code=500, content={"detail": str(e)})
+        print("❌ Erro no chat WebSocket:", e)
+    finally:
+        await em_thread(sala_chat.sair, professor, aluno, ws)
 
 
 # 🔹 Status completo com last_seen
 @app.get("/alunos-status-completo/{prof_email}")
-async def alunos_status_completo(prof_email: str):
+def alunos_status_completo(prof_email: str):
     try:
         docs = db.collection('alunos_professor') \
                  .where('professor', '==', prof_email.strip().lower()).stream()
 
-        alunos = []
-        for doc in docs:
-            data = doc.to_dict()
-            nome = data.get("aluno")
-
-            aluno_query = db.collection("alunos").where("nome", "==", nome).limit(1).stream()
-            aluno_doc = next(aluno_query, None)
+        nomes = [doc.to_dict().get("aluno") for doc in docs]
+        presenca.registar_alunos(nomes)
 
-            if aluno_doc and aluno_doc.exists:
-                aluno_data = aluno_doc.to_dict()
+        alunos = []
+        for nome in nomes:
+            estado = presenca.consultar("aluno", nome)
+            if estado is not None:
                 alunos.append({
                     "nome": nome,
-                    "online": aluno_data.get("online", False),
-                    "last_seen": aluno_data.get("last_seen", "Desconhecido")
+                    "online": estado["online"],
+                    "last_seen": estado["last_seen"] or "Desconhecido"
                 })
             else:
                 alunos.append({
@@ -969,16 +3301,12 @@ async def alunos_status_completo(prof_email: str):
 
 
 @app.get("/ver-professor/{aluno_nome}")
-async def ver_professor(aluno_nome: str):
+def ver_professor(aluno_nome: str):
     try:
         aluno_normalizado = aluno_nome.strip().lower().replace(" ", "_")
 
         # Procurar vínculo do aluno
-        docs = db.collection("alunos_professor") \
-                 .where("aluno", "==", aluno_normalizado) \
-                 .limit(1).stream()
-
-        doc = next(docs, None)
+        doc = cache_vinculos.primeiro(aluno_normalizado)
         if not doc:
             raise HTTPException(status_code=404, detail="Aluno não possui professor vinculado")
 
@@ -1000,26 +3328,22 @@ async def ver_professor(aluno_nome: str):
         )
         
 @app.get("/alunos-status-completo/{prof_email}")
-async def alunos_status_completo(prof_email: str):
+def alunos_status_completo(prof_email: str):
     try:
         docs = db.collection('alunos_professor') \
                  .where('professor', '==', prof_email.strip()).stream()
 
-        alunos = []
-        for doc in docs:
-            data = doc.to_dict()
-            nome = data.get("aluno")
-
-            # Buscar o documento na coleção "alunos"
-            aluno_query = db.collection("alunos").where("nome", "==", nome).limit(1).stream()
-            aluno_doc = next(aluno_query, None)
+        nomes = [doc.to_dict().get("aluno") for doc in docs]
+        presenca.registar_alunos(nomes)
 
-            if aluno_doc and aluno_doc.exists:
-                aluno_data = aluno_doc.to_dict()
+        alunos = []
+        for nome in nomes:
+            estado = presenca.consultar("aluno", nome)
+            if estado is not None:
                 alunos.append({
                     "nome": nome,
-                    "online": aluno_data.get("online", False),
-                    "last_seen": aluno_data.get("last_seen", "Desconhecido")
+                    "online": estado["online"],
+                    "last_seen": estado["last_seen"] or "Desconhecido"
                 })
             else:
                 alunos.append({
@@ -1035,18 +3359,13 @@ async def alunos_status_completo(prof_email: str):
 
 
 @app.put("/atualizar-status/{aluno_nome}/{status}")
-async def atualizar_status_online(aluno_nome: str, status: bool):
+def atualizar_status_online(aluno_nome: str, status: bool):
     try:
-        query = db.collection("alunos") \
-                  .where("nome", "==", aluno_nome.strip()).stream()
-
-        atualizado = False
-        for doc in query:
-            doc.reference.update({
-                "online": status,
-                "last_seen": datetime.now(timezone.utc).isoformat()
-            })
-            atualizado = True
+        chave = chave_nome_aluno(aluno_nome)
+        if status:
+            atualizado = presenca.batimento("aluno", chave)
+        else:
+            atualizado = presenca.sair("aluno", chave)
 
         if not atualizado:
             raise HTTPException(status_code=404, detail="Aluno não encontrado na coleção 'alunos'")
@@ -1057,12 +3376,9 @@ async def atualizar_status_online(aluno_nome: str, status: bool):
         return JSONResponse(status_code=500, content={"detail": "Erro ao atualizar status", "erro": str(e)})
 
 @app.get("/buscar-professor/{nome_aluno}")
-async def buscar_professor(nome_aluno: str):
+def buscar_professor(nome_aluno: str):
     try:
-        query = db.collection("alunos_professor") \
-                  .where("aluno", "==", nome_aluno.strip()) \
-                  .limit(1).stream()
-        doc = next(query, None)
+        doc = cache_vinculos.primeiro(nome_aluno.strip())
 
         if not doc:
             return JSONResponse(status_code=404, content={"professor": None, "disciplina": None})
@@ -1073,10 +3389,7 @@ async def buscar_professor(nome_aluno: str):
         if not professor_email:
             return {"professor": "Desconhecido", "disciplina": "Desconhecida"}
 
-        prof_query = db.collection("professores_online") \
-                       .where("email", "==", professor_email.strip()) \
-                       .limit(1).stream()
-        prof_doc = next(prof_query, None)
+        prof_doc = repositorio_professores.por_email(professor_email)
 
         if not prof_doc:
             return {"professor": "Desconhecido", "disciplina": "Desconhecida"}
@@ -1096,7 +3409,7 @@ async def criar_conta(request: Request):
     return templates.TemplateResponse("criar-conta.html", {"request": request})
 
 @app.post("/criar-conta")
-async def criar_conta_post(
+def criar_conta_post(
     nome: str = Form(...),
     email: str = Form(...),
     senha: str = Form(...)
@@ -1129,7 +3442,7 @@ async def mostrar_professores(request: Request):
     return templates.TemplateResponse("info-p.html", {"request": request, "professores": professores})
 
 @app.post("/excluir-professor/{bi}")
-async def excluir_professor(bi: str):
+def excluir_professor(bi: str):
     profs = carregar_professores_local()
     profs = [p for p in profs if p.get("bi") != bi]
     salvar_professores_local(profs)
@@ -1150,7 +3463,7 @@ async def dados_professor(request: Request):
     return templates.TemplateResponse("dados-professor.html", {"request": request})
 
 @app.post("/api/professores", response_class=JSONResponse)
-async def receber_professor_api(professor: dict = Body(...)):
+def receber_professor_api(professor: dict = Body(...)):
     profs = carregar_professores_local()
     profs.append(professor)
     salvar_professores_local(profs)
@@ -1163,13 +3476,13 @@ async def listar_professores():
     return JSONResponse(content=carregar_professores_local())
 
 @app.get("/api/firebase-professores")
-async def listar_professores_firebase():
+def listar_professores_firebase():
     return JSONResponse(content=carregar_professores_firebase())
 
 from firebase_admin import firestore
 
 @app.post("/registrar-professor", response_class=HTMLResponse)
-async def registrar_professor(
+def registrar_professor(
     request: Request,
     nome: str = Form(...), idade: str = Form(...), nome_pai: str = Form(...),
     nome_mae: str = Form(...), morada_atual: str = Form(...), ponto_referencia: str = Form(...),
@@ -1200,6 +3513,8 @@ async def registrar_professor(
         "telefone": telefone,
         "email": email,
         "localizacao": f"Latitude: {latitude}, Longitude: {longitude}",
+        "latitude": coordenada(latitude, 90),
+        "longitude": coordenada(longitude, 180),
         "doc_foto": "/" + foto_path,
         "doc_pdf": "/" + pdf_path
     }
@@ -1214,14 +3529,258 @@ async def registrar_professor(
     salvar_professor_firebase(novo)
 
     # ✅ Também salvar na nova coleção "professores_online2"
-    db = firestore.client()
     db.collection("professores_online2").document(email).set(novo)
+    indice_geografico.atualizar(email, novo)
+    repositorio_professores.invalidar(email)
 
     return RedirectResponse(url="/pro-info.html", status_code=303)
 
 
+# ============================
+# 🔹 ÍNDICE GEOGRÁFICO DE PROFESSORES
+# ============================
+# As coordenadas do registo ficam como números ('latitude'/'longitude') em
+# 'professores_online2'. Em memória os professores ficam numa grelha de células
+# de GEO_CELULA_GRAUS graus (~5,5 km); uma pesquisa por raio só visita as células
+# da caixa que contém o círculo e calcula a distância real (haversine) a esses
+# professores. Os centróides de bairro/município saem da média das coordenadas
+# dos professores com esse bairro/município e servem para localizar um aluno.
+GEO_CELULA_GRAUS = 0.05
+GEO_RAIO_TERRA_KM = 6371.0
+GEO_KM_POR_GRAU = 111.32
+
+
+def coordenada(valor, limite: float) -> Optional[float]:
+    try:
+        numero = float(str(valor).strip().replace(",", "."))
+    except (TypeError, ValueError):
+        return None
+    if math.isnan(numero) or abs(numero) > limite:
+        return None
+    return numero
+
+
+def coordenadas_do_documento(dados: dict):
+    lat = coordenada(dados.get("latitude"), 90)
+    lon = coordenada(dados.get("longitude"), 180)
+    if lat is None or lon is None:
+        # registos antigos: "Latitude: -8.8, Longitude: 13.2"
+        numeros = re.findall(r"-?\d+(?:[.,]\d+)?", str(dados.get("localizacao") or ""))
+        if len(numeros) == 2:
+            lat, lon = coordenada(numeros[0], 90), coordenada(numeros[1], 180)
+    if lat is None or lon is None:
+        return None
+    return lat, lon
+
+
+def distancia_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dp, dl = p2 - p1, math.radians(lon2 - lon1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * GEO_RAIO_TERRA_KM * math.asin(math.sqrt(a))
+
+
+def _celula(lat: float, lon: float):
+    return int(math.floor(lat / GEO_CELULA_GRAUS)), int(math.floor(lon / GEO_CELULA_GRAUS))
+
+
+def disciplinas_do_professor(dados: dict) -> set:
+    disciplinas = {_chave_texto(d) for d in dados.get("disciplinas") or [] if d}
+    for extra in (dados.get("area_formacao"), dados.get("outras_disciplinas")):
+        for d in str(extra or "").split(","):
+            if d.strip():
+                disciplinas.add(_chave_texto(d))
+    return disciplinas
+
+
+class IndiceGeografico:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._professores = {}
+        self._celulas = {}
+        self.carregado = False
+        self._watch = None
+
+    @staticmethod
+    def _entrada(dados: dict) -> Optional[dict]:
+        email = (dados.get("email") or "").strip().lower()
+        posicao = coordenadas_do_documento(dados)
+        if not email or posicao is None:
+            return None
+        return {
+            "email": email,
+            "nome": dados.get("nome_completo") or dados.get("nome") or "",
+            "lat": posicao[0],
+            "lon": posicao[1],
+            "disciplinas": disciplinas_do_professor(dados),
+            "municipio": _chave_texto(dados.get("municipio")),
+            "bairro": _chave_texto(dados.get("bairro"))
+        }
+
+    def _remover(self, email: str):
+        antigo = self._professores.pop(email, None)
+        if antigo:
+            celula = self._celulas.get(_celula(antigo["lat"], antigo["lon"]))
+            if celula:
+                celula.discard(email)
+
+    def _inserir(self, entrada: dict):
+        self._remover(entrada["email"])
+        self._professores[entrada["email"]] = entrada
+        self._celulas.setdefault(_celula(entrada["lat"], entrada["lon"]), set()).add(entrada["email"])
+
+    def recarregar(self):
+        entradas = []
+        for doc in repositorio_professores.documentos("professores_online2"):
+            entrada = self._entrada(doc.to_dict() or {})
+            if entrada:
+                entradas.append(entrada)
+        with self._lock:
+            self._professores = {}
+            self._celulas = {}
+            for entrada in entradas:
+                self._inserir(entrada)
+            self.carregado = True
+        print(f"📍 Índice geográfico: {len(entradas)} professores com coordenadas")
+
+    def _garantir(self):
+        if not self.carregado:
+            self.recarregar()
+
+    def atualizar(self, email: str, dados: Optional[dict]):
+        entrada = self._entrada(dados) if dados else None
+        with self._lock:
+            if entrada:
+                self._inserir(entrada)
+            else:
+                self._remover((email or "").strip().lower())
+
+    def proximos(self, lat: float, lon: float, raio_km: float,
+                 disciplina: Optional[str] = None, limite: int = 20) -> list:
+        self._garantir()
+        disciplina = _chave_texto(disciplina) if disciplina else None
+
+        dlat = raio_km / GEO_KM_POR_GRAU
+        dlon = raio_km / (GEO_KM_POR_GRAU * max(math.cos(math.radians(lat)), 0.01))
+        lat_min, lon_min = _celula(lat - dlat, lon - dlon)
+        lat_max, lon_max = _celula(lat + dlat, lon + dlon)
+
+        with self._lock:
+            if (lat_max - lat_min + 1) * (lon_max - lon_min + 1) > len(self._celulas):
+                candidatos = list(self._professores.values())
+            else:
+                candidatos = [
+                    self._professores[email]
+                    for i in range(lat_min, lat_max + 1)
+                    for j in range(lon_min, lon_max + 1)
+                    for email in self._celulas.get((i, j), ())
+                ]
+
+        resultado = []
+        for prof in candidatos:
+            if disciplina and disciplina not in prof["disciplinas"]:
+                continue
+            distancia = distancia_km(lat, lon, prof["lat"], prof["lon"])
+            if distancia <= raio_km:
+                resultado.append((distancia, prof))
+
+        resultado.sort(key=lambda item: item[0])
+        return [
+            {
+                "email": prof["email"],
+                "nome": prof["nome"],
+                "latitude": prof["lat"],
+                "longitude": prof["lon"],
+                "distancia_km": round(distancia, 2)
+            }
+            for distancia, prof in resultado[:limite]
+        ]
+
+    def centroide(self, municipio: str, bairro: Optional[str] = None):
+        """Média das coordenadas dos professores do bairro (ou, se não houver, do município)."""
+        self._garantir()
+        municipio, bairro = _chave_texto(municipio), _chave_texto(bairro)
+        with self._lock:
+            professores = list(self._professores.values())
+        for filtro in ((lambda p: bairro and p["bairro"] == bairro and p["municipio"] == municipio),
+                       (lambda p: municipio and p["municipio"] == municipio)):
+            pontos = [(p["lat"], p["lon"]) for p in professores if filtro(p)]
+            if pontos:
+                return sum(p[0] for p in pontos) / len(pontos), sum(p[1] for p in pontos) / len(pontos)
+        return None
+
+    def observar(self):
+        def ao_mudar(doc, removido):
+            dados = doc.to_dict() or {}
+            email = dados.get("email") or doc.id
+            self.atualizar(email, None if removido else dados)
+
+        self._watch = repositorio_professores.ao_mudar("professores_online2", ao_mudar)
+
+    def parar(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+
+indice_geografico = IndiceGeografico()
+
+
+@app.on_event("startup")
+async def carregar_indice_geografico():
+    try:
+        await em_thread(indice_geografico.recarregar)
+        if db is not None:
+            indice_geografico.observar()
+    except Exception as e:
+        print("Erro ao carregar índice geográfico:", e)
+
+
+@app.on_event("shutdown")
+async def parar_indice_geografico():
+    indice_geografico.parar()
+
+
+@app.get("/professores-proximos")
+def professores_proximos(
+    lat: Optional[float] = None,
+    lon: Optional[float] = None,
+    aluno: Optional[str] = None,
+    raio_km: float = Query(10, gt=0, le=2000),
+    disciplina: Optional[str] = None,
+    limite: int = Query(20, ge=1, le=200)
+):
+    try:
+        if lat is None or lon is None:
+            if not aluno:
+                return JSONResponse(status_code=400, content={"detail": "Indique lat/lon ou aluno."})
+
+            # Os alunos não têm coordenadas: usa o centróide do bairro/município
+            aluno_doc = buscar_aluno_por_nome(aluno)
+            if not aluno_doc:
+                return JSONResponse(status_code=404, content={"detail": "Aluno não encontrado."})
+            dados = aluno_doc.to_dict() or {}
+            posicao = indice_geografico.centroide(dados.get("municipio"), dados.get("bairro"))
+            if posicao is None:
+                return JSONResponse(status_code=404, content={"detail": "Localização do aluno desconhecida."})
+            lat, lon = posicao
+            disciplina = disciplina or dados.get("disciplina")
+
+        if coordenada(lat, 90) is None or coordenada(lon, 180) is None:
+            return JSONResponse(status_code=400, content={"detail": "Coordenadas inválidas."})
+
+        return {
+            "origem": {"latitude": lat, "longitude": lon},
+            "professores": indice_geografico.proximos(lat, lon, raio_km, disciplina, limite)
+        }
+
+    except Exception as e:
+        print("🔴 Erro ao procurar professores próximos:", e)
+        return JSONResponse(status_code=500, content={"detail": str(e)})
+
+
 @app.get("/gerar-pdf", response_class=FileResponse)
-async def gerar_pdf():
+def gerar_pdf():
     professores = carregar_professores_local()
     os.makedirs("static/docs", exist_ok=True)
     pdf_path = "static/docs/lista_professores.pdf"
@@ -1293,7 +3852,7 @@ async def exibir_formulario(request: Request):
 
 
 @app.post("/cadastro-aluno")
-async def cadastrar_aluno(
+def cadastrar_aluno(
     request: Request,
     nome: str = Form(...),
     nome_mae: str = Form(...),
@@ -1314,21 +3873,26 @@ async def cadastrar_aluno(
 
     nome_normalizado = nome.strip().lower()
     email_normalizado = email.strip().lower()
+    aluno_id = chave_aluno(nome)
+
+    if not aluno_id:
+
+        return render_template(
+            "cadastro-aluno.html",
+            {
+                "request": request,
+                "erro": "Nome inválido."
+            }
+        )
+
+    # 🔐 verificar duplicado por nome OU email (ou outro nome com a mesma chave, ex.: sem acentos)
+    existente = buscar_aluno_por_nome(nome_normalizado)
 
-    # 🔐 verificar duplicado por nome OU email
-    existente = alunos_ref.where(
-        "nome_normalizado",
-        "==",
-        nome_normalizado
-    ).get()
+    existente_email = buscar_aluno_por_email(email_normalizado)
 
-    existente_email = alunos_ref.where(
-        "email",
-        "==",
-        email_normalizado
-    ).get()
+    existente_chave = existente is None and alunos_ref.document(aluno_id).get().exists
 
-    if existente or existente_email:
+    if existente or existente_email or existente_chave:
 
         return render_template(
             "cadastro-aluno.html",
@@ -1340,11 +3904,7 @@ async def cadastrar_aluno(
 
     paga_passado = []
 
-    vinculo_query = db.collection("alunos_professor") \
-        .where("aluno", "==", nome_normalizado) \
-        .limit(1).stream()
-
-    vinculo_doc = next(vinculo_query, None)
+    vinculo_doc = cache_vinculos.primeiro(nome_normalizado)
 
     if vinculo_doc:
         paga_passado = vinculo_doc.to_dict().get(
@@ -1352,8 +3912,6 @@ async def cadastrar_aluno(
             []
         )
 
-    aluno_id = str(uuid.uuid4())
-
     dados = {
         "nome": nome,
         "nome_normalizado": nome_normalizado,
@@ -1378,57 +3936,84 @@ async def cadastrar_aluno(
     }
 
     alunos_ref.document(aluno_id).set(dados)
+    indexar_aluno(aluno_id, dados)
+    registrar_transicao_aluno(None, dados)
 
-    # 🔁 garantir consistência de dados antigos
-    for aluno in alunos_ref.stream():
+    # alunos antigos sem 'paga_passado': POST /migrar-paga-passado (administrador)
 
-        dados_aluno = aluno.to_dict() or {}
-
-        if "paga_passado" not in dados_aluno:
-
-            paga_passado_antigo = []
+    return RedirectResponse(
+        url="/login?sucesso=1",
+        status_code=303
+    )
 
-            vinculo_query = db.collection("alunos_professor") \
-                .where(
-                    "aluno",
-                    "==",
-                    dados_aluno.get("nome", "").strip().lower()
-                ) \
-                .limit(1).stream()
 
-            vinculo_doc = next(vinculo_query, None)
+def migrar_paga_passado(apos: Optional[str] = None, limite: int = 100) -> dict:
+    """
+    Preenche 'paga_passado' (do primeiro vínculo do aluno, ou []) nos alunos
+    antigos que não o têm. Retomável: 'proximo' continua; None no fim.
+    """
+    alunos_ref = db.collection("alunos")
+    query = alunos_ref.order_by(ID_DOCUMENTO)
+    if apos:
+        query = query.where(ID_DOCUMENTO, ">", alunos_ref.document(apos))
+
+    lidos = 0
+    ultimo_id = None
+    em_falta = []
+    for doc in query.limit(limite).stream():
+        lidos += 1
+        ultimo_id = doc.id
+        dados = doc.to_dict() or {}
+        if "paga_passado" not in dados:
+            em_falta.append((doc.id, chave_nome_aluno(dados.get("nome"))))
+
+    # primeiro vínculo (pela ordem dos IDs) de cada aluno, com consultas 'in' de 30 nomes
+    nomes = sorted({nome for _, nome in em_falta if nome})
+    primeiros = {}
+    for inicio in range(0, len(nomes), LIMITE_IN):
+        consulta = db.collection("alunos_professor").where("aluno", "in", nomes[inicio:inicio + LIMITE_IN])
+        for doc in consulta.select(["aluno", "paga_passado"]).stream():
+            dados = doc.to_dict() or {}
+            atual = primeiros.get(dados.get("aluno"))
+            if atual is None or doc.id < atual[0]:
+                primeiros[dados.get("aluno")] = (doc.id, dados.get("paga_passado", []))
+
+    batch = db.batch()
+    for aluno_id, nome in em_falta:
+        batch.update(alunos_ref.document(aluno_id), {"paga_passado": primeiros.get(nome, (None, []))[1]})
+    if em_falta:
+        batch.commit()
 
-            if vinculo_doc:
-                paga_passado_antigo = vinculo_doc.to_dict().get(
-                    "paga_passado",
-                    []
-                )
+    return {
+        "alunos_lidos": lidos,
+        "alunos_preenchidos": len(em_falta),
+        "proximo": ultimo_id if lidos == limite else None
+    }
 
-            alunos_ref.document(aluno.id).update({
-                "paga_passado": paga_passado_antigo
-            })
 
-    return RedirectResponse(
-        url="/login?sucesso=1",
-        status_code=303
-    )
+@app.post("/migrar-paga-passado")
+def migrar_paga_passado_post(request: Request, apos: Optional[str] = None, limite: int = Query(100, ge=1, le=400)):
+    if not admin_autenticado(request):
+        return acesso_negado_admin()
+    try:
+        return {"status": "ok", **migrar_paga_passado(apos, limite)}
+    except Exception as e:
+        print("❌ Erro ao preencher paga_passado:", e)
+        return JSONResponse(status_code=500, content={"detail": str(e)})
 
 
 @app.get("/perfil/{nome}", response_class=HTMLResponse)
-async def profil(request: Request, nome: str):
+def profil(request: Request, nome: str):
     try:
         nome_normalizado = nome.strip().lower()
         print(f"🔍 Buscando dados do aluno: {nome_normalizado}")
 
-        query = db.collection("alunos") \
-            .where("nome_normalizado", "==", nome_normalizado) \
-            .limit(1) \
-            .stream()
+        doc = buscar_aluno_por_nome(nome_normalizado)
 
         aluno = None
         doc_id = None
 
-        for doc in query:
+        if doc:
             dados = doc.to_dict()
             aluno = {
                 "nome": dados.get("nome", nome),
@@ -1438,40 +4023,32 @@ async def profil(request: Request, nome: str):
                 "disciplina": dados.get("disciplina", "N/A")
             }
             doc_id = doc.id
-            break
 
         if not aluno or not doc_id:
             return RedirectResponse(url="/login", status_code=303)
 
-        db.collection("alunos").document(doc_id).update({
-            "online": True,
-            "ultimo_ping": datetime.utcnow().isoformat()
-        })
+        presenca.batimento("aluno", chave_presenca("aluno", dados), doc)
 
         total_gasto = 0
         aulas_dadas = 0
         vinculo_id = None
 
-        alunos_prof_ref = db.collection("alunos_professor") \
-            .where("aluno", "==", nome_normalizado) \
-            .limit(1) \
-            .stream()
+        vinculo_doc = cache_vinculos.primeiro(nome_normalizado)
+        valor_guardado = None
 
-        for vinculo_doc in alunos_prof_ref:
+        if vinculo_doc:
             vinculo_data = vinculo_doc.to_dict()
             try:
                 aulas_dadas = int(vinculo_data.get("aulas_dadas", 0) or 0)
             except Exception:
                 aulas_dadas = 0
             vinculo_id = vinculo_doc.id
-            break
+            valor_guardado = vinculo_data.get("valor_mensal_aluno")
 
         valor_total = 0
-        doc_id_comprovativo = nome_normalizado.replace(" ", "_")
+        comp_doc = documento_aluno("comprovativos_pagamento", nome_normalizado)
 
-        comp_doc = db.collection("comprovativos_pagamento").document(doc_id_comprovativo).get()
-
-        if comp_doc.exists:
+        if comp_doc and comp_doc.exists:
             comp_data = comp_doc.to_dict() or {}
             mensalidade = comp_data.get("mensalidade") or {}
             raw_valor_total = mensalidade.get("valor_total", 0)
@@ -1489,10 +4066,12 @@ async def profil(request: Request, nome: str):
         if total_gasto < 0:
             total_gasto = 0
 
-        if vinculo_id:
+        # só escreve quando o valor muda: abrir o perfil não deve custar uma escrita
+        if vinculo_id and valor_guardado != total_gasto:
             db.collection("alunos_professor").document(vinculo_id).update({
                 "valor_mensal_aluno": total_gasto
             })
+            cache_vinculos.invalidar(nome_normalizado)
 
         # ✅ AQUI ESTÁ A CORREÇÃO
         return render_template(
@@ -1529,28 +4108,11 @@ def professor_possui_alunos(prof_email: str) -> bool:
 
 
 def buscar_professor_por_email(email: str):
-    email = email.strip().lower()
-    professores = db.collection("professores_online2") \
-                    .where("email", "==", email) \
-                    .limit(1).stream()
-    for prof in professores:
-        return prof.to_dict()
-    return None
-
-# ✅ Verifica se o vínculo entre aluno e professor existe
-def vinculo_existe(prof_email: str, aluno_nome: str) -> Optional[dict]:
-    prof_email = prof_email.strip().lower()
-    aluno_nome = aluno_nome.strip().lower()
-
-    docs = db.collection("alunos_professor") \
-             .where("professor", "==", prof_email) \
-             .where("aluno", "==", aluno_nome) \
-             .limit(1).stream()
-    return next(docs, None)
+    return repositorio_professores.dados(email, "professores_online2")
 
 
 @app.get("/sala_virtual_professor", response_class=HTMLResponse)
-async def get_sala_virtual_professor(
+def get_sala_virtual_professor(
     request: Request,
     email: Optional[str] = Query(default=None),
     aluno: Optional[str] = Query(default=None)
@@ -1562,10 +4124,9 @@ async def get_sala_virtual_professor(
         email = email.strip().lower()
         aluno_normalizado = aluno.strip().lower() if aluno else None
 
-        doc_ref = db.collection("professores_online2").document(email)
-        doc = doc_ref.get()
+        doc = repositorio_professores.por_email(email, "professores_online2")
 
-        if not doc.exists:
+        if doc is None:
             raise HTTPException(status_code=404, detail="Professor não encontrado.")
 
         professor = doc.to_dict()
@@ -1615,7 +4176,7 @@ async def get_sala_virtual_professor(
         
 
 @app.get("/sala_virtual_aluno", response_class=HTMLResponse)
-async def get_sala_virtual_aluno(
+def get_sala_virtual_aluno(
     request: Request,
     email: Optional[str] = Query(default=None),
     aluno: Optional[str] = Query(default=None)
@@ -1643,15 +4204,212 @@ async def get_sala_virtual_aluno(
         }
     )
 
-import logging
+import recibos
+
+# ============================
+# 🔹 RECIBOS EM PROCESSOS SEPARADOS
+# ============================
+# O ReportLab ocupa a CPU (e o GIL) durante todo o render; os recibos são
+# gerados num pool de processos "quentes" e a rota devolve logo um job_id.
+# O estado de cada trabalho fica também em RECIBOS_COLECAO/{job_id}: o worker
+# que gera o PDF grava aí o resultado e qualquer outro worker responde ao
+# status e ao download (o PDF fica em static/, no disco partilhado).
+RECIBOS_PROCESSOS = int(os.environ.get("RECIBOS_PROCESSOS", "2"))
+RECIBOS_RETENCAO = 3600  # segundos em que um trabalho continua consultável
+# pendente há mais tempo do que isto: o worker que o gerava morreu
+RECIBOS_PRAZO_S = int(os.environ.get("RECIBOS_PRAZO_S", "300"))
+RECIBOS_COLECAO = "recibos_trabalhos"
+_JOB_ID_RECIBO = re.compile(r"[0-9a-f]{32}")
+
+_pool_recibos = None
+_trabalhos_recibo = {}  # job_id -> {"futuro", "pdf_path", "aluno", "criado_em"}
+_recibos_lock = threading.Lock()
+
+
+def pool_recibos() -> ProcessPoolExecutor:
+    global _pool_recibos
+    with _recibos_lock:
+        if _pool_recibos is None:
+            _pool_recibos = ProcessPoolExecutor(
+                max_workers=RECIBOS_PROCESSOS,
+                # "spawn": os workers não herdam o cliente do Firestore nem threads
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=recibos.inicializar_worker,
+                initargs=(recibos.CAMINHO_LOGO,)
+            )
+        return _pool_recibos
+
+
+@app.on_event("startup")
+async def iniciar_pool_recibos():
+    # arranca os processos (estilos + logotipo carregados) antes do primeiro pagamento
+    pool = await em_thread(pool_recibos)
+    for _ in range(RECIBOS_PROCESSOS):
+        pool.submit(recibos.aquecer)
+    print(f"🧾 Pool de recibos: {RECIBOS_PROCESSOS} processos")
+
+
+@app.on_event("shutdown")
+async def parar_pool_recibos():
+    if _pool_recibos is not None:
+        _pool_recibos.shutdown(wait=False, cancel_futures=True)
+
+
+def _recibo_ref(job_id: str):
+    return db.collection(RECIBOS_COLECAO).document(job_id)
+
+
+def _erro_recibo(futuro) -> Optional[str]:
+    """Erro de um futuro terminado; None se o recibo foi gerado."""
+    # no shutdown o pool cancela os pendentes: exception() levantaria CancelledError
+    if futuro.cancelled():
+        return "Geração do recibo cancelada; tente novamente."
+    erro = futuro.exception()
+    return None if erro is None else str(erro)
+
+
+def _concluir_recibo(job_id: str, futuro):
+    """Callback do futuro (thread do pool): publica o resultado para os outros workers."""
+    if db is None:
+        return
+    erro = _erro_recibo(futuro)
+    try:
+        _recibo_ref(job_id).update(
+            {"estado": "pronto"} if erro is None else {"estado": "erro", "erro": erro}
+        )
+    except Exception as e:
+        print(f"⚠️ Erro ao gravar o estado do recibo {job_id}:", e)
+
+
+def agendar_recibo(aluno: str, pdf_path: str, dados: dict) -> str:
+    global _pool_recibos
+
+    job_id = uuid.uuid4().hex
+    if db is not None:
+        criado_em = datetime.now(timezone.utc)
+        _recibo_ref(job_id).set({
+            "aluno": aluno,
+            "pdf_path": pdf_path,
+            "estado": "pendente",
+            "criado_em": criado_em,
+            # campo para uma política TTL do Firestore
+            "expira_em": criado_em + timedelta(seconds=RECIBOS_RETENCAO)
+        })
+
+    try:
+        futuro = pool_recibos().submit(recibos.gerar_recibo, pdf_path, dados)
+    except BrokenProcessPool:
+        # um worker morreu: recria o pool uma vez
+        with _recibos_lock:
+            _pool_recibos = None
+        futuro = pool_recibos().submit(recibos.gerar_recibo, pdf_path, dados)
+    futuro.add_done_callback(lambda f: _concluir_recibo(job_id, f))
+
+    agora = time.time()
+
+    with _recibos_lock:
+        for antigo in [j for j, t in _trabalhos_recibo.items() if agora - t["criado_em"] > RECIBOS_RETENCAO]:
+            del _trabalhos_recibo[antigo]
+
+        _trabalhos_recibo[job_id] = {
+            "futuro": futuro,
+            "pdf_path": pdf_path,
+            "aluno": aluno,
+            "criado_em": agora
+        }
+
+    return job_id
+
+
+def _trabalho_recibo(job_id: str) -> Optional[dict]:
+    """{aluno, pdf_path, estado, erro}: do futuro local ou, noutro worker, do Firestore."""
+    with _recibos_lock:
+        trabalho = _trabalhos_recibo.get(job_id)
+
+    if trabalho is not None:
+        resultado = {"aluno": trabalho["aluno"], "pdf_path": trabalho["pdf_path"], "estado": "pendente"}
+        futuro = trabalho["futuro"]
+        if futuro.done():
+            erro = _erro_recibo(futuro)
+            resultado["estado"] = "pronto" if erro is None else "erro"
+            if erro is not None:
+                resultado["erro"] = erro
+        return resultado
+
+    if db is None or not _JOB_ID_RECIBO.fullmatch(job_id):
+        return None
+    doc = _recibo_ref(job_id).get()
+    if not doc.exists:
+        return None
+
+    dados = doc.to_dict() or {}
+    resultado = {
+        "aluno": dados.get("aluno"),
+        "pdf_path": dados.get("pdf_path"),
+        "estado": dados.get("estado", "pendente")
+    }
+    if dados.get("erro"):
+        resultado["erro"] = dados["erro"]
+    criado_em = dados.get("criado_em")
+    if resultado["estado"] == "pendente" and criado_em and \
+            datetime.now(timezone.utc) - criado_em > timedelta(seconds=RECIBOS_PRAZO_S):
+        resultado["estado"] = "erro"
+        resultado["erro"] = "O recibo não foi gerado a tempo."
+    return resultado
+
+
+def estado_recibo(job_id: str) -> Optional[dict]:
+    trabalho = _trabalho_recibo(job_id)
+    if trabalho is None:
+        return None
+
+    estado = {"job_id": job_id, "aluno": trabalho["aluno"], "estado": trabalho["estado"]}
+    if trabalho["estado"] == "pronto":
+        estado["download"] = f"/recibos/{job_id}/download"
+    elif trabalho["estado"] == "erro":
+        estado["erro"] = trabalho.get("erro")
+    return estado
+
+
+@app.get("/recibos/{job_id}/status")
+def status_recibo(job_id: str):
+    estado = estado_recibo(job_id)
+    if estado is None:
+        return JSONResponse(status_code=404, content={"detail": "Recibo não encontrado"})
+    return estado
+
+
+@app.get("/recibos/{job_id}/download")
+def download_recibo(job_id: str):
+    trabalho = _trabalho_recibo(job_id)
+    if trabalho is None:
+        return JSONResponse(status_code=404, content={"detail": "Recibo não encontrado"})
+    estado = estado_recibo(job_id)
+
+    if estado["estado"] == "pendente":
+        return JSONResponse(status_code=202, content=estado)
+
+    if estado["estado"] == "erro":
+        logging.error(f"Erro ao gerar recibo {job_id}: {estado['erro']}")
+        return JSONResponse(status_code=500, content=estado)
+
+    pdf_path = trabalho["pdf_path"]
+    if not pdf_path or not os.path.exists(pdf_path):
+        return JSONResponse(status_code=404, content={"detail": "Recibo não encontrado"})
+
+    return FileResponse(
+        pdf_path,
+        media_type="application/pdf",
+        filename=os.path.basename(pdf_path)
+    )
+
 
 MAX_TENTATIVAS = 3
 
 def verificar_pagamento_existente(nome_comprovativo: str, aluno_nome: str) -> bool:
     """Verifica se o comprovativo já existe para o aluno no Firebase."""
-    doc_ref = db.collection("comprovativos_pagamento").document(aluno_nome)
-    doc = doc_ref.get()
-    if doc.exists:
+    doc = documento_aluno("comprovativos_pagamento", aluno_nome)
+    if doc and doc.exists:
         comprovativos = doc.to_dict().get("comprovativos", [])
         return nome_comprovativo in comprovativos
     return False
@@ -1660,8 +4418,8 @@ def verificar_pagamento_existente(nome_comprovativo: str, aluno_nome: str) -> bo
 def registrar_comprovativo_pagamento(nome_comprovativo: str, aluno_nome: str):
     """Registra o comprovativo no Firebase (somente nome)."""
     try:
-        doc_ref = db.collection("comprovativos_pagamento").document(aluno_nome)
-        doc = doc_ref.get()
+        doc = documento_aluno("comprovativos_pagamento", aluno_nome, migrar=True)
+        doc_ref = doc.reference
 
         if doc.exists:
             dados = doc.to_dict()
@@ -1678,18 +4436,14 @@ def registrar_comprovativo_pagamento(nome_comprovativo: str, aluno_nome: str):
 
 def atualizar_status_conta(aluno_nome: str, status: str):
     """Ativa ou desativa a conta do aluno na coleção 'alunos'."""
-    alunos_ref = db.collection("alunos")
-    docs = alunos_ref.stream()
-    for doc in docs:
-        dados = doc.to_dict()
-        nome_banco = dados.get("nome", "").strip().lower()
-        if nome_banco == aluno_nome:
-            alunos_ref.document(doc.id).update({"ativacao_conta": status})
+    doc = buscar_aluno_por_nome(aluno_nome)
+    if doc:
+        db.collection("alunos").document(doc.id).update({"ativacao_conta": status})
 
 
 def registrar_pagamento_mensal(aluno_nome: str):
     """Armazena o pagamento na coleção 'alunos_professor' e zera valor_mensal_aluno."""
-    docs = db.collection("alunos_professor").where("aluno", "==", aluno_nome).stream()
+    docs = cache_vinculos.do_aluno(aluno_nome, fresco=True)
     for doc in docs:
         ref = db.collection("alunos_professor").document(doc.id)
         dados = doc.to_dict()
@@ -1710,29 +4464,12 @@ def registrar_pagamento_mensal(aluno_nome: str):
             "valor_mensal_aluno": 0,
             "paga_passado": paga_passado
         })
+    if docs:
+        cache_vinculos.invalidar(aluno_nome)
 
 
-import logging
-from datetime import datetime
-
-from reportlab.lib import colors
-from reportlab.lib.enums import TA_CENTER
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import ParagraphStyle
-from reportlab.lib.units import mm
-from reportlab.platypus import (
-    SimpleDocTemplate,
-    Paragraph,
-    Spacer,
-    Table,
-    TableStyle,
-    Image
-)
-
-MAX_TENTATIVAS = 3
-
 @app.post("/upload_comprovativo", response_class=HTMLResponse)
-async def upload_comprovativo(
+def upload_comprovativo(
     request: Request,
     aluno_nome: str = Form(...),
     banco: str = Form(...),
@@ -1742,11 +4479,15 @@ async def upload_comprovativo(
 ):
     try:
 
-        aluno_normalizado = (
-            aluno_nome.strip()
-            .lower()
-            .replace(" ", "_")
-        )
+        aluno_normalizado = chave_nome_aluno(aluno_nome)
+        aluno_chave = chave_aluno(aluno_nome)
+
+        if not aluno_chave:
+
+            raise HTTPException(
+                status_code=400,
+                detail="Nome do aluno inválido."
+            )
 
         banco_norm = banco.strip().lower()
 
@@ -1787,9 +4528,9 @@ async def upload_comprovativo(
         # LER PDF
         # =====================================
 
-        conteudo = await comprovativo.read()
+        conteudo = comprovativo.file.read()
 
-        await comprovativo.close()
+        comprovativo.file.close()
 
         nome_comprovativo = comprovativo.filename
 
@@ -1812,11 +4553,15 @@ async def upload_comprovativo(
         # REGISTRAR FIREBASE
         # =====================================
 
-        doc_ref = db.collection(
-            "comprovativos_pagamento"
-        ).document(aluno_normalizado)
+        comp_doc = documento_aluno(
+            "comprovativos_pagamento",
+            aluno_normalizado,
+            migrar=True
+        )
+
+        doc_ref = comp_doc.reference
 
-        if not doc_ref.get().exists:
+        if not comp_doc.exists:
 
             doc_ref.set({
                 "comprovativos": []
@@ -1906,434 +4651,30 @@ async def upload_comprovativo(
         })
 
         # =====================================
-        # GERAR PDF ESTILO BANCÁRIO
+        # GERAR PDF ESTILO BANCÁRIO (pool de processos)
         # =====================================
 
         pdf_path = (
-            f"static/recibo_{aluno_normalizado}.pdf"
+            f"static/recibo_{aluno_chave}.pdf"
         )
 
-        doc = SimpleDocTemplate(
+        job_id = agendar_recibo(
+            aluno_chave,
             pdf_path,
-            pagesize=A4,
-            topMargin=18,
-            bottomMargin=18,
-            leftMargin=18,
-            rightMargin=18
-        )
-
-        elementos = []
-
-        # =====================================
-        # ESTILOS
-        # =====================================
-
-        estilo_centralizado = ParagraphStyle(
-            "centralizado",
-            alignment=TA_CENTER,
-            fontName="Helvetica",
-            fontSize=10,
-            leading=15
-        )
-
-        estilo_titulo = ParagraphStyle(
-            "titulo",
-            alignment=TA_CENTER,
-            fontName="Helvetica-Bold",
-            fontSize=16,
-            leading=20,
-            textColor=colors.HexColor("#0b2c5f")
-        )
-
-        estilo_subtitulo = ParagraphStyle(
-            "subtitulo",
-            alignment=TA_CENTER,
-            fontName="Helvetica",
-            fontSize=9,
-            textColor=colors.grey
-        )
-
-        # =====================================
-        # LOGOTIPO
-        # =====================================
-
-        try:
-
-            logo = Image(
-                "static/Logo Sabapp Facturas.png",
-                width=130,
-                height=55
-            )
-
-            logo.hAlign = "CENTER"
-
-            elementos.append(logo)
-
-        except Exception as e:
-
-            print("Erro ao carregar logotipo:", e)
-
-        elementos.append(
-            Spacer(1, 8)
-        )
-
-        # =====================================
-        # EMPRESA
-        # =====================================
-
-        empresa = Paragraph(
-            """
-            <b>SABI LÍDER - COMÉRCIO E PRESTAÇÃO
-            DE SERVIÇOS (SU) LDA</b>
-            <br/>
-            NIF: 5002232529
-            """,
-            estilo_titulo
-        )
-
-        elementos.append(empresa)
-
-        elementos.append(
-            Spacer(1, 10)
-        )
-
-        recibo_titulo = Paragraph(
-            """
-            <b>RECIBO DE PAGAMENTO</b>
-            """,
-            estilo_centralizado
-        )
-
-        elementos.append(recibo_titulo)
-
-        elementos.append(
-            Spacer(1, 18)
-        )
-
-        # =====================================
-        # CABEÇALHO ESTILO BANCÁRIO
-        # =====================================
-
-        cabecalho = Table(
-            [
-                [
-                    "Número do Recibo:",
-                    numero_recibo
-                ],
-                [
-                    "Data:",
-                    data_formatada
-                ],
-                [
-                    "Hora:",
-                    hora_formatada
-                ]
-            ],
-            colWidths=[160, 320]
-        )
-
-        cabecalho.setStyle(TableStyle([
-
-            ("BACKGROUND",
-             (0, 0),
-             (-1, -1),
-             colors.HexColor("#f2f2f2")),
-
-            ("GRID",
-             (0, 0),
-             (-1, -1),
-             0.5,
-             colors.lightgrey),
-
-            ("FONTNAME",
-             (0, 0),
-             (0, -1),
-             "Helvetica-Bold"),
-
-            ("FONTNAME",
-             (1, 0),
-             (1, -1),
-             "Helvetica"),
-
-            ("FONTSIZE",
-             (0, 0),
-             (-1, -1),
-             9),
-
-            ("BOTTOMPADDING",
-             (0, 0),
-             (-1, -1),
-             8),
-
-            ("TOPPADDING",
-             (0, 0),
-             (-1, -1),
-             8),
-
-        ]))
-
-        elementos.append(cabecalho)
-
-        elementos.append(
-            Spacer(1, 18)
-        )
-
-        # =====================================
-        # DADOS DO BENEFICIÁRIO
-        # =====================================
-
-        titulo_beneficiario = Table(
-            [["DADOS DO BENEFICIÁRIO"]],
-            colWidths=[480]
-        )
-
-        titulo_beneficiario.setStyle(TableStyle([
-
-            ("BACKGROUND",
-             (0, 0),
-             (-1, -1),
-             colors.HexColor("#0b2c5f")),
-
-            ("TEXTCOLOR",
-             (0, 0),
-             (-1, -1),
-             colors.white),
-
-            ("FONTNAME",
-             (0, 0),
-             (-1, -1),
-             "Helvetica-Bold"),
-
-            ("FONTSIZE",
-             (0, 0),
-             (-1, -1),
-             9),
-
-            ("BOTTOMPADDING",
-             (0, 0),
-             (-1, -1),
-             6),
-
-            ("TOPPADDING",
-             (0, 0),
-             (-1, -1),
-             6),
-        ]))
-
-        elementos.append(titulo_beneficiario)
-
-        dados_empresa = [
-
-            ["Nome:",
-             "SABI LÍDER COMÉRCIO PREST SERVIÇO SU LDA"],
-
-            ["Conta / IBAN:",
-             "AO060004000008230978610166"],
-
-            ["Banco:",
-             "Banco Angolano de Investimentos"],
-
-            ["NIF:",
-             "5002232529"]
-        ]
-
-        tabela_empresa = Table(
-            dados_empresa,
-            colWidths=[150, 330]
-        )
-
-        tabela_empresa.setStyle(TableStyle([
-
-            ("BACKGROUND",
-             (0, 0),
-             (-1, -1),
-             colors.HexColor("#f7f7f7")),
-
-            ("GRID",
-             (0, 0),
-             (-1, -1),
-             0.4,
-             colors.lightgrey),
-
-            ("FONTNAME",
-             (0, 0),
-             (0, -1),
-             "Helvetica-Bold"),
-
-            ("FONTNAME",
-             (1, 0),
-             (1, -1),
-             "Helvetica"),
-
-            ("FONTSIZE",
-             (0, 0),
-             (-1, -1),
-             8.5),
-
-            ("BOTTOMPADDING",
-             (0, 0),
-             (-1, -1),
-             6),
-
-            ("TOPPADDING",
-             (0, 0),
-             (-1, -1),
-             6),
-        ]))
-
-        elementos.append(tabela_empresa)
-
-        elementos.append(
-            Spacer(1, 18)
-        )
-
-        # =====================================
-        # DADOS DA TRANSFERÊNCIA
-        # =====================================
-
-        titulo_transferencia = Table(
-            [["DADOS DA TRANSFERÊNCIA"]],
-            colWidths=[480]
-        )
-
-        titulo_transferencia.setStyle(TableStyle([
-
-            ("BACKGROUND",
-             (0, 0),
-             (-1, -1),
-             colors.HexColor("#0b2c5f")),
-
-            ("TEXTCOLOR",
-             (0, 0),
-             (-1, -1),
-             colors.white),
-
-            ("FONTNAME",
-             (0, 0),
-             (-1, -1),
-             "Helvetica-Bold"),
-
-            ("FONTSIZE",
-             (0, 0),
-             (-1, -1),
-             9),
-
-            ("BOTTOMPADDING",
-             (0, 0),
-             (-1, -1),
-             6),
-
-            ("TOPPADDING",
-             (0, 0),
-             (-1, -1),
-             6),
-        ]))
-
-        elementos.append(titulo_transferencia)
-
-        dados_transferencia = [
-
-            ["Aluno:",
-             aluno_nome.title()],
-
-            ["Banco Utilizado:",
-             banco.upper()],
-
-            ["Número de Meses:",
-             str(meses)],
-
-            ["Valor Mensal:",
-             f"{valor_mensal:,.2f} Kz"],
-
-            ["Desconto:",
-             f"{desconto_total:,.2f} Kz"],
-
-            ["Montante Total:",
-             f"{valor_total:,.2f} Kz"],
-
-            ["Comprovativo:",
-             nome_comprovativo],
-
-            ["Estado:",
-             "SUCESSO"],
-
-            ["Canal:",
-             "Portal SabApp"]
-        ]
-
-        tabela_transferencia = Table(
-            dados_transferencia,
-            colWidths=[150, 330]
-        )
-
-        tabela_transferencia.setStyle(TableStyle([
-
-            ("BACKGROUND",
-             (0, 0),
-             (-1, -1),
-             colors.HexColor("#f7f7f7")),
-
-            ("GRID",
-             (0, 0),
-             (-1, -1),
-             0.4,
-             colors.lightgrey),
-
-            ("FONTNAME",
-             (0, 0),
-             (0, -1),
-             "Helvetica-Bold"),
-
-            ("FONTNAME",
-             (1, 0),
-             (1, -1),
-             "Helvetica"),
-
-            ("FONTSIZE",
-             (0, 0),
-             (-1, -1),
-             8.5),
-
-            ("BOTTOMPADDING",
-             (0, 0),
-             (-1, -1),
-             6),
-
-            ("TOPPADDING",
-             (0, 0),
-             (-1, -1),
-             6),
-        ]))
-
-        elementos.append(tabela_transferencia)
-
-        elementos.append(
-            Spacer(1, 25)
-        )
-
-        # =====================================
-        # RODAPÉ
-        # =====================================
-
-        rodape = Paragraph(
-            """
-            Documento processado automaticamente pelo
-            <b>SabApp</b>.
-            <br/><br/>
-            Este recibo serve como confirmação oficial
-            do pagamento efectuado.
-            """,
-            estilo_subtitulo
+            {
+                "aluno_nome": aluno_nome,
+                "banco": banco,
+                "meses": meses,
+                "valor_mensal": valor_mensal,
+                "desconto_total": desconto_total,
+                "valor_total": valor_total,
+                "comprovativo": nome_comprovativo,
+                "numero_recibo": numero_recibo,
+                "data_pagamento": data_formatada,
+                "hora_pagamento": hora_formatada
+            }
         )
 
-        elementos.append(rodape)
-
-        # =====================================
-        # GERAR PDF
-        # =====================================
-
-        doc.build(elementos)
-
         # =====================================
         # HTML RETORNO
         # =====================================
@@ -2458,17 +4799,18 @@ async def upload_comprovativo(
                 >
 
                 <h2>
-                    ✅ Recibo Gerado com Sucesso!
+                    ✅ Pagamento Registado com Sucesso!
                 </h2>
 
-                <p>
-                    O recibo profissional foi gerado
-                    com sucesso.
+                <p id="estado-recibo">
+                    O recibo está a ser gerado...
                 </p>
 
                 <a
-                    href="/static/recibo_{aluno_normalizado}.pdf"
+                    id="baixar-recibo"
+                    href="/recibos/{job_id}/download"
                     class="btn download"
+                    style="opacity:0.5;pointer-events:none;"
                     download
                 >
                     📄 Baixar Recibo PDF
@@ -2483,6 +4825,39 @@ async def upload_comprovativo(
 
             </div>
 
+            <script>
+
+                // o PDF é gerado no pool de recibos; ativa o botão quando estiver pronto
+                async function verificarRecibo() {{
+                    try {{
+                        const res = await fetch("/recibos/{job_id}/status");
+                        const dados = await res.json();
+
+                        if (dados.estado === "pronto") {{
+                            document.getElementById("estado-recibo").innerText =
+                                "O recibo profissional foi gerado com sucesso.";
+                            const botao = document.getElementById("baixar-recibo");
+                            botao.style.opacity = "1";
+                            botao.style.pointerEvents = "auto";
+                            return;
+                        }}
+
+                        if (dados.estado === "erro" || !res.ok) {{
+                            document.getElementById("estado-recibo").innerText =
+                                "Erro ao gerar o recibo. O pagamento foi registado.";
+                            return;
+                        }}
+                    }} catch (err) {{
+                        console.error("Erro ao verificar recibo:", err);
+                    }}
+
+                    setTimeout(verificarRecibo, 1000);
+                }}
+
+                verificarRecibo();
+
+            </script>
+
         </body>
 
         </html>
@@ -2541,32 +4916,8 @@ async def redirecionar_para_sala_aluno(sala: str):
     )
 
 
-def vinculo_existe(prof_email: str, aluno_nome: str) -> dict:
-    """
-    Verifica se o aluno está vinculado ao professor (normalizando os dados dos dois lados).
-    """
-    prof_email = prof_email.strip().lower()
-    aluno_nome = aluno_nome.strip().lower()
-
-    try:
-        docs = db.collection("alunos_professor") \
-                 .where("professor", "==", prof_email) \
-                 .stream()
-
-        for doc in docs:
-            data = doc.to_dict()
-            nome_banco = data.get("aluno", "").strip().lower()
-
-            if nome_banco == aluno_nome:
-                return data
-
-        return None
-    except Exception as e:
-        print(f"❌ Erro ao verificar vínculo: {e}")
-        return None
-
 @app.post("/solicitar_entrada")
-async def solicitar_entrada(
+def solicitar_entrada(
     nome_aluno: str = Form(...),
     senha_aluno: str = Form(...),
     peer_id_aluno: str = Form(...),
@@ -2598,39 +4949,30 @@ async def solicitar_entrada(
         )
 
 @app.get("/logout/{nome}")
-async def logout(nome: str):
-    db = firestore.client()
-    alunos_ref = db.collection("alunos")
-    query = alunos_ref.where("nome", "==", nome).stream()
-    for aluno in query:
-        aluno.reference.update({"online": False})
+def logout(nome: str):
+    presenca.sair("aluno", chave_nome_aluno(nome))
     return RedirectResponse(url="/", status_code=HTTP_303_SEE_OTHER)
     
 @app.post("/logout")
-async def logout(request: Request):
-    data = await request.json()
+def logout(request: Request, data: dict = Depends(corpo_json)):
     nome = data.get("nome")
-    db = firestore.client()
-    alunos_ref = db.collection("alunos")
-    query = alunos_ref.where("nome", "==", nome).stream()
-    for aluno in query:
-        aluno.reference.update({"online": False})
+    presenca.sair("aluno", chave_nome_aluno(nome))
     return RedirectResponse(url="/", status_code=303)
 
 @app.post("/alterar-senha/{nome}")
-async def alterar_senha(
+def alterar_senha(
     request: Request,
     nome: str,
     senha_antiga: str = Form(...),
     nova_senha: str = Form(...),
     confirmar_senha: str = Form(...)
 ):
-    aluno_docs = db.collection("alunos").where("nome", "==", nome).get()
-    if not aluno_docs:
+    aluno_doc = buscar_aluno_por_nome(nome)
+    if not aluno_doc:
         return RedirectResponse(url="/login", status_code=HTTP_303_SEE_OTHER)
 
-    aluno_ref = aluno_docs[0].reference
-    aluno_data = aluno_docs[0].to_dict()
+    aluno_ref = aluno_doc.reference
+    aluno_data = aluno_doc.to_dict()
 
     if senha_antiga != aluno_data.get("senha"):
         return templates.TemplateResponse("perfil.html", {
@@ -2646,8 +4988,19 @@ async def alterar_senha(
             "erro_senha": "As novas senhas não coincidem!"
         })
 
-    aluno_ref.update({"senha": nova_senha})
-    aluno_data["senha"] = nova_senha  # para manter os dados atualizados na recarga
+    atualizacoes = {"senha": nova_senha}
+
+    # 🔐 senha alterada invalida um pedido de recuperação pendente
+    token_pendente = aluno_data.get("reset_token")
+    if token_pendente:
+        atualizacoes["reset_token"] = None
+
+    aluno_ref.update(atualizacoes)
+    aluno_data.update(atualizacoes)  # para manter os dados atualizados na recarga
+
+    if token_pendente:
+        remover_indice_aluno("token", token_pendente)
+    indexar_aluno(aluno_doc.id, aluno_data)
 
     return templates.TemplateResponse("perfil.html", {
         "request": request,
@@ -2657,24 +5010,25 @@ async def alterar_senha(
 
 
 @app.post("/ping-online")
-async def ping_online(payload: dict = Body(...)):
+def ping_online(payload: dict = Body(...)):
+    # Só mexe na tabela de presença; a gravação é feita em lote
+    email = payload.get("email")
+    if email:
+        if presenca.batimento("professor", email.strip().lower()):
+            return {"status": "ok"}
+        return {"status": "erro", "mensagem": "Professor não encontrado"}
+
     nome = payload.get("nome")
     if not nome:
         return {"status": "erro", "mensagem": "Nome não fornecido"}
 
-    aluno_ref = db.collection("alunos").where("nome", "==", nome).get()
-    if aluno_ref:
-        doc = aluno_ref[0]
-        db.collection("alunos").document(doc.id).update({
-            "online": True,
-            "ultimo_ping": datetime.utcnow().isoformat()
-        })
+    if presenca.batimento("aluno", chave_nome_aluno(nome)):
         return {"status": "ok"}
     else:
         return {"status": "erro", "mensagem": "Aluno não encontrado"}
 
 @app.post("/atualizar-perfil/{nome}")
-async def atualizar_perfil(
+def atualizar_perfil(
     request: Request,
     nome: str,
     telefone: str = Form(...),
@@ -2684,12 +5038,12 @@ async def atualizar_perfil(
     disciplina: str = Form(...),
     outra_disciplina: str = Form(None)
 ):
-    aluno_docs = db.collection("alunos").where("nome", "==", nome).get()
-    if not aluno_docs:
+    aluno_doc = buscar_aluno_por_nome(nome)
+    if not aluno_doc:
         return RedirectResponse(url="/login", status_code=HTTP_303_SEE_OTHER)
 
-    aluno_ref = aluno_docs[0].reference
-    dados_atuais = aluno_docs[0].to_dict()
+    aluno_ref = aluno_doc.reference
+    dados_atuais = aluno_doc.to_dict()
 
     atualizacoes = {
         "telefone": telefone,
@@ -2709,7 +5063,7 @@ async def atualizar_perfil(
 
 
 @app.post("/verificar-aluno")
-async def verificar_aluno(
+def verificar_aluno(
     nome_aluno: str = Form(...),
     senha: str = Form(...),
     professor_id: str = Form(...)
@@ -2729,7 +5083,7 @@ async def verificar_aluno(
         return JSONResponse({"status": "erro", "mensagem": str(e)})
 
 @app.post("/verificar-aluno")
-async def verificar_aluno(
+def verificar_aluno(
     nome_aluno: str = Form(...),
     senha: str = Form(...),
     professor_id: str = Form(...)
@@ -2742,10 +5096,9 @@ async def verificar_aluno(
         # Verifica se o aluno está na lista do professor
         if doc_lista.exists and nome_aluno in doc_lista.to_dict().get("alunos", []):
             # Pega os dados do aluno na coleção 'alunos'
-            ref_aluno = db.collection("alunos").document(nome_aluno)
-            doc_aluno = ref_aluno.get()
+            doc_aluno = buscar_aluno_por_nome(nome_aluno)
 
-            if doc_aluno.exists:
+            if doc_aluno:
                 dados_aluno = doc_aluno.to_dict()
                 senha_registrada = dados_aluno.get("senha")
 
@@ -2766,7 +5119,7 @@ async def get_cadastro(request: Request):
     return templates.TemplateResponse("professores_online.html", {"request": request, "success": False})
 
 @app.post("/professores_online", response_class=HTMLResponse)
-async def post_cadastro(
+def post_cadastro(
     request: Request,
     nome_completo: str = Form(...),
     nome_mae: str = Form(...),
@@ -2815,6 +5168,8 @@ async def post_cadastro(
         # grava
         db.collection("professores_online").add(dados)
         db.collection("professores_online2").document(email).set(dados)
+        registrar_transicao_professor(None, dados)
+        repositorio_professores.invalidar(email)
 
         return templates.TemplateResponse(
             "sucesso.html",
@@ -2850,7 +5205,7 @@ async def login_prof_get(request: Request):
 
 
 @app.post("/login_prof", response_class=HTMLResponse)
-async def login_prof_post(
+def login_prof_post(
     request: Request,
     nome_completo: str = Form(...),
     senha: str = Form(...)
@@ -2866,9 +5221,7 @@ async def login_prof_post(
             email = dados.get("email")
 
             # 🟢 Atualiza status online
-            db.collection("professores_online").document(prof.id).update({
-                "online": True
-            })
+            presenca.batimento("professor", chave_presenca("professor", dados), prof)
 
             return RedirectResponse(
                 url=f"/perfil_prof?email={email}",
@@ -2886,16 +5239,13 @@ async def login_prof_post(
     
 
 @app.post("/dados_professor", response_class=HTMLResponse)
-async def dados_professor(request: Request, email: str = Form(...)):
+def dados_professor(request: Request, email: str = Form(...)):
     try:
         email = email.strip().lower()
 
-        prof_query = db.collection("professores_online") \
-            .where("email", "==", email) \
-            .limit(1) \
-            .stream()
+        prof_doc = repositorio_professores.por_email(email)
 
-        for prof_doc in prof_query:
+        if prof_doc:
             dados = prof_doc.to_dict()
 
             salario_info = dados.get("salario", {})
@@ -2925,21 +5275,14 @@ async def dados_professor(request: Request, email: str = Form(...)):
 
 
 @app.post("/logout_prof", response_class=HTMLResponse)
-async def logout_prof(request: Request, email: str = Form(...)):
-    professores_ref = db.collection("professores_online").where("email", "==", email).stream()
-
-    for prof in professores_ref:
-        db.collection("professores_online").document(prof.id).update({
-            "online": False
-        })
-        break
+def logout_prof(request: Request, email: str = Form(...)):
+    presenca.sair("professor", email.strip().lower())
 
     return RedirectResponse(url="/", status_code=303)
 
 @app.get("/meus-dados")
-async def meus_dados(email: str = Query(...)):
-    prof_ref = db.collection("professores_online").where("email", "==", email).limit(1).stream()
-    prof_doc = next(prof_ref, None)
+def meus_dados(email: str = Query(...)):
+    prof_doc = repositorio_professores.por_email(email)
 
     if not prof_doc:
         return {"erro": "Professor não encontrado"}
@@ -2974,14 +5317,12 @@ async def aulas_dadas_no_mes(email: str = Query(...)):
     }
 
 @app.get("/sala_virtual", response_class=HTMLResponse)
-async def sala_virtual(request: Request, email: str):
+def sala_virtual(request: Request, email: str):
     """
     Página da sala de aula online do professor.
     O professor será identificado pelo email enviado via query string.
     """
-    professores_ref = db.collection("professores_online")
-    query = professores_ref.where("email", "==", email).limit(1).stream()
-    prof_doc = next(query, None)
+    prof_doc = repositorio_professores.por_email(email)
 
     if not prof_doc:
         return templates.TemplateResponse("erro.html", {"request": request, "mensagem": "Professor não encontrado para criar a sala."})
@@ -2995,8 +5336,7 @@ async def sala_virtual(request: Request, email: str):
     })
 
 @app.post("/verificar_aluno")
-async def verificar_aluno(request: Request):
-    dados = await request.json()
+def verificar_aluno(request: Request, dados: dict = Depends(corpo_json)):
     nome = dados.get("nome")
     senha = dados.get("senha")
 
@@ -3010,16 +5350,13 @@ async def verificar_aluno(request: Request):
 
 
 @app.get("/professor-do-aluno/{nome_aluno}")
-async def professor_do_aluno(nome_aluno: str):
+def professor_do_aluno(nome_aluno: str):
     try:
         # Normaliza o nome do aluno
         aluno_normalizado = nome_aluno.strip().lower()
 
         # Busca vínculo aluno-professor
-        query = db.collection("alunos_professor") \
-                  .where("aluno", "==", aluno_normalizado) \
-                  .limit(1).stream()
-        vinculo_doc = next(query, None)
+        vinculo_doc = cache_vinculos.primeiro(aluno_normalizado)
 
         if not vinculo_doc:
             return JSONResponse(
@@ -3043,10 +5380,7 @@ async def professor_do_aluno(nome_aluno: str):
             }
 
         # Busca dados do professor na coleção professores_online
-        prof_query = db.collection("professores_online") \
-                       .where("email", "==", professor_email.strip().lower()) \
-                       .limit(1).stream()
-        prof_doc = next(prof_query, None)
+        prof_doc = repositorio_professores.por_email(professor_email)
 
         if not prof_doc:
             return {
@@ -3062,8 +5396,7 @@ async def professor_do_aluno(nome_aluno: str):
             "professor": prof_data.get("nome_completo", "Desconhecido"),
             "disciplina": prof_data.get("area_formacao", "Desconhecida"),
             "email": professor_email.strip().lower(),
-            "foto_perfil": prof_data.get("foto_perfil") or "perfil.png",
-            "mensagens": vinculo_data.get("mensagens", [])  # mensagens do vínculo
+            "foto_perfil": prof_data.get("foto_perfil") or "perfil.png"
         }
 
     except Exception as e:
@@ -3078,7 +5411,7 @@ async def professor_do_aluno(nome_aluno: str):
 
 
 @app.get("/meu-professor-status/{nome_aluno}") 
-async def meu_professor_status(nome_aluno: str):
+def meu_professor_status(nome_aluno: str):
     try:
         # Nome recebido da URL
         nome_original = nome_aluno.strip()
@@ -3087,14 +5420,7 @@ async def meu_professor_status(nome_aluno: str):
         nome_aluno_input = nome_original.lower().replace("_", " ")
 
         # Procurar o aluno na coleção "alunos"
-        alunos_ref = db.collection("alunos").stream()
-        aluno_doc = None
-        for doc in alunos_ref:
-            dados = doc.to_dict()
-            nome_banco = dados.get("nome", "").strip().lower()
-            if nome_banco == nome_aluno_input:
-                aluno_doc = doc
-                break
+        aluno_doc = buscar_aluno_por_nome(nome_aluno_input)
 
         if not aluno_doc:
             return JSONResponse(content={
@@ -3104,11 +5430,7 @@ async def meu_professor_status(nome_aluno: str):
             }, status_code=404)
 
         # Verificar vínculo na coleção "alunos_professor"
-        vinculo_ref = db.collection("alunos_professor") \
-                        .where("aluno", "==", nome_aluno_input) \
-                        .limit(1) \
-                        .stream()
-        vinculo_doc = next(vinculo_ref, None)
+        vinculo_doc = cache_vinculos.primeiro(nome_aluno_input)
 
         if not vinculo_doc:
             return JSONResponse(content={
@@ -3135,24 +5457,33 @@ async def meu_professor_status(nome_aluno: str):
 
 
 @app.post("/iniciar-aula")
-async def iniciar_aula(payload: dict):
+def iniciar_aula(payload: dict):
     aluno = payload.get("aluno", "").strip().lower()
     professor = payload.get("professor", "").strip().lower()
     sala = payload.get("sala", "")
 
-    db.collection("chamadas_ao_vivo").document(aluno).set({
+    chamada_antes = documento_aluno("chamadas_ao_vivo", aluno, migrar=True)
+    if chamada_antes is None:
+        raise HTTPException(status_code=400, detail="Aluno inválido")
+    chamada_ref = chamada_antes.reference
+
+    chamada_ref.set({
         "aluno": aluno,
         "professor": professor,
         "sala": sala,
         "status": "pendente",
         "timestamp": firestore.SERVER_TIMESTAMP
     })
+    registrar_transicao_chamada(
+        chamada_antes.to_dict().get("status") if chamada_antes.exists else None,
+        "pendente"
+    )
 
     return {"mensagem": "Chamada enviada ao aluno"}
 
 # 🔸 Verificar vínculo do aluno com o professor
 @app.post("/verificar-vinculo")
-async def verificar_vinculo(request: Request, dados: dict):
+def verificar_vinculo(request: Request, dados: dict):
     prof_email = dados.get("professor_email", "").strip().lower()
     aluno_nome = dados.get("aluno_nome", "").strip().lower()
     senha = dados.get("senha", "").strip()
@@ -3244,7 +5575,7 @@ class VerificarAlunoInput(BaseModel):
 
 
 @app.post("/verificar-aluno-vinculo")
-async def verificar_aluno_vinculo(request: Request, data: VerificarAlunoInput):
+def verificar_aluno_vinculo(request: Request, data: VerificarAlunoInput):
     try:
         aluno_nome = data.aluno_nome.strip().lower()
         senha = data.senha.strip()
@@ -3286,17 +5617,10 @@ async def verificar_aluno_vinculo(request: Request, data: VerificarAlunoInput):
                 }
             )
 
-        # ===============================
-        # BUSCAR VÍNCULO COM PROFESSOR
-        # ===============================
-        vinculo_docs = (
-            db.collection("alunos_professor")
-            .where("aluno", "==", aluno_nome)
-            .limit(1)
-            .stream()
-        )
-
-        vinculo_doc = next(vinculo_docs, None)
+        # ===============================
+        # BUSCAR VÍNCULO COM PROFESSOR
+        # ===============================
+        vinculo_doc = cache_vinculos.primeiro(aluno_nome)
 
         if not vinculo_doc:
             return render_template(
@@ -3314,14 +5638,7 @@ async def verificar_aluno_vinculo(request: Request, data: VerificarAlunoInput):
         # ===============================
         # BUSCAR NOME DO PROFESSOR
         # ===============================
-        prof_docs = (
-            db.collection("professores_online")
-            .where("email", "==", professor_email)
-            .limit(1)
-            .stream()
-        )
-
-        prof_doc = next(prof_docs, None)
+        prof_doc = repositorio_professores.por_email(professor_email)
 
         if prof_doc:
             professor_nome = (
@@ -3355,20 +5672,192 @@ async def verificar_aluno_vinculo(request: Request, data: VerificarAlunoInput):
             }
         )
         
+# ============================
+# 🔹 NOTIFICAÇÕES EM TEMPO REAL (SSE)
+# ============================
+# Quem muda 'notificacao'/'notificacao_todos' num vínculo grava também o estado
+# em notificacoes/{aluno}. Cada worker tem um único on_snapshot sobre essa
+# coleção (só documentos alterados depois do arranque) e reparte os avisos pelas
+# ligações SSE abertas nele, em memória.
+NOTIFICACOES_COLECAO = "notificacoes"
+
+
+def _notificacao_ref(aluno: str):
+    return db.collection(NOTIFICACOES_COLECAO).document(quote(aluno, safe=""))
+
+
+def publicar_notificacao(batch, aluno: str, estado: dict):
+    """Junta ao batch o aviso para os streams SSE de todos os workers."""
+    batch.set(_notificacao_ref(aluno), {**estado, "aluno": aluno, "atualizado_em": firestore.SERVER_TIMESTAMP})
+
+
+class CanalNotificacoes:
+    """
+    Entrega as notificações dos alunos às ligações SSE deste worker.
+    Um só on_snapshot por worker sobre 'notificacoes' traz as mudanças gravadas
+    por qualquer worker; o último estado de cada aluno ligado responde a
+    /verificar-notificacao sem ler o Firestore.
+    """
+
+    def __init__(self):
+        self._assinantes = {}  # aluno -> set de filas (uma por ligação)
+        self._estado = {}      # aluno -> último estado recebido (só alunos ligados)
+        self._watch = None
+        self._lock = threading.Lock()
+        self._loop = None
+
+    def iniciar(self, loop):
+        self._loop = loop
+        # alguns segundos de folga para a diferença entre relógios
+        desde = datetime.now(timezone.utc) - timedelta(seconds=5)
+        query = db.collection(NOTIFICACOES_COLECAO).where("atualizado_em", ">", desde)
+        self._watch = query.on_snapshot(lambda docs, mudancas, lido_em: self._ao_mudar(mudancas))
+
+    def assinar(self, aluno: str) -> asyncio.Queue:
+        fila = asyncio.Queue(maxsize=100)
+        with self._lock:
+            self._assinantes.setdefault(aluno, set()).add(fila)
+        return fila
+
+    def cancelar(self, aluno: str, fila: asyncio.Queue):
+        with self._lock:
+            filas = self._assinantes.get(aluno)
+            if filas is None:
+                return
+            filas.discard(fila)
+            if not filas:
+                # sem ligações: o próximo acesso volta a ler o Firestore
+                del self._assinantes[aluno]
+                self._estado.pop(aluno, None)
+
+    def estado(self, aluno: str) -> Optional[dict]:
+        with self._lock:
+            return self._estado.get(aluno)
+
+    def iniciar_estado(self, aluno: str, estado: dict) -> dict:
+        """Guarda o estado lido na ligação, sem sobrepor um aviso mais recente."""
+        with self._lock:
+            if aluno not in self._assinantes:
+                return estado
+            return self._estado.setdefault(aluno, estado)
+
+    def _ao_mudar(self, mudancas):
+        """Callback do on_snapshot (thread do cliente Firestore)."""
+        entregas = []
+        with self._lock:
+            for mudanca in mudancas:
+                if mudanca.type.name == "REMOVED":
+                    continue
+                dados = mudanca.document.to_dict() or {}
+                aluno = dados.get("aluno")
+                if aluno not in self._assinantes:
+                    continue
+                estado = estado_notificacao(
+                    {**dados, "professor": dados.get("professor_email", "")}
+                )
+                anterior = self._estado.get(aluno)
+                self._estado[aluno] = estado
+                # sem estado ainda, a ligação lê-o (iniciar_estado fica com este)
+                if anterior is None or anterior == estado:
+                    continue
+                entregas.extend((fila, estado) for fila in self._assinantes[aluno])
+
+        if self._loop is None:
+            return
+        for fila, estado in entregas:
+            self._loop.call_soon_threadsafe(self._entregar, fila, estado)
+
+    @staticmethod
+    def _entregar(fila: asyncio.Queue, estado: dict):
+        try:
+            fila.put_nowait(estado)
+        except asyncio.QueueFull:
+            pass
+
+    def parar(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+
+canal_notificacoes = CanalNotificacoes()
+
+
+def estado_notificacao(dados_vinculo: Optional[dict], **alteracoes) -> dict:
+    dados = {**(dados_vinculo or {}), **alteracoes}
+    return {
+        "notificacao": bool(dados.get("notificacao", False)),
+        "notificacao_todos": bool(dados.get("notificacao_todos", False)),
+        "professor_email": str(dados.get("professor", "")).strip()
+    }
+
+
+@app.on_event("startup")
+async def iniciar_canal_notificacoes():
+    if db is not None:
+        canal_notificacoes.iniciar(asyncio.get_running_loop())
+
+
+@app.on_event("shutdown")
+async def parar_canal_notificacoes():
+    canal_notificacoes.parar()
+
+
+def ler_estado_notificacao(aluno: str) -> dict:
+    doc = cache_vinculos.primeiro(aluno)
+    return estado_notificacao(doc.to_dict() if doc else None)
+
+
+@app.get("/notificacoes/stream/{aluno}")
+async def stream_notificacoes(request: Request, aluno: str):
+    """
+    Server-Sent Events: envia o estado atual ao ligar e depois apenas as mudanças
+    do vínculo no Firestore, gravadas por qualquer worker.
+    """
+    aluno = aluno.strip().lower()
+    fila = canal_notificacoes.assinar(aluno)
+
+    try:
+        estado = canal_notificacoes.estado(aluno)
+        if estado is None:
+            estado = canal_notificacoes.iniciar_estado(
+                aluno, await em_thread(ler_estado_notificacao, aluno)
+            )
+    except Exception:
+        canal_notificacoes.cancelar(aluno, fila)
+        raise
+
+    async def eventos():
+        try:
+            yield f"data: {json.dumps(estado)}\n\n"
+
+            while not await request.is_disconnected():
+                try:
+                    novo = await asyncio.wait_for(fila.get(), timeout=15)
+                    yield f"data: {json.dumps(novo)}\n\n"
+                except asyncio.TimeoutError:
+                    # mantém a ligação viva através de proxies
+                    yield ": keep-alive\n\n"
+        finally:
+            canal_notificacoes.cancelar(aluno, fila)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 class NotificacaoRequest(BaseModel):
     aluno: str
 
 @app.post("/ativar-notificacao")
-async def ativar_notificacao(data: NotificacaoRequest):
+def ativar_notificacao(data: NotificacaoRequest):
     try:
         aluno_nome = data.aluno.strip().lower()
 
         # Buscar o documento do aluno na coleção alunos_professor
-        docs = db.collection("alunos_professor") \
-                 .where("aluno", "==", aluno_nome) \
-                 .limit(1).stream()
-
-        doc = next(docs, None)
+        doc = cache_vinculos.primeiro(aluno_nome)
 
         if not doc:
             return JSONResponse(
@@ -3376,10 +5865,12 @@ async def ativar_notificacao(data: NotificacaoRequest):
                 status_code=404
             )
 
-        db.collection("alunos_professor").document(doc.id).update({
-            "notificacao": True,
-            "notificacao_todos": True
-        })
+        alteracoes = {"notificacao": True, "notificacao_todos": True}
+        batch = db.batch()
+        batch.update(db.collection("alunos_professor").document(doc.id), alteracoes)
+        publicar_notificacao(batch, aluno_nome, estado_notificacao(doc.to_dict(), **alteracoes))
+        batch.commit()
+        cache_vinculos.invalidar(aluno_nome)
 
         return {
             "msg": f"Notificação ativada para o aluno '{aluno_nome}'."
@@ -3399,18 +5890,11 @@ class AlunoInfo(BaseModel):
 
 
 @app.post("/desativar-notificacao")
-async def desativar_notificacao(request: Request, info: AlunoInfo):
+def desativar_notificacao(request: Request, info: AlunoInfo):
     try:
         aluno = info.aluno.strip().lower()
 
-        docs = (
-            db.collection("alunos_professor")
-            .where("aluno", "==", aluno)
-            .limit(1)
-            .stream()
-        )
-
-        doc = next(docs, None)
+        doc = cache_vinculos.primeiro(aluno)
 
         if not doc:
             return render_template(
@@ -3423,7 +5907,11 @@ async def desativar_notificacao(request: Request, info: AlunoInfo):
             )
 
         # Atualiza o campo notificacao para False
-        doc.reference.update({"notificacao": False})
+        batch = db.batch()
+        batch.update(doc.reference, {"notificacao": False})
+        publicar_notificacao(batch, aluno, estado_notificacao(doc.to_dict(), notificacao=False))
+        batch.commit()
+        cache_vinculos.invalidar(aluno)
 
         return render_template(
             "desativar_notificacao.html",
@@ -3447,9 +5935,8 @@ async def desativar_notificacao(request: Request, info: AlunoInfo):
 
 
 @app.post("/verificar-notificacao")
-async def verificar_notificacao(request: Request):
+def verificar_notificacao(request: Request, dados: dict = Depends(corpo_json)):
     try:
-        dados = await request.json()
         nome_aluno = str(
             dados.get("aluno", "")
         ).strip().lower()
@@ -3462,15 +5949,13 @@ async def verificar_notificacao(request: Request):
                 status_code=400
             )
 
-        # Buscar aluno
-        query = (
-            db.collection("alunos_professor")
-            .where("aluno", "==", nome_aluno)
-            .limit(1)
-            .stream()
-        )
+        # Aluno com stream SSE aberto neste worker: o canal mantém o estado em memória
+        estado = canal_notificacoes.estado(nome_aluno)
+        if estado and estado["professor_email"]:
+            return JSONResponse(content=estado)
 
-        doc = next(query, None)
+        # Buscar aluno
+        doc = cache_vinculos.primeiro(nome_aluno)
 
         if not doc:
             return JSONResponse(
@@ -3519,9 +6004,8 @@ async def verificar_notificacao(request: Request):
         
 
 @app.post("/registrar-chamada")
-async def registrar_chamada(request: Request):
+def registrar_chamada(request: Request, dados: dict = Depends(corpo_json)):
     try:
-        dados = await request.json()
 
         aluno = dados.get("aluno")
         professor = dados.get("professor")
@@ -3548,14 +6032,7 @@ async def registrar_chamada(request: Request):
         # ===============================
         # VERIFICAR VÍNCULO
         # ===============================
-        vinculo_query = (
-            db.collection("alunos_professor")
-            .where("professor", "==", professor_email)
-            .where("aluno", "==", aluno_nome)
-            .stream()
-        )
-
-        if not any(vinculo_query):
+        if cache_vinculos.do_par(professor_email, aluno_nome) is None:
             return render_template(
                 "erro.html",
                 {
@@ -3568,11 +6045,18 @@ async def registrar_chamada(request: Request):
         # ===============================
         # DOCUMENTO ÚNICO POR DIA
         # ===============================
-        hoje = date.today().isoformat()
-        doc_id = f"{aluno_slug}_{hoje}"
-
-        doc_ref = db.collection("chamadas_ao_vivo").document(doc_id)
-        doc = doc_ref.get()
+        hoje = datetime.now().date().isoformat()
+        doc = documento_aluno("chamadas_ao_vivo", aluno_nome, migrar=True, sufixo=f"_{hoje}")
+        if doc is None:
+            return render_template(
+                "erro.html",
+                {
+                    "request": request,
+                    "erro": "Nome do aluno inválido.",
+                    "sucesso": 0
+                }
+            )
+        doc_ref = doc.reference
 
         # ===============================
         # SE NÃO EXISTE → CRIA COMO PENDENTE
@@ -3585,6 +6069,7 @@ async def registrar_chamada(request: Request):
                 "status": "pendente",
                 "timestamp": SERVER_TIMESTAMP
             })
+            registrar_transicao_chamada(None, "pendente")
 
             return render_template(
                 "registrar_chamada.html",
@@ -3637,12 +6122,12 @@ app.add_middleware(
 @app.get("/verificar-transmissao/{professor_email}/{aluno_nome}")
 def verificar_transmissao(professor_email: str, aluno_nome: str):
     professor_id = professor_email.strip().lower()
+    # nome da sala partilhado com o cliente (não é o ID do documento)
     aluno_id = aluno_nome.strip().lower().replace(" ", "_")
 
-    doc_ref = db.collection("chamadas_ao_vivo").document(aluno_id)
-    doc = doc_ref.get()
+    doc = documento_aluno("chamadas_ao_vivo", aluno_nome)
 
-    if not doc.exists:
+    if doc is None or not doc.exists:
         raise HTTPException(status_code=404, detail="Chamada não encontrada")
 
     dados = doc.to_dict()
@@ -3665,9 +6150,15 @@ def definir_status_ok(dados: dict):
     if not aluno:
         raise HTTPException(status_code=400, detail="Aluno não informado")
 
-    aluno_id = aluno.strip().lower().replace(" ", "_")
-    ref = db.collection("chamadas_ao_vivo").document(aluno_id)
+    antes = documento_aluno("chamadas_ao_vivo", aluno, migrar=True)
+    if antes is None:
+        raise HTTPException(status_code=400, detail="Aluno não informado")
+    ref = antes.reference
     ref.set({"status": "aceito"}, merge=True)
+    registrar_transicao_chamada(
+        antes.to_dict().get("status") if antes.exists else None,
+        "aceito"
+    )
 
     return {"msg": "Status definido como aceito"}
 
@@ -3677,14 +6168,14 @@ def verificar_status(aluno_nome: str):
         if not aluno_nome:
             return JSONResponse(content={"erro": "Aluno não especificado"}, status_code=400)
 
-        aluno_id = aluno_nome.strip().lower().replace(" ", "_")
-        ref = db.collection("chamadas_ao_vivo").document(aluno_id)
-        doc = ref.get()
+        doc = documento_aluno("chamadas_ao_vivo", aluno_nome, migrar=True)
 
-        if doc.exists:
+        if doc is not None and doc.exists:
+            ref = doc.reference
             status = doc.to_dict().get("status", "pendente")
             if status == "pendente":
                 ref.update({"status": "aceito"})
+                registrar_transicao_chamada("pendente", "aceito")
                 status = "aceito"
             return {"status": status}
         else:
@@ -3694,25 +6185,14 @@ def verificar_status(aluno_nome: str):
         return JSONResponse(content={"erro": str(e)}, status_code=500)
         
 @app.post("/ver-aulas")
-async def ver_aulas(request: Request):
+def ver_aulas(request: Request, dados: dict = Depends(corpo_json)):
     try:
-        dados = await request.json()
         aluno_raw = dados.get("aluno", "")
         if not aluno_raw:
             return JSONResponse(content={"erro": "Nome do aluno ausente"}, status_code=400)
 
-        aluno_normalizado = str(aluno_raw).strip().lower().replace(" ", "")
-
-        db_firestore = firestore.client()
-        query = db_firestore.collection("alunos_professor").stream()
-
-        aluno_encontrado = None
-        for doc in query:
-            dados_doc = doc.to_dict()
-            aluno_db = dados_doc.get("aluno", "").strip().lower().replace(" ", "")
-            if aluno_db == aluno_normalizado:
-                aluno_encontrado = dados_doc
-                break
+        vinculo_doc = cache_vinculos.primeiro(chave_nome_aluno(aluno_raw))
+        aluno_encontrado = vinculo_doc.to_dict() if vinculo_doc else None
 
         if not aluno_encontrado:
             return JSONResponse(content={"erro": "Aluno não encontrado"}, status_code=404)
@@ -3734,7 +6214,7 @@ async def ver_aulas(request: Request):
 
 
 @app.get("/listar-alunos")
-async def listar_alunos():
+def listar_alunos():
     alunos_ref = db.collection("alunos").stream()
     alunos = []
 
@@ -3752,14 +6232,11 @@ async def listar_alunos():
     return alunos
 
 @app.get("/listar-professores-online")
-async def listar_professores_online():
+def listar_professores_online():
     try:
-        professores = db.collection("professores_online").stream()
         lista = []
 
-        for prof in professores:
-            dados = prof.to_dict() or {}
-
+        for dados in presenca.professores():
             telefone = dados.get("telefone") or dados.get("telefone_alternativo")
 
             lista.append({
@@ -3781,7 +6258,7 @@ async def listar_professores_online():
 
 
 @app.get("/listar-chamadas")
-async def listar_chamadas():
+def listar_chamadas():
     chamadas_ref = db.collection("chamadas_ao_vivo").stream()
     lista = []
 
@@ -3797,7 +6274,7 @@ async def listar_chamadas():
 
 
 @app.get("/relatorio-aulas")
-async def relatorio_aulas():
+def relatorio_aulas():
     relatorio_ref = db.collection("alunos_professor").stream()
     resultado = []
     notificacoes = []
@@ -3822,7 +6299,7 @@ async def relatorio_aulas():
     return {"relatorio": resultado, "notificacoes": notificacoes}
 
 @app.get("/alunos-nao-vinculados")
-async def listar_alunos_nao_vinculados():
+def listar_alunos_nao_vinculados():
     try:
         alunos_ref = db.collection("alunos") \
                        .where("vinculado", "==", False) \
@@ -3849,8 +6326,7 @@ async def listar_alunos_nao_vinculados():
 
 
 @app.post("/remover-aluno")
-async def remover_aluno(request: Request):
-    dados = await request.json()
+def remover_aluno(request: Request, dados: dict = Depends(corpo_json)):
     nome_raw = dados.get("nome", "")
     nome = str(nome_raw).strip()
 
@@ -3859,13 +6335,13 @@ async def remover_aluno(request: Request):
 
     print("🔍 Nome recebido:", nome)
 
-    db = firestore.client()
     docs = db.collection("alunos").where("nome", "==", nome).stream()
     achou = False
 
     for doc in docs:
         print("📌 Documento encontrado:", doc.id)
         doc.reference.delete()
+        registrar_transicao_aluno(doc.to_dict(), None)
         achou = True
 
     if achou:
@@ -3876,8 +6352,7 @@ async def remover_aluno(request: Request):
 
 
 @app.post("/remover-professor")
-async def remover_professor(request: Request):
-    dados = await request.json()
+def remover_professor(request: Request, dados: dict = Depends(corpo_json)):
     email_raw = dados.get("email", "")
     email = str(email_raw).strip().lower()
 
@@ -3887,13 +6362,13 @@ async def remover_professor(request: Request):
     print("🔍 Email recebido:", email_raw)
     print("🔍 Email normalizado:", email)
 
-    db = firestore.client()
     docs = db.collection("professores_online").where("email", "==", email).stream()
     achou = False
 
     for doc in docs:
         print("📌 Documento encontrado:", doc.id)
         doc.reference.delete()
+        registrar_transicao_professor(doc.to_dict(), None)
         achou = True
 
     # Também remove da coleção professores_online2, onde o email é o ID
@@ -3902,6 +6377,7 @@ async def remover_professor(request: Request):
         print("🗑️ Removido de professores_online2")
     except Exception as e:
         print("⚠️ Erro ao remover de professores_online2:", e)
+    repositorio_professores.invalidar(email)
 
     if achou:
         return {"mensagem": f"Professor {email_raw} removido com sucesso"}
@@ -3910,16 +6386,14 @@ async def remover_professor(request: Request):
 
 
 @app.post("/enviar-mensagem-professor")
-async def enviar_mensagem_professor(request: Request):
-    dados = await request.json()
+def enviar_mensagem_professor(request: Request, dados: dict = Depends(corpo_json)):
     destino = dados.get("email", "").strip().lower()
     texto = dados.get("mensagem", "").strip()
 
     if not destino or not texto:
         return {"erro": "Email e mensagem são obrigatórios"}
 
-    db_firestore = firestore.client()
-    doc_ref = db_firestore.collection("mensagens_professores").document(destino)
+    doc_ref = db.collection("mensagens_professores").document(destino)
 
     # Buscar mensagens anteriores (se existirem)
     doc = doc_ref.get()
@@ -3938,10 +6412,9 @@ async def enviar_mensagem_professor(request: Request):
     return {"mensagem": "Mensagem enviada com sucesso"}
 
 @app.get("/mensagens-professor/{email}")
-async def mensagens_professor(email: str):
+def mensagens_professor(email: str):
     email = email.strip().lower()
-    db_firestore = firestore.client()
-    doc_ref = db_firestore.collection("mensagens_professores").document(email)
+    doc_ref = db.collection("mensagens_professores").document(email)
     doc = doc_ref.get()
     if doc.exists:
         return {"mensagens": doc.to_dict().get("mensagens", [])}
@@ -3972,9 +6445,8 @@ dias_traduzidos = {
 }
 
 @app.post("/aulas_do_dia")
-async def aulas_do_dia(request: Request):
+def aulas_do_dia(request: Request, dados: dict = Depends(corpo_json)):
     try:
-        dados = await request.json()
         professor_email = dados.get("professor_email", "").strip().lower()
 
         if not professor_email:
@@ -3991,15 +6463,12 @@ async def aulas_do_dia(request: Request):
         docs = db.collection("alunos_professor") \
                  .where("professor", "==", professor_email).stream()
 
-        for doc in docs:
-            data = doc.to_dict()
-            aluno_nome = data.get("aluno", "").strip().lower()
-
-            aluno_docs = db.collection("alunos") \
-                .where("nome_normalizado", "==", aluno_nome).limit(1).stream()
+        nomes = [doc.to_dict().get("aluno", "").strip().lower() for doc in docs]
+        alunos_por_nome = buscar_alunos_em_lote("nome_normalizado", nomes)
 
-            for aluno_doc in aluno_docs:
-                aluno_data = aluno_doc.to_dict()
+        for aluno_nome in nomes:
+            aluno_data = alunos_por_nome.get(aluno_nome)
+            if aluno_data is not None:
                 horarios = aluno_data.get("horario", {}).get(dia_abreviado, [])
                 if horarios:
                     aulas.append({
@@ -4014,9 +6483,8 @@ async def aulas_do_dia(request: Request):
 
 
 @app.post("/aulas_da_semana")
-async def aulas_da_semana(request: Request):
+def aulas_da_semana(request: Request, dados: dict = Depends(corpo_json)):
     try:
-        dados = await request.json()
         professor_email = dados.get("professor_email", "").strip().lower()
 
         if not professor_email:
@@ -4037,15 +6505,12 @@ async def aulas_da_semana(request: Request):
         docs = db.collection("alunos_professor") \
                  .where("professor", "==", professor_email).stream()
 
-        for doc in docs:
-            data = doc.to_dict()
-            aluno_nome = data.get("aluno", "").strip().lower()
-
-            aluno_docs = db.collection("alunos") \
-                .where("nome_normalizado", "==", aluno_nome).limit(1).stream()
+        nomes = [doc.to_dict().get("aluno", "").strip().lower() for doc in docs]
+        alunos_por_nome = buscar_alunos_em_lote("nome_normalizado", nomes)
 
-            for aluno_doc in aluno_docs:
-                aluno_data = aluno_doc.to_dict()
+        for aluno_nome in nomes:
+            aluno_data = alunos_por_nome.get(aluno_nome)
+            if aluno_data is not None:
                 horarios_por_dia = aluno_data.get("horario", {})
 
                 for dia_abrev, horarios in horarios_por_dia.items():
@@ -4063,9 +6528,8 @@ async def aulas_da_semana(request: Request):
         return JSONResponse(status_code=500, content={"erro": f"Erro interno: {str(e)}"})
 
 @app.post("/ultimas-aulas")
-async def ultimas_aulas(request: Request):
+def ultimas_aulas(request: Request, dados: dict = Depends(corpo_json)):
     try:
-        dados = await request.json()
         professor_email = dados.get("professor_email", "").strip().lower()
         skip = int(dados.get("skip", 0))
         limit = int(dados.get("limit", 5))
@@ -4115,15 +6579,184 @@ async def ultimas_aulas(request: Request):
         )
 
         
+# ============================
+# 🔹 ÍNDICE DE DISPONIBILIDADE (HORÁRIOS EM BITMAP)
+# ============================
+# Um horário semanal (7 dias x 7 aulas) é um inteiro de 49 bits: o bit
+# dia * AULAS_POR_DIA + aula está a 1 quando a aula está marcada. O índice guarda
+# em memória o bitmap de cada professor de 'professores_online' que já tem
+# horário e é mantido pelo watcher do repositório de professores, por isso
+# "que professores têm a aula X livre", a sobreposição aluno/professor e a
+# primeira aula comum são operações bit a bit, sem ler o Firestore no pedido.
+DIAS_HORARIO = ["Seg", "Ter", "Qua", "Qui", "Sex", "Sáb", "Dom"]
+AULAS_HORARIO = [
+    "7:30 - 8:30",
+    "9:30 - 10:30",
+    "11:30 - 12:30",
+    "13:30 - 14:30",
+    "15:30 - 16:30",
+    "17:30 - 18:30",
+    "19:30 - 20:30"
+]
+AULAS_POR_DIA = len(AULAS_HORARIO)
+MASCARA_DIA = (1 << AULAS_POR_DIA) - 1
+MASCARA_SEMANA = (1 << (len(DIAS_HORARIO) * AULAS_POR_DIA)) - 1
+
+# "Sáb" e "Sab" aparecem ambos nos documentos
+_POSICAO_DIA = {"seg": 0, "ter": 1, "qua": 2, "qui": 3, "sex": 4, "sab": 5, "dom": 6}
+
+
+def _chave_aula(aula) -> str:
+    # "07:30-08:30" e "7:30 - 8:30" são a mesma aula
+    return re.sub(r"\b0(\d)", r"\1", "".join(str(aula).split()))
+
+
+_POSICAO_AULA = {_chave_aula(a): i for i, a in enumerate(AULAS_HORARIO)}
+
+
+def posicao_dia(dia) -> Optional[int]:
+    return _POSICAO_DIA.get(remover_acentos(str(dia or "")).strip().lower()[:3])
+
+
+def bit_aula(dia, aula) -> int:
+    """Bit da aula no bitmap semanal, ou 0 se o dia ou a aula não existirem."""
+    d = posicao_dia(dia)
+    a = _POSICAO_AULA.get(_chave_aula(aula))
+    if d is None or a is None:
+        return 0
+    return 1 << (d * AULAS_POR_DIA + a)
+
+
+def horario_para_bits(horario: Optional[dict]) -> int:
+    bits = 0
+    for dia, aulas in (horario or {}).items():
+        if isinstance(aulas, list):
+            for aula in aulas:
+                bits |= bit_aula(dia, aula)
+    return bits
+
+
+def bits_para_horario(bits: int, so_dias_com_aulas: bool = True) -> dict:
+    horario = {}
+    for d, dia in enumerate(DIAS_HORARIO):
+        do_dia = (bits >> (d * AULAS_POR_DIA)) & MASCARA_DIA
+        if do_dia or not so_dias_com_aulas:
+            horario[dia] = [a for i, a in enumerate(AULAS_HORARIO) if do_dia >> i & 1]
+    return horario
+
+
+def estado_horario(bits: int) -> dict:
+    """Dia -> True quando as 7 aulas do dia estão marcadas."""
+    return {
+        dia: (bits >> (d * AULAS_POR_DIA)) & MASCARA_DIA == MASCARA_DIA
+        for d, dia in enumerate(DIAS_HORARIO)
+    }
+
+
+def primeira_aula(bits: int) -> Optional[dict]:
+    if not bits:
+        return None
+    posicao = (bits & -bits).bit_length() - 1
+    d, a = divmod(posicao, AULAS_POR_DIA)
+    return {"dia": DIAS_HORARIO[d], "horario": AULAS_HORARIO[a]}
+
+
+def bits_do_documento(dados: Optional[dict]) -> Optional[int]:
+    """Bitmap de um documento com horário; None se o documento ainda não tem horário."""
+    dados = dados or {}
+    bits = dados.get("horario_bits")
+    if isinstance(bits, int):
+        return bits & MASCARA_SEMANA
+    if "horario" in dados:
+        return horario_para_bits(dados.get("horario"))
+    return None
+
+
+class IndiceDisponibilidade:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ocupados = {}
+        self.carregado = False
+        self._watch = None
+
+    def recarregar(self):
+        ocupados = {}
+        for doc in repositorio_professores.documentos("professores_online"):
+            dados = doc.to_dict() or {}
+            email = (dados.get("email") or "").strip().lower()
+            bits = bits_do_documento(dados)
+            if email and bits is not None:
+                ocupados[email] = bits
+        with self._lock:
+            self._ocupados = ocupados
+            self.carregado = True
+        print(f"🗓️ Índice de disponibilidade: {len(ocupados)} professores com horário")
+
+    def _garantir(self):
+        if not self.carregado:
+            self.recarregar()
+
+    def atualizar(self, email: str, bits: Optional[int]):
+        email = (email or "").strip().lower()
+        if not email:
+            return
+        with self._lock:
+            if bits is None:
+                self._ocupados.pop(email, None)
+            else:
+                self._ocupados[email] = bits & MASCARA_SEMANA
+
+    def livres(self, email: str) -> Optional[int]:
+        self._garantir()
+        ocupados = self._ocupados.get((email or "").strip().lower())
+        return None if ocupados is None else ~ocupados & MASCARA_SEMANA
+
+    def professores_com_vagas(self) -> list:
+        """[(email, bitmap livre)] dos professores com pelo menos uma aula livre."""
+        self._garantir()
+        with self._lock:
+            itens = list(self._ocupados.items())
+        return [(email, ~bits & MASCARA_SEMANA) for email, bits in itens if bits != MASCARA_SEMANA]
+
+    def observar(self):
+        def ao_mudar(doc, removido):
+            dados = doc.to_dict() or {}
+            self.atualizar(dados.get("email"), None if removido else bits_do_documento(dados))
+
+        self._watch = repositorio_professores.ao_mudar("professores_online", ao_mudar)
+
+    def parar(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+
+indice_disponibilidade = IndiceDisponibilidade()
+
+
+@app.on_event("startup")
+async def carregar_indice_disponibilidade():
+    try:
+        await em_thread(indice_disponibilidade.recarregar)
+        if db is not None:
+            indice_disponibilidade.observar()
+    except Exception as e:
+        print("Erro ao carregar índice de disponibilidade:", e)
+
+
+@app.on_event("shutdown")
+async def parar_indice_disponibilidade():
+    indice_disponibilidade.parar()
+
+
 class HorarioEnvio(BaseModel):
     aluno_nome: str
     professor_email: str
     horario: dict
 
 @app.post("/enviar-horario")
-async def enviar_horario(request: Request):
+def enviar_horario(request: Request, dados: dict = Depends(corpo_json)):
     try:
-        dados = await request.json()
         aluno_nome = dados.get("aluno_nome", "").strip().lower()
         professor_email = dados.get("professor_email", "").strip().lower()
         horario = dados.get("horario")  # dict recebido
@@ -4133,37 +6766,28 @@ async def enviar_horario(request: Request):
 
         print(f"🟢 Horário recebido → {horario}")
 
+        horario_bits = horario_para_bits(horario)
+
         # ============================================================
         # 1️⃣ ATUALIZAR HORÁRIO NA COLEÇÃO ALUNOS
         # ============================================================
-        alunos_query = db.collection("alunos") \
-            .where("nome_normalizado", "==", aluno_nome) \
-            .limit(1).stream()
-
-        aluno_found = False
-        for aluno_doc in alunos_query:
-            aluno_doc.reference.update({"horario": horario})
-            aluno_found = True
+        aluno_doc = buscar_aluno_por_nome(aluno_nome)
+        if aluno_doc:
+            aluno_doc.reference.update({"horario": horario, "horario_bits": horario_bits})
             print(f"✅ Horário atualizado em ALUNOS → {aluno_doc.id}")
-            break
-
-        if not aluno_found:
+        else:
             print("⚠️ Aluno não encontrado para atualizar horário.")
 
         # ============================================================
         # 2️⃣ ATUALIZAR HORÁRIO NA COLEÇÃO ALUNOS_PROFESSOR
         # ============================================================
-        query = db.collection("alunos_professor") \
-            .where("professor", "==", professor_email) \
-            .where("aluno", "==", aluno_nome) \
-            .limit(1).stream()
+        doc = cache_vinculos.do_par(professor_email, aluno_nome)
 
-        doc_found = False
-        for doc in query:
+        doc_found = doc is not None
+        if doc_found:
             doc.reference.update({"horario": horario})
-            doc_found = True
+            cache_vinculos.invalidar(aluno_nome)
             print(f"✅ Horário atualizado em ALUNOS_PROFESSOR → {doc.id}")
-            break
 
         if not doc_found:
             print("⚠️ Não encontrado em alunos_professor")
@@ -4172,31 +6796,21 @@ async def enviar_horario(request: Request):
         # 3️⃣ ATUALIZAR NA COLEÇÃO PROFESSORES_ONLINE
         # ============================================================
 
-        dias_necessarios = ["Seg", "Ter", "Qua", "Qui", "Sex", "Sáb", "Dom"]
-
-        # 🔥 LÓGICA CORRETA:
-        # True SOMENTE SE O ARRAY TIVER EXATAMENTE 7 HORÁRIOS
-        horario_estado = {}
-        for dia in dias_necessarios:
-            horarios_do_dia = horario.get(dia, [])
-            horario_estado[dia] = isinstance(horarios_do_dia, list) and len(horarios_do_dia) == 7
-
-        # True somente se TODOS OS DIAS estiverem completos com 7 horários
-        horario_completo = all(horario_estado.values())
+        # Dia completo = as 7 aulas do dia marcadas no bitmap
+        horario_estado = estado_horario(horario_bits)
+        horario_completo = horario_bits == MASCARA_SEMANA
 
         # Buscar professor
-        prof_query = db.collection("professores_online") \
-            .where("email", "==", professor_email) \
-            .limit(1).stream()
-
-        prof_doc = next(prof_query, None)
+        prof_doc = repositorio_professores.por_email(professor_email)
 
         if prof_doc:
             prof_doc.reference.update({
                 "horario": horario,
+                "horario_bits": horario_bits,
                 "horario_estado": horario_estado,
                 "horario_completo": horario_completo
             })
+            indice_disponibilidade.atualizar(professor_email, horario_bits)
             print(f"🟦 Horário atualizado em PROFESSORES_ONLINE → {prof_doc.id}")
         else:
             print("⚠️ Professor não encontrado em professores_online")
@@ -4207,12 +6821,14 @@ async def enviar_horario(request: Request):
         try:
             db.collection("professores_online2").document(professor_email).update({
                 "horario": horario,
+                "horario_bits": horario_bits,
                 "horario_estado": horario_estado,
                 "horario_completo": horario_completo
             })
             print("🟦 Horário atualizado em PROFESSORES_ONLINE2")
         except:
             print("⚠️ Professor não encontrado em professores_online2")
+        repositorio_professores.invalidar(professor_email)
 
         # ============================================================
         # RETORNO FINAL
@@ -4225,11 +6841,11 @@ async def enviar_horario(request: Request):
 
 
 @app.get("/ver-horario-aluno/{nome}")
-async def ver_horario_aluno(nome: str):
+def ver_horario_aluno(nome: str):
     try:
         nome = nome.strip()
-        query = db.collection("alunos").where("nome", "==", nome).limit(1).stream()
-        for doc in query:
+        doc = buscar_aluno_por_nome(nome)
+        if doc:
             dados = doc.to_dict()
             if "horario" in dados:
                 horario = dados["horario"]
@@ -4259,15 +6875,13 @@ async def ver_horario_aluno(nome: str):
 
 
 @app.get("/custos-aluno/{nome}", response_class=HTMLResponse)
-async def ver_custos_aluno(request: Request, nome: str):
+def ver_custos_aluno(request: Request, nome: str):
     try:
         nome_normalizado = nome.strip().lower()
         print(f"🔍 Verificando custos do aluno: {nome_normalizado}")
 
         # Buscar os vínculos do aluno na coleção alunos_professor
-        vinculos = db.collection("alunos_professor").where(
-            "aluno", "==", nome_normalizado
-        ).stream()
+        vinculos = cache_vinculos.do_aluno(nome_normalizado)
 
         valor_por_aula = 1250
         total_aulas_previstas = 0
@@ -4315,7 +6929,7 @@ async def ver_custos_aluno(request: Request, nome: str):
         return HTMLResponse(content=f"Erro ao calcular os custos: {str(e)}", status_code=500)
 
 @app.get("/saldo-atual")
-async def obter_saldo_atual(request: Request):
+def obter_saldo_atual(request: Request):
     try:
         email = request.query_params.get("email")
         if not email:
@@ -4331,11 +6945,9 @@ async def obter_saldo_atual(request: Request):
                 return default
             return val
 
-        prof_ref = db.collection("professores_online").where(
-            filter=FieldFilter("email", "==", email)
-        ).limit(1).stream()
+        doc = repositorio_professores.por_email(email)
 
-        for doc in prof_ref:
+        if doc:
             professor = doc.to_dict() or {}
             salario_info = safe_value(professor.get("salario"), {}) or {}
             saldo_atual = int(safe_value(salario_info.get("saldo_atual"), 0))
@@ -4360,6 +6972,7 @@ def inserir_perguntas():
                 "nivel": nivel
             })
             total += 1
+    banco_perguntas.publicar_nova_versao()
     return {"mensagem": f"✅ {total} perguntas inseridas na coleção 'perguntas_ingles' com sucesso!"}
 
 
@@ -4448,7 +7061,7 @@ def obter_perguntas_ingles():
 
 
 @app.get("/ajustar-progresso-ingles")
-async def ajustar_progresso_ingles():
+def ajustar_progresso_ingles():
     alunos_ref = db.collection("alunos").stream()
     count = 0
 
@@ -4569,8 +7182,362 @@ def remover_acentos(texto: str) -> str:
         if unicodedata.category(c) != 'Mn'
     )
 
+# ============================
+# 🔹 BANCO DE PERGUNTAS (INGLÊS)
+# ============================
+# As perguntas são dados estáticos: são lidas uma vez para memória, por nível e
+# na mesma ordem da antiga consulta (order_by("pergunta")), com as respostas já
+# normalizadas. '/inserir-perguntas' sobe a versão em 'configuracoes/perguntas_ingles'
+# e todos os workers recarregam através de on_snapshot nesse documento.
+BANCO_PERGUNTAS_VERSAO_DOC = ("configuracoes", "perguntas_ingles")
+
+
+def normalizar_resposta(texto: str) -> str:
+    return remover_acentos((texto or "").strip().lower())
+
+
+class BancoPerguntas:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._por_nivel = {}
+        self._por_id = {}
+        self.versao = 0
+        self.carregado = False
+        self._watch = None
+
+    @staticmethod
+    def _ler_firestore() -> list:
+        return [{"id": p.id, **p.to_dict()} for p in db.collection("perguntas_ingles").stream()]
+
+    @staticmethod
+    def _ler_padrao() -> list:
+        # mesma numeração de ids usada por '/inserir-perguntas'
+        return [
+            {"id": f"{nivel}_{i+1}", "nivel": nivel, **p}
+            for nivel, perguntas in obter_perguntas_ingles().items()
+            for i, p in enumerate(perguntas)
+        ]
+
+    def _versao_publicada(self) -> int:
+        doc = self._versao_ref().get()
+        return (doc.to_dict() or {}).get("versao", 0) if doc.exists else 0
+
+    def recarregar(self, versao: Optional[int] = None):
+        perguntas = []
+        if db is not None:
+            try:
+                if versao is None:
+                    versao = self._versao_publicada()
+                perguntas = self._ler_firestore()
+            except Exception as e:
+                print("Erro ao carregar perguntas de inglês:", e)
+        if not perguntas:
+            perguntas = self._ler_padrao()
+
+        por_nivel = {}
+        por_id = {}
+        for p in perguntas:
+            item = {
+                "id": p["id"],
+                "pergunta": p.get("pergunta", ""),
+                "nivel": p.get("nivel", ""),
+                "resposta_normalizada": normalizar_resposta(p.get("resposta", ""))
+            }
+            por_nivel.setdefault(item["nivel"], []).append(item)
+            por_id[item["id"]] = item
+
+        for lista in por_nivel.values():
+            lista.sort(key=lambda item: item["pergunta"])
+
+        with self._lock:
+            self._por_nivel = por_nivel
+            self._por_id = por_id
+            self.versao = versao if versao is not None else self.versao + 1
+            self.carregado = True
+
+        print(f"📚 Banco de perguntas v{self.versao}: {len(por_id)} perguntas em {len(por_nivel)} níveis")
+
+    def _garantir(self):
+        if not self.carregado:
+            self.recarregar()
+
+    def pergunta(self, nivel: str, indice: int) -> Optional[dict]:
+        self._garantir()
+        lista = self._por_nivel.get(nivel, [])
+        if 0 <= indice < len(lista):
+            return lista[indice]
+        return None
+
+    def total(self, nivel: str) -> int:
+        self._garantir()
+        return len(self._por_nivel.get(nivel, []))
+
+    def por_id(self, pergunta_id: str) -> Optional[dict]:
+        self._garantir()
+        return self._por_id.get(pergunta_id)
+
+    def _versao_ref(self):
+        colecao, documento = BANCO_PERGUNTAS_VERSAO_DOC
+        return db.collection(colecao).document(documento)
+
+    def publicar_nova_versao(self):
+        """Chamado depois de escrever as perguntas: recarrega aqui e avisa os outros workers."""
+        self._versao_ref().set({"versao": firestore.Increment(1)}, merge=True)
+        self.recarregar()
+
+    def observar(self):
+        def ao_mudar(docs, mudancas, lido_em):
+            for doc in docs:
+                versao = (doc.to_dict() or {}).get("versao") if doc.exists else None
+                if versao is not None and versao != self.versao:
+                    self.recarregar(versao)
+
+        self._watch = self._versao_ref().on_snapshot(ao_mudar)
+
+    def parar(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+
+banco_perguntas = BancoPerguntas()
+
+
+@app.on_event("startup")
+async def carregar_banco_perguntas():
+    await em_thread(banco_perguntas.recarregar)
+    if db is not None:
+        try:
+            banco_perguntas.observar()
+        except Exception as e:
+            print("Erro ao observar versão das perguntas:", e)
+
+
+@app.on_event("shutdown")
+async def parar_banco_perguntas():
+    banco_perguntas.parar()
+
+
+# ============================
+# 🔹 SESSÕES DO QUIZ DE INGLÊS
+# ============================
+# Enquanto o aluno responde, nível, posição e histórico ficam em memória.
+# O progresso vai para o Firestore em lote: ao mudar de nível, ao terminar a
+# sessão (QUIZ_SESSAO_TTL sem atividade, ou shutdown) ou a cada
+# QUIZ_GRAVAR_CADA perguntas avançadas. Cada gravação é uma transação que só
+# escreve se 'quiz_versao' no documento for a que a sessão leu: se outro worker
+# gravou entretanto, a sessão adota o estado gravado em vez de o sobrepor.
+QUIZ_SESSAO_TTL = int(os.environ.get("QUIZ_SESSAO_TTL", "900"))
+QUIZ_GRAVAR_CADA = int(os.environ.get("QUIZ_GRAVAR_CADA", "5"))
+QUIZ_INTERVALO_LIMPEZA = 60
+
+
+def chave_quiz(nome: str) -> str:
+    return chave_aluno(nome)
+
+
+def _estado_quiz(aluno: dict) -> tuple:
+    """(nível, progresso) do documento do aluno; progresso inválido conta como 0."""
+    nivel_raw = (aluno.get("nivel_ingles") or "iniciante").strip().lower()
+    progresso = aluno.get("progresso_ingles", 0)
+    if not isinstance(progresso, int) or progresso < 0:
+        progresso = 0
+    return mapa_niveis.get(nivel_raw, "iniciante"), progresso
+
+
+def _gravar_quiz(transaction, ref, versao: int, alteracoes: dict) -> Optional[dict]:
+    """Grava se ninguém gravou desde 'versao'; senão devolve o documento atual."""
+    doc = ref.get(transaction=transaction)
+    if not doc.exists:
+        return {}
+    dados = doc.to_dict() or {}
+    if dados.get("quiz_versao", 0) != versao:
+        return dados
+    transaction.update(ref, {**alteracoes, "quiz_versao": versao + 1})
+    return None
+
+
+class SessoesQuiz:
+    def __init__(self, ttl: int = QUIZ_SESSAO_TTL, gravar_cada: int = QUIZ_GRAVAR_CADA):
+        self.ttl = ttl
+        self.gravar_cada = gravar_cada
+        self._lock = threading.Lock()
+        self._sessoes = {}
+        self._tarefa = None
+
+    @staticmethod
+    def _adotar(sessao: dict, aluno: dict):
+        """Estado da sessão = estado gravado no documento do aluno."""
+        nivel, progresso = _estado_quiz(aluno)
+        historico = aluno.get("historico_ingles")
+        historico = list(historico) if isinstance(historico, list) else []
+        sessao.update({
+            "nivel": nivel,
+            "nivel_gravado": nivel,
+            "progresso": progresso,
+            # -1 obriga a regravar um progresso inválido na primeira gravação
+            "progresso_gravado": progresso if progresso == aluno.get("progresso_ingles", 0) else -1,
+            "historico": historico,
+            "historico_gravado": len(historico),
+            "versao": aluno.get("quiz_versao", 0)
+        })
+
+    def _carregar(self, nome: str) -> Optional[dict]:
+        doc = buscar_aluno_por_nome(nome)
+        if not doc:
+            return None
+
+        aluno = doc.to_dict() or {}
+        sessao = {
+            "doc_id": doc.id,
+            "nome": aluno.get("nome", nome),
+            "ultimo_acesso": time.monotonic()
+        }
+        self._adotar(sessao, aluno)
+        return sessao
+
+    def obter(self, nome: str) -> Optional[dict]:
+        """Sessão ativa do aluno; só lê o Firestore na primeira pergunta da sessão."""
+        chave = chave_quiz(nome)
+        with self._lock:
+            sessao = self._sessoes.get(chave)
+            if sessao is not None:
+                sessao["ultimo_acesso"] = time.monotonic()
+                return sessao
+
+        sessao = self._carregar(nome)
+        if sessao is None:
+            return None
+
+        with self._lock:
+            # outra thread pode ter carregado a mesma sessão entretanto
+            return self._sessoes.setdefault(chave, sessao)
+
+    def avancar(self, sessao: dict) -> int:
+        with self._lock:
+            sessao["progresso"] += 1
+            progresso = sessao["progresso"]
+            pendentes = progresso - sessao["progresso_gravado"]
+
+        if pendentes >= self.gravar_cada or progresso >= banco_perguntas.total(sessao["nivel"]):
+            self.gravar([sessao])
+        return sessao["progresso"]
+
+    def mudar_nivel(self, sessao: dict, novo_nivel: str):
+        with self._lock:
+            sessao["nivel"] = novo_nivel
+            sessao["progresso"] = 0
+            # o histórico é do nível atual
+            sessao["historico"] = []
+            sessao["historico_gravado"] = -1
+        self.gravar([sessao])
+
+    def registrar_resposta(self, sessao: dict, pergunta_id: str, acertou: bool):
+        with self._lock:
+            sessao["historico"].append({"pergunta_id": pergunta_id, "acertou": acertou})
+
+    def _alteracoes(self, sessao: dict) -> Optional[dict]:
+        alteracoes = {}
+        if sessao["progresso"] != sessao["progresso_gravado"]:
+            alteracoes["progresso_ingles"] = sessao["progresso"]
+        if sessao["nivel"] != sessao["nivel_gravado"]:
+            alteracoes["nivel_ingles"] = sessao["nivel"]
+        if len(sessao["historico"]) != sessao["historico_gravado"]:
+            alteracoes["historico_ingles"] = list(sessao["historico"])
+        return alteracoes or None
+
+    def gravar(self, sessoes: list) -> int:
+        """Grava o progresso ainda não persistido destas sessões (uma transação por aluno)."""
+        with self._lock:
+            pendentes = [(s, self._alteracoes(s), s["versao"]) for s in sessoes]
+        pendentes = [(s, alt, versao) for s, alt, versao in pendentes if alt]
+        if not pendentes or db is None:
+            return 0
+
+        gravadas = 0
+        for sessao, alteracoes, versao in pendentes:
+            atual = _transacao(_gravar_quiz, db.collection("alunos").document(sessao["doc_id"]), versao, alteracoes)
+
+            with self._lock:
+                if atual is None:
+                    sessao["versao"] = versao + 1
+                    sessao["progresso_gravado"] = alteracoes.get("progresso_ingles", sessao["progresso_gravado"])
+                    sessao["nivel_gravado"] = alteracoes.get("nivel_ingles", sessao["nivel_gravado"])
+                    sessao["historico_gravado"] = len(alteracoes.get("historico_ingles", sessao["historico"]))
+                    gravadas += 1
+                elif atual:
+                    # outro worker gravou este aluno depois de nós: fica o que está no Firestore
+                    print(f"⚠️ Quiz de {sessao['nome']} gravado noutro worker; sessão recarregada.")
+                    self._adotar(sessao, atual)
+
+        return gravadas
+
+    def encerrar_inativas(self, todas: bool = False) -> int:
+        limite = time.monotonic() - self.ttl
+        with self._lock:
+            chaves = [c for c, s in self._sessoes.items() if todas or s["ultimo_acesso"] < limite]
+            sessoes = [self._sessoes[c] for c in chaves]
+
+        gravadas = self.gravar(sessoes)
+
+        with self._lock:
+            for chave in chaves:
+                sessao = self._sessoes.get(chave)
+                # só descarta se não voltou a ser usada durante a gravação
+                if sessao is not None and (todas or sessao["ultimo_acesso"] < limite):
+                    del self._sessoes[chave]
+        return gravadas
+
+    async def _ciclo(self):
+        while True:
+            await asyncio.sleep(QUIZ_INTERVALO_LIMPEZA)
+            try:
+                await em_thread(self.encerrar_inativas)
+            except Exception as e:
+                print("⚠️ Erro ao gravar sessões do quiz:", e)
+
+    def iniciar(self):
+        if self._tarefa is None:
+            self._tarefa = asyncio.get_running_loop().create_task(self._ciclo())
+
+    async def parar(self):
+        if self._tarefa is not None:
+            self._tarefa.cancel()
+            self._tarefa = None
+        await em_thread(self.encerrar_inativas, True)
+
+    def estado(self) -> dict:
+        with self._lock:
+            return {
+                "sessoes_ativas": len(self._sessoes),
+                "por_gravar": sum(1 for s in self._sessoes.values() if self._alteracoes(s))
+            }
+
+
+sessoes_quiz = SessoesQuiz()
+
+
+@app.on_event("startup")
+async def iniciar_sessoes_quiz():
+    if db is not None:
+        sessoes_quiz.iniciar()
+
+
+@app.on_event("shutdown")
+async def parar_sessoes_quiz():
+    try:
+        await sessoes_quiz.parar()
+    except Exception as e:
+        print("⚠️ Erro ao gravar sessões do quiz no shutdown:", e)
+
+
+@app.get("/status-sessoes-quiz")
+def status_sessoes_quiz():
+    return sessoes_quiz.estado()
+
+
 @app.get("/pergunta-ingles")
-async def pergunta_ingles(nome: str, nivel: str = None):
+def pergunta_ingles(nome: str, nivel: str = None):
     mapa_niveis = {
         "basico": "iniciante",
         "inicial": "iniciante",
@@ -4586,53 +7553,35 @@ async def pergunta_ingles(nome: str, nivel: str = None):
         "avancado": "fluente"
     }
 
-    nome = remover_acentos(nome.strip().lower())
+    nome = nome.strip()
 
-    # Busca aluno pelo nome
-    aluno_ref = db.collection("alunos").where("nome_normalizado", "==", nome).limit(1).get()
-    if not aluno_ref:
+    # Sessão do quiz (só lê o aluno no Firestore no início da sessão)
+    sessao = sessoes_quiz.obter(nome)
+    if sessao is None:
         return JSONResponse(status_code=404, content={"erro": "Aluno não encontrado"})
 
-    doc = aluno_ref[0]
-    aluno = doc.to_dict()
-
     # Define nível
     if nivel:
         nivel = mapa_niveis.get(nivel.strip().lower(), "iniciante")
     else:
-        nivel_raw = aluno.get("nivel_ingles", "iniciante").strip().lower()
-        nivel = mapa_niveis.get(nivel_raw, "iniciante")
+        nivel = sessao["nivel"]
 
     # Progresso do aluno
-    progresso = aluno.get("progresso_ingles", 0)
-    if not isinstance(progresso, int) or progresso < 0:
-        progresso = 0
+    progresso = sessao["progresso"]
 
-    # Busca perguntas do nível
-    perguntas_ref = db.collection("perguntas_ingles") \
-        .where("nivel", "==", nivel) \
-        .order_by("pergunta") \
-        .stream()
-    perguntas = [{"id": p.id, **p.to_dict()} for p in perguntas_ref]
+    # Perguntas do nível vêm do banco em memória
+    total_perguntas = banco_perguntas.total(nivel)
 
     # Caso tenha terminado as perguntas -> subir nível
-    if progresso >= len(perguntas):
+    if progresso >= total_perguntas:
         if nivel in proximo_nivel:
             novo_nivel = proximo_nivel[nivel]
-            doc.reference.update({
-                "nivel_ingles": novo_nivel,
-                "progresso_ingles": 0
-            })
-            print(f"🚀 {aluno.get('nome', nome)} subiu de {nivel.upper()} para {novo_nivel.upper()}.")
+            sessoes_quiz.mudar_nivel(sessao, novo_nivel)
+            print(f"🚀 {sessao['nome']} subiu de {nivel.upper()} para {novo_nivel.upper()}.")
 
-            prox_perguntas_ref = db.collection("perguntas_ingles") \
-                .where("nivel", "==", novo_nivel) \
-                .order_by("pergunta") \
-                .stream()
-            prox_perguntas = [{"id": p.id, **p.to_dict()} for p in prox_perguntas_ref]
+            primeira = banco_perguntas.pergunta(novo_nivel, 0)
 
-            if prox_perguntas:
-                primeira = prox_perguntas[0]
+            if primeira:
                 return JSONResponse(content={
                     "mensagem": "Subiu de nível!",
                     "novo_nivel": novo_nivel,
@@ -4647,8 +7596,8 @@ async def pergunta_ingles(nome: str, nivel: str = None):
             return JSONResponse(content={"status": "maximo", "mensagem": "Você já está no nível máximo!"})
 
     # Caso ainda tenha perguntas no nível
-    if perguntas:
-        pergunta_atual = perguntas[progresso]
+    if total_perguntas:
+        pergunta_atual = banco_perguntas.pergunta(nivel, progresso)
         return JSONResponse(content={
             "id": pergunta_atual["id"],
             "pergunta": pergunta_atual["pergunta"],
@@ -4659,47 +7608,20 @@ async def pergunta_ingles(nome: str, nivel: str = None):
     return JSONResponse(content={"status": "sem-perguntas", "mensagem": "Nenhuma pergunta disponível para este nível."})
 
 
-@app.post("/proxima-pergunta")
-async def proxima_pergunta(data: dict = Body(...)):
-    mapa_niveis = {
-        "basico": "iniciante",
-        "inicial": "iniciante",
-        "intermedio": "intermediario",
-        "medio": "intermediario",
-        "avancado": "avancado",
-        "fluente": "fluente"
-    }
-
-    nome = data.get("nome", "").strip()
-    nome_normalizado = remover_acentos(nome.lower())
-
-    aluno_ref = db.collection("alunos").where("nome_normalizado", "==", nome_normalizado).limit(1).get()
-    if not aluno_ref:
-        return JSONResponse(status_code=404, content={"erro": "Aluno não encontrado"})
-
-    aluno_doc = aluno_ref[0]
-    aluno = aluno_doc.to_dict()
-
-    progresso = aluno.get("progresso_ingles", 0) + 1
-    db.collection("alunos").document(aluno_doc.id).update({
-        "progresso_ingles": progresso
-    })
-
-    nivel_raw = aluno.get("nivel_ingles", "iniciante").strip().lower()
-    nivel = mapa_niveis.get(nivel_raw, "iniciante")
-
-    perguntas_ref = db.collection("perguntas_ingles") \
-        .where("nivel", "==", nivel) \
-        .order_by("pergunta") \
-        .stream()
+@app.post("/proxima-pergunta")
+def proxima_pergunta(data: dict = Body(...)):
+    sessao = sessoes_quiz.obter(data.get("nome", ""))
+    if sessao is None:
+        return JSONResponse(status_code=404, content={"erro": "Aluno não encontrado"})
 
-    perguntas = [{"id": p.id, **p.to_dict()} for p in perguntas_ref]
+    # o progresso é gravado em lote pela sessão
+    progresso = sessoes_quiz.avancar(sessao)
+    nivel = sessao["nivel"]
 
-    if progresso >= len(perguntas):
+    pergunta_atual = banco_perguntas.pergunta(nivel, progresso)
+    if pergunta_atual is None:
         return JSONResponse(content={"status": "final-nivel"})
 
-    pergunta_atual = perguntas[progresso]
-
     return JSONResponse(content={
         "id": pergunta_atual["id"],
         "pergunta": pergunta_atual["pergunta"],
@@ -4709,30 +7631,27 @@ async def proxima_pergunta(data: dict = Body(...)):
 
 
 @app.post("/verificar-resposta")
-async def verificar_resposta(data: dict = Body(...)):
+def verificar_resposta(data: dict = Body(...)):
     nome = data.get("nome", "").strip().lower()
-    resposta_user = remover_acentos(data.get("resposta", "").strip().lower())
+    resposta_user = normalizar_resposta(data.get("resposta", ""))
     pergunta_id = data.get("pergunta_id", "").strip()
 
-    aluno_ref = db.collection("alunos").where("nome_normalizado", "==", nome).limit(1).get()
-    if not aluno_ref:
+    sessao = sessoes_quiz.obter(nome)
+    if sessao is None:
         return JSONResponse(status_code=404, content={"erro": "Aluno não encontrado"})
 
-    doc = aluno_ref[0]
-    aluno = doc.to_dict()
-
-    pergunta_ref = db.collection("perguntas_ingles").document(pergunta_id).get()
-    if not pergunta_ref.exists:
+    pergunta = banco_perguntas.por_id(pergunta_id)
+    if pergunta is None:
         return JSONResponse(status_code=404, content={"erro": "Pergunta não encontrada"})
 
-    pergunta_data = pergunta_ref.to_dict()
-    resposta_certa = remover_acentos(pergunta_data["resposta"].strip().lower())
+    acertou = resposta_user == pergunta["resposta_normalizada"]
+    sessoes_quiz.registrar_resposta(sessao, pergunta_id, acertou)
 
-    if resposta_user == resposta_certa:
-        print(f"✔️ {aluno.get('nome', nome)} acertou a pergunta {pergunta_id}.")
+    if acertou:
+        print(f"✔️ {sessao['nome']} acertou a pergunta {pergunta_id}.")
         return JSONResponse(content={"acertou": True})
     else:
-        print(f"❌ {aluno.get('nome', nome)} errou a pergunta {pergunta_id}.")
+        print(f"❌ {sessao['nome']} errou a pergunta {pergunta_id}.")
         return JSONResponse(content={"acertou": False})
 
 
@@ -4747,14 +7666,11 @@ async def pagina_pagamentos(aluno_nome: str, request: Request):
 
 
 @app.get("/api/historico-pagamentos/{aluno_nome}")
-async def historico_pagamentos_api(aluno_nome: str):
+def historico_pagamentos_api(aluno_nome: str):
     aluno_normalizado = aluno_nome.strip().lower()
 
     # busca vinculo (aluno_professor)
-    vinculos = db.collection("alunos_professor") \
-                 .where("aluno", "==", aluno_normalizado) \
-                 .limit(1).stream()
-    vinculo_doc = next(vinculos, None)
+    vinculo_doc = cache_vinculos.primeiro(aluno_normalizado)
     if not vinculo_doc:
         raise HTTPException(status_code=404, detail="Aluno/vínculo não encontrado")
 
@@ -4812,14 +7728,11 @@ class PagamentoIn(BaseModel):
 
 
 @app.post("/api/registrar-pagamento")
-async def registrar_pagamento(data: PagamentoIn):
+def registrar_pagamento(data: PagamentoIn):
     aluno_normalizado = data.aluno_nome.strip().lower()
 
-    # Buscar vínculo do aluno
-    vinculos = db.collection("alunos_professor") \
-                 .where("aluno", "==", aluno_normalizado) \
-                 .limit(1).stream()
-    vinculo_doc = next(vinculos, None)
+    # Buscar vínculo do aluno (lido do Firestore: o histórico vai ser regravado)
+    vinculo_doc = cache_vinculos.primeiro(aluno_normalizado, fresco=True)
     if not vinculo_doc:
         raise HTTPException(status_code=404, detail="Aluno/vínculo não encontrado")
 
@@ -4851,6 +7764,7 @@ async def registrar_pagamento(data: PagamentoIn):
     doc_ref.update({
         "valor_mensal_aluno": 0
     })
+    cache_vinculos.invalidar(aluno_normalizado)
 
     # Além disso, registrar em coleção de pagamentos individuais (opcional)
     doc_id = f"{aluno_normalizado}_{data.ano}_{data.mes}"
@@ -4867,7 +7781,7 @@ async def registrar_pagamento(data: PagamentoIn):
 
 
 @app.get("/salarios", response_class=HTMLResponse)
-async def salarios(request: Request):
+def salarios(request: Request):
     try:
         email = request.query_params.get("email")
         if not email:
@@ -4882,9 +7796,7 @@ async def salarios(request: Request):
                 return default
             return val
 
-        prof_ref = db.collection("professores_online").where(
-            filter=FieldFilter("email", "==", email)
-        ).limit(1).stream()
+        prof_ref = repositorio_professores.todos_por_email(email)[:1]
 
         saldo_atual = 0
         nome_professor = ""
@@ -4929,7 +7841,7 @@ async def salarios(request: Request):
         return HTMLResponse(content=f"Erro: {str(e)}", status_code=500)
         
 @app.get("/pagamentos", response_class=HTMLResponse)
-async def pagamentos(request: Request):
+def pagamentos(request: Request):
     campos_obrigatorios = {
         "aluno": "",
         "preco_aula": 0,
@@ -4957,6 +7869,7 @@ async def pagamentos(request: Request):
 
         if atualizado:
             db.collection("alunos_professor").document(doc.id).update(novos_dados)
+            cache_vinculos.invalidar(data.get("aluno"))
 
     return render_template(
         "pagamentos.html",
@@ -4969,7 +7882,7 @@ async def pagamentos(request: Request):
 ANGOLA_TZ = pytz.timezone("Africa/Luanda")
 
 @app.post("/api/registrar-pagamento")
-async def registrar_pagamento(data: dict = Body(...)):
+def registrar_pagamento(data: dict = Body(...)):
     try:
         aluno = data.get("aluno", "").strip().lower()
         valor = data.get("valor", 0)
@@ -4990,16 +7903,11 @@ async def registrar_pagamento(data: dict = Body(...)):
         data_pagamento = agora.strftime("%Y-%m-%d")
         hora_pagamento = agora.strftime("%H:%M:%S")
 
-        # Buscar vínculo em alunos_professor
-        alunos_prof_ref = db.collection("alunos_professor") \
-            .where("aluno", "==", aluno).limit(1).stream()
+        # Buscar vínculo em alunos_professor (lido do Firestore: o histórico vai ser regravado)
+        vinculo_doc = cache_vinculos.primeiro(aluno, fresco=True)
 
-        vinculo_id = None
-        vinculo_data = None
-        for doc in alunos_prof_ref:
-            vinculo_id = doc.id
-            vinculo_data = doc.to_dict()
-            break
+        vinculo_id = vinculo_doc.id if vinculo_doc else None
+        vinculo_data = vinculo_doc.to_dict() if vinculo_doc else None
 
         if not vinculo_id:
             raise HTTPException(status_code=404, detail="Aluno não encontrado em alunos_professor")
@@ -5033,6 +7941,7 @@ async def registrar_pagamento(data: dict = Body(...)):
         updates["Valor_mensal_aluno"] = 0
 
         doc_ref.update(updates)
+        cache_vinculos.invalidar(aluno)
 
         return {
             "status": "sucesso",
@@ -5044,13 +7953,12 @@ async def registrar_pagamento(data: dict = Body(...)):
 
 
 @app.get("/historico-pagamentos-prof/{prof_id}", response_class=HTMLResponse)
-async def historico_pagamentos_prof(request: Request, prof_id: str):
+def historico_pagamentos_prof(request: Request, prof_id: str):
     try:
         # Busca o professor no Firestore
-        doc_ref = db.collection("professores_online").document(prof_id)
-        doc = doc_ref.get()
+        doc = repositorio_professores.por_id(prof_id)
 
-        if not doc.exists:
+        if doc is None:
             return templates.TemplateResponse(
                 "historico_pagamentos.html",
                 {"request": request, "professor": None, "historico": []}
@@ -5082,7 +7990,7 @@ async def historico_pagamentos_prof(request: Request, prof_id: str):
 
 
 @app.get("/detalhes-pagamento/{aluno_id}")
-async def detalhes_pagamento(aluno_id: str):
+def detalhes_pagamento(aluno_id: str):
     doc_ref = db.collection("alunos_professor").document(aluno_id).get()
     if not doc_ref.exists:
         return JSONResponse({"error": "Aluno não encontrado"}, status_code=404)
@@ -5107,7 +8015,7 @@ async def detalhes_pagamento(aluno_id: str):
 
 
 @app.post("/atualizar-pagamento-mes")
-async def atualizar_pagamento_mes(payload: dict):
+def atualizar_pagamento_mes(payload: dict):
     aluno_id = payload.get("id")
     campo = payload.get("campo")
     status = payload.get("status")
@@ -5118,11 +8026,12 @@ async def atualizar_pagamento_mes(payload: dict):
     db.collection("alunos_professor").document(aluno_id).update({
         campo: status
     })
+    cache_vinculos.invalidar_documento(aluno_id)
     return JSONResponse({"status": "ok"})
 
 
 @app.get("/listar-pagamentos")
-async def listar_pagamentos():
+def listar_pagamentos():
     alunos_ref = db.collection("alunos").stream()
     alunos_lista = []
 
@@ -5137,15 +8046,12 @@ async def listar_pagamentos():
         total_gasto = 0
 
         # Se quiser, ainda pode buscar vínculo para pegar valor_mensal_aluno atualizado
-        alunos_prof_ref = db.collection("alunos_professor") \
-            .where("aluno", "==", nome_banco.lower()) \
-            .limit(1).stream()
+        vinculo_doc = cache_vinculos.primeiro(nome_banco.lower())
 
-        for vinculo_doc in alunos_prof_ref:
+        if vinculo_doc:
             vinculo_data = vinculo_doc.to_dict()
             valor_mensal_aluno = vinculo_data.get("valor_mensal_aluno", 0)
             total_gasto = valor_mensal_aluno
-            break
 
         alunos_lista.append({
             "id": doc.id,
@@ -5161,20 +8067,13 @@ async def listar_pagamentos():
 
 
 @app.get("/ver-pagamentos/{nome_aluno}")
-async def ver_pagamentos(nome_aluno: str):
+def ver_pagamentos(nome_aluno: str):
     # Normaliza o nome do aluno
     nome_normalizado = nome_aluno.strip().lower()
 
-    # Buscar aluno na coleção "alunos" pelo nome original
-    alunos_ref = db.collection("alunos").stream()
-    aluno_doc = None
-
-    for doc in alunos_ref:
-        dados = doc.to_dict()
-        nome_banco = dados.get("nome", "").strip().lower()
-        if nome_banco == nome_normalizado:
-            aluno_doc = dados
-            break
+    # Buscar aluno na coleção "alunos" pelo nome normalizado
+    doc = buscar_aluno_por_nome(nome_normalizado)
+    aluno_doc = doc.to_dict() if doc else None
 
     if not aluno_doc:
         raise HTTPException(status_code=404, detail=f"Aluno '{nome_aluno}' não encontrado")
@@ -5189,7 +8088,7 @@ async def ver_pagamentos(nome_aluno: str):
 
     
 @app.post("/atualizar-pagamento")
-async def atualizar_pagamento(payload: dict):
+def atualizar_pagamento(payload: dict):
     aluno_id = payload.get("id")
     mensalidade = payload.get("mensalidade")
     if aluno_id is None:
@@ -5198,6 +8097,7 @@ async def atualizar_pagamento(payload: dict):
     db.collection("alunos_professor").document(aluno_id).update({
         "mensalidade": mensalidade
     })
+    cache_vinculos.invalidar_documento(aluno_id)
     return JSONResponse({"status": "ok"})
 
 
@@ -5210,7 +8110,7 @@ class PagamentoMesProfIn(BaseModel):
     status: bool
 
 @app.get("/listar-pagamentos-prof")
-async def listar_pagamentos_prof():
+def listar_pagamentos_prof():
     try:
         docs = db.collection("alunos_professor").stream()
         professores_dict = {}
@@ -5224,9 +8124,7 @@ async def listar_pagamentos_prof():
                 pagamentos_list = []
                 nome_professor = ""
                 try:
-                    prof_ref = db.collection("professores_online") \
-                        .where(filter=FieldFilter("email", "==", prof_email.strip().lower())) \
-                        .limit(1).stream()
+                    prof_ref = repositorio_professores.todos_por_email(prof_email)[:1]
                     
                     for prof_doc in prof_ref:
                         professor_data = prof_doc.to_dict() or {}
@@ -5278,7 +8176,7 @@ async def listar_pagamentos_prof():
         
         
 @app.get("/ver-pagamentos", response_class=HTMLResponse)
-async def ver_pagamentos(request: Request, professor: str):
+def ver_pagamentos(request: Request, professor: str):
     """
     Exibe os registros da coluna pagamentos de um professor específico
     usando o email do professor como filtro.
@@ -5287,9 +8185,7 @@ async def ver_pagamentos(request: Request, professor: str):
         professores_data = []
         
         # Busca apenas o professor específico pelo email (corrigido)
-        doc_ref = db.collection("professores_online") \
-                    .where("email", "==", professor.strip().lower()) \
-                    .stream()
+        doc_ref = repositorio_professores.todos_por_email(professor)
         
         for doc in doc_ref:
             dados = doc.to_dict()
@@ -5323,11 +8219,12 @@ async def ver_pagamentos(request: Request, professor: str):
 
         
 @app.post("/atualizar-pagamento-mes-prof")
-async def atualizar_pagamento_mes_prof(item: PagamentoMesProfIn):
+def atualizar_pagamento_mes_prof(item: PagamentoMesProfIn):
     try:
         db.collection("alunos_professor").document(item.id).update({
             item.campo: item.status
         })
+        cache_vinculos.invalidar_documento(item.id)
         return {"message": "Pagamento mensal atualizado com sucesso"}
     except Exception as e:
         return JSONResponse(status_code=500, content={"detail": str(e)})
@@ -5338,7 +8235,7 @@ class AtualizarPagamentoProfIn(BaseModel):
     professor: str  # email do professor
 
 @app.post("/atualizar-pagamento-prof")
-async def atualizar_pagamento_prof(item: AtualizarPagamentoProfIn):
+def atualizar_pagamento_prof(item: AtualizarPagamentoProfIn):
     """
     Atualiza o pagamento do professor:
     - Busca saldo_atual em professores_online e usa como valor_pago.
@@ -5364,6 +8261,7 @@ async def atualizar_pagamento_prof(item: AtualizarPagamentoProfIn):
 
         # Marcar mês como pago
         doc_ref.update({mes_atualizado: True})
+        cache_vinculos.invalidar(dados.get("aluno"))
 
         # Nome do mês
         mes_num = int(mes_atualizado.replace("mensapro", ""))
@@ -5379,9 +8277,7 @@ async def atualizar_pagamento_prof(item: AtualizarPagamentoProfIn):
 
         # Buscar professor no professores_online e pegar saldo_atual
         professor_email = item.professor.strip().lower()
-        prof_ref = db.collection("professores_online") \
-            .where(filter=FieldFilter("email", "==", professor_email)) \
-            .limit(1).stream()
+        prof_ref = repositorio_professores.todos_por_email(professor_email, fresco=True)[:1]
 
         valor_pago = 0
         prof_id = None
@@ -5408,6 +8304,7 @@ async def atualizar_pagamento_prof(item: AtualizarPagamentoProfIn):
             },
             "salario.saldo_atual": 0
         })
+        repositorio_professores.invalidar(professor_email)
 
         # Registrar na coleção pagamentos
         db.collection("pagamentos").add({
@@ -5447,7 +8344,7 @@ class VendaItem(BaseModel):
     quantidade: int
 
 @app.get("/ajustar-progresso-ingles")
-async def ajustar_progresso_ingles():
+def ajustar_progresso_ingles():
     alunos_ref = db.collection("alunos").stream()
     count = 0
 
@@ -5477,7 +8374,7 @@ async def info_pagamentos(request: Request):
     return templates.TemplateResponse("info_pagamentos.html", {"request": request})
 
 @app.post("/desvincular-aluno")
-async def desvincular_aluno(data: dict):
+def desvincular_aluno(data: dict):
     try:
         professor = data.get("professor", "").strip().lower()
         aluno_nome_input = data.get("aluno", "").strip().lower()
@@ -5498,22 +8395,25 @@ async def desvincular_aluno(data: dict):
         for doc in query:
             db.collection("alunos_professor").document(doc.id).delete()
             removed = True
+        cache_vinculos.invalidar(aluno_nome_input)
+
+        # a sala 100ms pré-criada do vínculo deixa de ser usada
+        if removed:
+            try:
+                gestor_salas_100ms.descartar(professor, aluno_nome_input)
+            except Exception as e:
+                print("⚠️ Erro ao descartar sala do vínculo:", e)
 
         # 2️⃣ Buscar aluno na coleção alunos pelo nome normalizado
-        alunos = db.collection("alunos").stream()
-        aluno_doc = None
-        for doc in alunos:
-            dados = doc.to_dict()
-            nome_banco = dados.get("nome", "").strip().lower()
-            if nome_banco == aluno_nome_input:
-                aluno_doc = doc
-                break
+        aluno_doc = buscar_aluno_por_nome(aluno_nome_input)
 
         # 3️⃣ Atualizar campo "vinculado" = False
         if aluno_doc:
             db.collection("alunos").document(aluno_doc.id).update({
                 "vinculado": False
             })
+            antes = aluno_doc.to_dict()
+            registrar_transicao_aluno(antes, {**antes, "vinculado": False})
         else:
             print(f"⚠ Aluno '{aluno_nome_input}' não encontrado para atualizar vínculo.")
 
@@ -5533,87 +8433,199 @@ async def desvincular_aluno(data: dict):
 # ============================
 # CONFIG 100ms - DINÂMICA DE TROCA DE CONTA
 # ============================
-HMS_API_BASE = "https://api.100ms.live/v2"
+HMS_API_BASE = os.environ.get("HMS_API_BASE", "https://api.100ms.live/v2")
+HMS_TENTATIVAS = int(os.environ.get("HMS_TENTATIVAS", "4"))
+HMS_ESPERA_INICIAL = float(os.environ.get("HMS_ESPERA_INICIAL", "0.15"))  # segundos
 
-# ============================
-# SCHEMA DA REQUISIÇÃO
-# ============================
-class CreateRoomRequest(BaseModel):
-    name: str
+# tokens de management: válidos 1 hora, renovados 5 minutos antes
+HMS_TOKEN_VALIDADE = 3600
+HMS_TOKEN_RENOVAR_ANTES = 300
 
-# ============================
-# BUSCA CONTA ATIVA
-# ============================
-async def get_current_account():
-    doc = db.collection("CONTAS_100MS").document("contador").get()
-    data = doc.to_dict()
 
-    # garante que todas as chaves do 'usos' são strings
-    usos = {str(k): v for k, v in data["usos"].items()}
+class ErroGateway100ms(Exception):
+    def __init__(self, status_code: int, texto: str):
+        super().__init__(f"{status_code} - {texto}")
+        self.status_code = status_code
+        self.texto = texto
 
-    return data["conta_atual"], usos
 
+class Gateway100ms:
+    """
+    Cliente único da API de management do 100ms:
+    - um httpx.AsyncClient com ligações keep-alive partilhado por todas as rotas
+    - token de management em cache por conta, renovado antes de expirar
+    - novas tentativas com backoff exponencial (erros de rede, 429, 5xx)
+    - métricas de latência por operação
+    """
 
-async def rotate_account():
-    ref = db.collection("CONTAS_100MS").document("contador")
-    doc = ref.get().to_dict()
+    def __init__(self, base_url: str = HMS_API_BASE, tentativas: int = HMS_TENTATIVAS,
+                 espera_inicial: float = HMS_ESPERA_INICIAL):
+        self.base_url = base_url
+        self.tentativas = max(1, tentativas)
+        self.espera_inicial = espera_inicial
+        self._client = None
+        self._tokens = {}    # conta -> (token, expira_em)
+        self._metricas = {}  # operação -> contadores
+
+    def _cliente(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                timeout=httpx.Timeout(15.0, connect=5.0),
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            )
+        return self._client
 
-    conta = doc["conta_atual"]
-    usos = {str(k): v for k, v in doc["usos"].items()}  # converte chaves para string
+    async def fechar(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
 
-    conta_str = str(conta)
-    if usos.get(conta_str, 0) >= 50:  
-        conta = (conta + 1) % len(CONTAS_100MS)
-        conta_str = str(conta)
-        usos[conta_str] = 0  # reset da nova conta
+    # ---------- tokens ----------
+    def token(self, conta_atual: int) -> str:
+        agora = time.time()
+        em_cache = self._tokens.get(conta_atual)
+        if em_cache and em_cache[1] - agora > HMS_TOKEN_RENOVAR_ANTES:
+            return em_cache[0]
 
-    ref.update({
-        "conta_atual": conta,
-        "usos": usos
-    })
-    return conta
+        conta = CONTAS_100MS[conta_atual]
+        payload = {
+            "iat": int(agora),
+            "exp": int(agora) + HMS_TOKEN_VALIDADE,
+            "access_key": conta["ACCESS_KEY"],
+            "type": "management",
+            "jti": str(uuid.uuid4()),
+        }
+        token = jwt.encode(payload, conta["SECRET"], algorithm="HS256")
+        self._tokens[conta_atual] = (token, agora + HMS_TOKEN_VALIDADE)
+        return token
 
+    def headers(self, conta_atual: int) -> dict:
+        return {
+            "Authorization": f"Bearer {self.token(conta_atual)}",
+            "Content-Type": "application/json",
+        }
 
-async def incrementar_uso():
-    ref = db.collection("CONTAS_100MS").document("contador")
-    doc = ref.get().to_dict()
+    # ---------- métricas ----------
+    def _registar(self, operacao: str, duracao_ms: float, tentativas: int, erro: bool):
+        m = self._metricas.setdefault(operacao, {
+            "chamadas": 0, "erros": 0, "novas_tentativas": 0,
+            "total_ms": 0.0, "max_ms": 0.0, "ultima_ms": 0.0
+        })
+        m["chamadas"] += 1
+        m["erros"] += int(erro)
+        m["novas_tentativas"] += tentativas - 1
+        m["total_ms"] += duracao_ms
+        m["max_ms"] = max(m["max_ms"], duracao_ms)
+        m["ultima_ms"] = duracao_ms
+        metricas_rotas.registrar_externo("100ms", duracao_ms / 1000)
+
+    def metricas(self) -> dict:
+        return {
+            operacao: {
+                **m,
+                "media_ms": round(m["total_ms"] / m["chamadas"], 1) if m["chamadas"] else 0.0,
+                "total_ms": round(m["total_ms"], 1),
+                "max_ms": round(m["max_ms"], 1),
+                "ultima_ms": round(m["ultima_ms"], 1),
+            }
+            for operacao, m in self._metricas.items()
+        }
+
+    # ---------- pedidos ----------
+    async def _post(self, operacao: str, conta_atual: int, caminho: str, corpo: dict,
+                    repetir_status: tuple = ()) -> dict:
+        """
+        POST com novas tentativas. 'repetir_status' acrescenta códigos que devem
+        ser repetidos nesta operação (ex.: 404 enquanto a sala acabada de criar
+        ainda não é visível para o endpoint de room-codes).
+        """
+        inicio = time.perf_counter()
+        tentativa = 0
+        sucesso = False
+        erro = None
+
+        try:
+            while tentativa < self.tentativas:
+                tentativa += 1
+                try:
+                    r = await self._cliente().post(caminho, json=corpo, headers=self.headers(conta_atual))
+                except httpx.TransportError as e:
+                    erro = ErroGateway100ms(503, f"Falha de rede: {e}")
+                else:
+                    print(f"📡 [100ms {caminho}] STATUS: {r.status_code} | TENTATIVA: {tentativa}")
+
+                    if r.status_code < 400:
+                        sucesso = True
+                        return r.json()
+
+                    erro = ErroGateway100ms(r.status_code, r.text)
+
+                    if r.status_code == 401:
+                        # token rejeitado: descarta o da cache e tenta com um novo
+                        self._tokens.pop(conta_atual, None)
+                    elif r.status_code != 429 and r.status_code < 500 and r.status_code not in repetir_status:
+                        break
+
+                if tentativa < self.tentativas:
+                    await asyncio.sleep(self.espera_inicial * (2 ** (tentativa - 1)))
+
+            raise erro
+        finally:
+            self._registar(operacao, (time.perf_counter() - inicio) * 1000, tentativa, not sucesso)
+
+    async def criar_sala(self, conta_atual: int, nome: str, template_id: str) -> dict:
+        return await self._post(
+            "criar_sala", conta_atual, "/rooms",
+            {"name": nome, "template_id": template_id}
+        )
+
+    async def criar_codigos(self, conta_atual: int, room_id: str, roles: list) -> dict:
+        return await self._post(
+            "criar_codigos", conta_atual, f"/room-codes/room/{room_id}",
+            {"roles": roles},
+            repetir_status=(404,)
+        )
+
+
+gateway_100ms = Gateway100ms()
 
-    conta = doc["conta_atual"]
-    usos = {str(k): v for k, v in doc["usos"].items()} 
-    
-    conta_str = str(conta)
-    usos[conta_str] = usos.get(conta_str, 0) + 1  
-    
-    ref.update({"usos": usos})
-    await rotate_account()
 
+@app.on_event("shutdown")
+async def fechar_gateway_100ms():
+    await gateway_100ms.fechar()
+
+
+@app.get("/status-gateway-100ms")
+async def status_gateway_100ms():
+    return {
+        "api": gateway_100ms.base_url,
+        "tokens_em_cache": len(gateway_100ms._tokens),
+        "operacoes": gateway_100ms.metricas()
+    }
 
 # ============================
-# GERA TOKEN 100ms (com permissão de management)
+# SCHEMA DA REQUISIÇÃO
 # ============================
-async def generate_100ms_token():
-    conta_atual, _ = await get_current_account()
-    conta = CONTAS_100MS[conta_atual]
+class CreateRoomRequest(BaseModel):
+    name: str
 
-    payload = {
-        "iat": int(time.time()),
-        "exp": int(time.time()) + 3600,  # válido por 1 hora
-        "access_key": conta["ACCESS_KEY"],
-        "type": "management",  
-        "jti": str(uuid.uuid4()),
-    }
-    return jwt.encode(payload, conta["SECRET"], algorithm="HS256")
+# ============================
+# GERA TOKEN 100ms (com permissão de management)
+# ============================
+async def generate_100ms_token(conta_atual: Optional[int] = None):
+    if conta_atual is None:
+        conta_atual = await alocador_100ms.conta_atual()
+    return gateway_100ms.token(conta_atual)
 
 
 # ============================
 # RETORNA HEADERS COM CONTA ATIVA
 # ============================
-async def get_headers():
-    token = await generate_100ms_token()
-    return {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json",
-    }
+async def get_headers(conta_atual: Optional[int] = None):
+    if conta_atual is None:
+        conta_atual = await alocador_100ms.conta_atual()
+    return gateway_100ms.headers(conta_atual)
 
 # ============================
 # Normaliza nome da sala
@@ -5628,78 +8640,355 @@ def normalize_room_name(name: str):
 # ============================
 @app.post("/create-room")
 async def create_room(req: CreateRoomRequest):
-    import asyncio
-    async with httpx.AsyncClient(timeout=30.0) as client:
-        normalized_name = normalize_room_name(req.name)
-        print(f"🟦 Criando sala com nome normalizado: {normalized_name}")
+    normalized_name = normalize_room_name(req.name)
+    print(f"🟦 Criando sala com nome normalizado: {normalized_name}")
 
-        # 🔹 Busca conta ativa
-        conta_atual, _ = await get_current_account()
-        conta = CONTAS_100MS[conta_atual]
-        template_id = conta["TEMPLATE"]
-        subdomain = conta["SUBDOMAIN"]
+    # 🔹 Reserva um uso da conta ativa (única operação no contador)
+    conta_atual = await get_account_and_increment()
+    conta = CONTAS_100MS[conta_atual]
+    template_id = conta["TEMPLATE"]
+    subdomain = conta["SUBDOMAIN"]
 
-        body = {"name": normalized_name, "template_id": template_id}
+    # ====== Criação da sala ======
+    try:
+        room = await gateway_100ms.criar_sala(conta_atual, normalized_name, template_id)
+    except ErroGateway100ms as e:
+        raise HTTPException(status_code=500, detail=f"Erro ao criar sala: {e.status_code} - {e.texto}")
 
-        # ====== Criação da sala ======
-        headers = await get_headers()
-        r = await client.post(f"{HMS_API_BASE}/rooms", json=body, headers=headers)
-        print(f"📡 [100ms /rooms] STATUS: {r.status_code} | RESPOSTA: {r.text}")
+    room_id = room.get("id")
+    if not room_id:
+        raise HTTPException(status_code=500, detail="⚠️ Sala criada, mas sem ID retornado.")
 
-        if r.status_code >= 400:
-            raise HTTPException(status_code=500, detail=f"Erro ao criar sala: {r.status_code} - {r.text}")
+    print(f"✅ Sala criada com ID: {room_id}")
 
-        room = r.json()
-        room_id = room.get("id")
-        if not room_id:
-            raise HTTPException(status_code=500, detail="⚠️ Sala criada, mas sem ID retornado.")
+    # ====== Criação dos códigos (room-codes) ======
+    # sem espera fixa: o gateway repete com backoff se a sala ainda não estiver visível
+    try:
+        data_codes = await gateway_100ms.criar_codigos(conta_atual, room_id, ["host", "guest"])
+    except ErroGateway100ms as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Erro ao gerar room codes: {e.status_code} - {e.texto}"
+        )
 
-        print(f"✅ Sala criada com ID: {room_id}")
+    codes = data_codes.get("data", [])
+    if not codes:
+        raise HTTPException(status_code=500, detail=f"⚠️ Nenhum room code retornado: {data_codes}")
 
-        await asyncio.sleep(1)
+    role_map = {c.get("role"): c.get("code") for c in codes}
+    room_code_host = role_map.get("host")
+    room_code_guest = role_map.get("guest")
 
-        # ====== Criação dos códigos (room-codes) ======
-        body_codes = {"roles": ["host", "guest"]}
-        r2 = await client.post(
-            f"{HMS_API_BASE}/room-codes/room/{room_id}",
-            json=body_codes,
-            headers=headers,
-        )
-        print(f"📡 [100ms /room-codes/room/{room_id}] STATUS: {r2.status_code} | BODY ENVIADO: {body_codes} | RESPOSTA: {r2.text}")
+    if not room_code_host or not room_code_guest:
+        raise HTTPException(status_code=500, detail=f"⚠️ Room codes ausentes: {data_codes}")
 
-        if r2.status_code >= 400:
-            raise HTTPException(
-                status_code=500,
-                detail=f"Erro ao gerar room codes: {r2.status_code} - {r2.text}"
-            )
+    print(f"✅ Room codes criados com sucesso → Host={room_code_host}, Guest={room_code_guest}")
+
+    return {
+        "room_id": room_id,
+        "room_code_host": room_code_host,
+        "room_code_guest": room_code_guest,
+        "prebuilt_links": {
+            "host": f"https://{subdomain}.app.100ms.live/meeting/{room_code_host}",
+            "guest": f"https://{subdomain}.app.100ms.live/meeting/{room_code_guest}",
+        },
+        "conta_usada": conta_atual  # ✅ retorna qual conta foi usada
+    }
+
+# ============================
+# 🔹 POOL DE SALAS 100ms POR VÍNCULO
+# ============================
+# Cada vínculo professor–aluno tem uma sala 100ms (com os room codes host/guest)
+# criada antecipadamente e reutilizada em todas as aulas. Iniciar uma aula lê a
+# sala do pool, sem chamadas à API do 100ms; uma tarefa de fundo cria as salas
+# em falta para vínculos novos. Apontando HMS_API_BASE para um stub local, todo
+# o fluxo pode ser testado sem a API real.
+#
+# Com vários workers, cada sala é reservada no Firestore (estado "provisionando")
+# antes de qualquer chamada ao 100ms, e só o worker com a liderança do pool
+# (documento em 'configuracoes', renovado a cada ciclo) percorre os vínculos.
+SALAS_100MS = "salas_100ms"
+SALAS_INTERVALO = int(os.environ.get("SALAS_INTERVALO", "300"))      # segundos entre reabastecimentos
+SALAS_CONCORRENCIA = int(os.environ.get("SALAS_CONCORRENCIA", "4"))  # criações em paralelo
+SALAS_RESERVA_PRAZO = int(os.environ.get("SALAS_RESERVA_PRAZO", "120"))  # reserva abandonada após N s
+SALAS_ESPERA = 0.5  # segundos entre leituras enquanto outro worker cria a sala
+SALAS_LIDER_DOC = ("configuracoes", "salas_100ms_lider")
 
-        data_codes = r2.json()
-        codes = data_codes.get("data", [])
-        if not codes:
-            raise HTTPException(status_code=500, detail=f"⚠️ Nenhum room code retornado: {data_codes}")
 
-        role_map = {c.get("role"): c.get("code") for c in codes}
-        room_code_host = role_map.get("host")
-        room_code_guest = role_map.get("guest")
+def _id_sala(professor: str, aluno: str) -> str:
+    return quote(f"{professor}|{aluno}", safe="")
 
-        if not room_code_host or not room_code_guest:
-            raise HTTPException(status_code=500, detail=f"⚠️ Room codes ausentes: {data_codes}")
 
-        print(f"✅ Room codes criados com sucesso → Host={room_code_host}, Guest={room_code_guest}")
+def _sala_pronta(dados: Optional[dict]) -> bool:
+    return bool(dados and dados.get("room_id"))
 
-        # ====== Incrementa uso da conta ativa ======
-        await incrementar_uso()
 
-        return {
+def _reserva_ativa(dados: dict) -> bool:
+    reservada_em = dados.get("reservada_em")
+    return bool(reservada_em) and \
+        datetime.now(timezone.utc) - reservada_em < timedelta(seconds=SALAS_RESERVA_PRAZO)
+
+
+def _reservar_sala(transaction, ref, professor: str, aluno: str, reserva: str) -> tuple:
+    """
+    ("pronta", sala) se já existir; ("ocupada", None) se outro worker a estiver
+    a criar; ("reservada", None) se a criação ficou para quem chamou.
+    """
+    doc = ref.get(transaction=transaction)
+    dados = doc.to_dict() if doc.exists else None
+    if _sala_pronta(dados):
+        return "pronta", dados
+    if dados and _reserva_ativa(dados):
+        return "ocupada", None
+
+    transaction.set(ref, {
+        "estado": "provisionando",
+        "professor": professor,
+        "aluno": aluno,
+        "reserva": reserva,
+        "reservada_em": datetime.now(timezone.utc)
+    })
+    return "reservada", None
+
+
+def _libertar_sala(transaction, ref, reserva: str):
+    """Apaga a reserva depois de uma criação falhada, se ainda for nossa."""
+    doc = ref.get(transaction=transaction)
+    if doc.exists and (doc.to_dict() or {}).get("reserva") == reserva:
+        transaction.delete(ref)
+
+
+def _assumir_lideranca_salas(transaction, ref, dono: str) -> bool:
+    doc = ref.get(transaction=transaction)
+    dados = doc.to_dict() if doc.exists else {}
+    agora = datetime.now(timezone.utc)
+    if dados.get("dono") not in (None, dono) and dados.get("ate") and dados["ate"] > agora:
+        return False
+
+    # dura dois ciclos: um ciclo atrasado não passa a liderança a outro worker
+    transaction.set(ref, {"dono": dono, "ate": agora + timedelta(seconds=2 * SALAS_INTERVALO)})
+    return True
+
+
+class GestorSalas100ms:
+
+    def __init__(self, gateway: Gateway100ms):
+        self.gateway = gateway
+        self._salas = {}       # (professor, aluno) -> dados da sala
+        self._em_curso = {}    # (professor, aluno) -> asyncio.Task de provisionamento
+        self._tarefa = None
+        self._id_worker = uuid.uuid4().hex
+
+    @staticmethod
+    def _chave(professor: str, aluno: str) -> tuple:
+        return professor.strip().lower(), aluno.strip().lower()
+
+    async def obter(self, professor: str, aluno: str) -> Optional[dict]:
+        """Sala pronta do vínculo (memória → Firestore); None se ainda não existir."""
+        chave = self._chave(professor, aluno)
+        sala = self._salas.get(chave)
+        if sala:
+            return sala
+
+        doc = await em_thread(db.collection(SALAS_100MS).document(_id_sala(*chave)).get)
+        sala = doc.to_dict() if doc.exists else None
+        if _sala_pronta(sala):
+            self._salas[chave] = sala
+            return sala
+        return None
+
+    async def obter_ou_criar(self, professor: str, aluno: str) -> dict:
+        sala = await self.obter(professor, aluno)
+        if sala:
+            return sala
+        return await self.provisionar(professor, aluno)
+
+    async def provisionar(self, professor: str, aluno: str) -> dict:
+        """Cria a sala do vínculo; pedidos simultâneos para o mesmo vínculo partilham a criação."""
+        chave = self._chave(professor, aluno)
+        tarefa = self._em_curso.get(chave)
+        if tarefa is None:
+            tarefa = asyncio.ensure_future(self._criar(*chave))
+            self._em_curso[chave] = tarefa
+            tarefa.add_done_callback(lambda _: self._em_curso.pop(chave, None))
+        return await asyncio.shield(tarefa)
+
+    async def _criar(self, professor: str, aluno: str) -> dict:
+        ref = db.collection(SALAS_100MS).document(_id_sala(professor, aluno))
+        reserva = uuid.uuid4().hex
+
+        # só quem reserva chama o 100ms; os outros esperam pela sala pronta
+        while True:
+            resultado, sala = await em_thread(_transacao, _reservar_sala, ref, professor, aluno, reserva)
+            if resultado == "pronta":
+                self._salas[(professor, aluno)] = sala
+                return sala
+            if resultado == "reservada":
+                break
+            await asyncio.sleep(SALAS_ESPERA)
+
+        try:
+            sala = await self._criar_no_100ms(professor, aluno)
+        except BaseException:
+            await em_thread(_transacao, _libertar_sala, ref, reserva)
+            raise
+
+        await em_thread(ref.set, sala)
+        self._salas[(professor, aluno)] = sala
+        print(f"🏫 Sala 100ms pronta para {professor} / {aluno}: {sala['room_id']}")
+        return sala
+
+    async def _criar_no_100ms(self, professor: str, aluno: str) -> dict:
+        conta_atual = await get_account_and_increment()
+        conta = CONTAS_100MS[conta_atual]
+
+        room = await self.gateway.criar_sala(
+            conta_atual, normalize_room_name(f"{professor}-{aluno}"), conta["TEMPLATE"]
+        )
+        room_id = room.get("id")
+        if not room_id:
+            raise ErroGateway100ms(500, "Sala criada, mas sem ID retornado.")
+
+        data_codes = await self.gateway.criar_codigos(conta_atual, room_id, ["host", "guest"])
+        role_map = {c.get("role"): c.get("code") for c in data_codes.get("data", [])}
+        if not role_map.get("host") or not role_map.get("guest"):
+            raise ErroGateway100ms(500, f"Room codes ausentes: {data_codes}")
+
+        subdomain = conta["SUBDOMAIN"]
+        sala = {
+            "professor": professor,
+            "aluno": aluno,
+            "conta": conta_atual,
             "room_id": room_id,
-            "room_code_host": room_code_host,
-            "room_code_guest": room_code_guest,
+            "room_code_host": role_map["host"],
+            "room_code_guest": role_map["guest"],
             "prebuilt_links": {
-                "host": f"https://{subdomain}.app.100ms.live/meeting/{room_code_host}",
-                "guest": f"https://{subdomain}.app.100ms.live/meeting/{room_code_guest}",
+                "host": f"https://{subdomain}.app.100ms.live/meeting/{role_map['host']}",
+                "guest": f"https://{subdomain}.app.100ms.live/meeting/{role_map['guest']}",
             },
-            "conta_usada": conta_atual  # ✅ retorna qual conta foi usada
+            "estado": "pronta",
+            "criada_em": datetime.now(timezone.utc).isoformat()
+        }
+        return sala
+
+    def descartar(self, professor: str, aluno: str):
+        """Chamado ao desvincular: a sala deixa de ser servida (pode correr em qualquer thread)."""
+        chave = self._chave(professor, aluno)
+        self._salas.pop(chave, None)
+        db.collection(SALAS_100MS).document(_id_sala(*chave)).delete()
+
+    # ---------- reabastecimento ----------
+    def _vinculos_sem_sala(self) -> list:
+        # salas prontas e reservas em curso ficam de fora; reservas abandonadas voltam à fila
+        existentes = {
+            doc.id for doc in db.collection(SALAS_100MS).select(["room_id", "reservada_em"]).stream()
+            if _sala_pronta(doc.to_dict()) or _reserva_ativa(doc.to_dict() or {})
         }
+        pares = set()
+        for doc in db.collection("alunos_professor").select(["professor", "aluno"]).stream():
+            dados = doc.to_dict() or {}
+            chave = self._chave(str(dados.get("professor") or ""), str(dados.get("aluno") or ""))
+            if all(chave) and _id_sala(*chave) not in existentes:
+                pares.add(chave)
+        return sorted(pares)
+
+    async def reabastecer(self) -> int:
+        pendentes = await em_thread(self._vinculos_sem_sala)
+        if not pendentes:
+            return 0
+
+        limite = asyncio.Semaphore(SALAS_CONCORRENCIA)
+
+        async def criar(par):
+            async with limite:
+                try:
+                    await self.provisionar(*par)
+                    return 1
+                except Exception as e:
+                    print(f"⚠️ Erro ao criar sala para {par}: {e}")
+                    return 0
+
+        criadas = sum(await asyncio.gather(*(criar(par) for par in pendentes)))
+        print(f"🏫 Pool de salas: {criadas}/{len(pendentes)} salas criadas")
+        return criadas
+
+    def _lider(self) -> bool:
+        ref = db.collection(SALAS_LIDER_DOC[0]).document(SALAS_LIDER_DOC[1])
+        return _transacao(_assumir_lideranca_salas, ref, self._id_worker)
+
+    async def _ciclo(self):
+        while True:
+            try:
+                # os outros workers só leem o documento da liderança
+                if await em_thread(self._lider):
+                    await self.reabastecer()
+            except Exception as e:
+                print("⚠️ Erro no reabastecimento de salas:", e)
+            await asyncio.sleep(SALAS_INTERVALO)
+
+    def iniciar(self):
+        if self._tarefa is None:
+            self._tarefa = asyncio.get_running_loop().create_task(self._ciclo())
+
+    def parar(self):
+        if self._tarefa is not None:
+            self._tarefa.cancel()
+            self._tarefa = None
+
+
+gestor_salas_100ms = GestorSalas100ms(gateway_100ms)
+
+
+@app.on_event("startup")
+async def iniciar_pool_salas():
+    if db is not None:
+        gestor_salas_100ms.iniciar()
+
+
+@app.on_event("shutdown")
+async def parar_pool_salas():
+    gestor_salas_100ms.parar()
+
+
+class SalaVinculoRequest(BaseModel):
+    professor: str
+    aluno: str
+
+
+@app.post("/sala-do-vinculo")
+async def sala_do_vinculo(req: SalaVinculoRequest):
+    """
+    Sala da aula para o vínculo: vem do pool (sem chamadas ao 100ms);
+    só se o vínculo ainda não tiver sala é criada na hora.
+    """
+    professor, aluno = GestorSalas100ms._chave(req.professor, req.aluno)
+    # só vínculos reais têm sala: pares inventados não gastam quota nem criam documentos
+    if await em_thread(cache_vinculos.do_par, professor, aluno) is None:
+        raise HTTPException(status_code=404, detail="Vínculo não encontrado")
+
+    try:
+        sala = await gestor_salas_100ms.obter_ou_criar(req.professor, req.aluno)
+    except ErroGateway100ms as e:
+        raise HTTPException(status_code=500, detail=f"Erro ao criar sala: {e.status_code} - {e.texto}")
+
+    return {
+        "room_id": sala["room_id"],
+        "room_code_host": sala["room_code_host"],
+        "room_code_guest": sala["room_code_guest"],
+        "prebuilt_links": sala["prebuilt_links"],
+        "conta_usada": sala["conta"]
+    }
+
+
+@app.post("/reabastecer-salas")
+async def reabastecer_salas(request: Request):
+    # cria salas reais (quota das contas 100ms): só o administrador, e só no worker líder
+    if not admin_autenticado(request):
+        return acesso_negado_admin()
+    if not await em_thread(gestor_salas_100ms._lider):
+        return JSONResponse(status_code=409, content={"detail": "O pool de salas é reabastecido por outro worker."})
+    criadas = await gestor_salas_100ms.reabastecer()
+    return {"status": "ok", "salas_criadas": criadas}
 
 # -------------------------
 # 3️⃣ PROFESSOR ENVIA room_code AO ALUNO
@@ -5740,13 +9029,138 @@ async def gerar_token(role: str, user_id: str, room_id: str):
 # ==============================
 from pydantic import BaseModel
 
-ALUNO_ROOM = {}
+# ============================
+# 🔹 SESSÕES DE AULA AO VIVO
+# ============================
+# Link da aula publicado pelo professor e lido pelo aluno. Substitui o antigo
+# dicionário ALUNO_ROOM (que só funcionava com um worker): o armazém é escolhido
+# por SESSOES_AULA_BACKEND ("firestore", partilhado entre workers, ou "memoria",
+# só para desenvolvimento com um worker) e cada entrada expira após o TTL.
+SESSOES_AULA_TTL = int(os.environ.get("SESSOES_AULA_TTL", "7200"))  # segundos
+SESSOES_AULA_COLECAO = "sessoes_aula"
+
+
+class ArmazemSessoesMemoria:
+    """Armazém local: TTL por entrada e avisos diretos aos assinantes do mesmo processo."""
+
+    def __init__(self):
+        self._sessoes = {}     # aluno -> (dados, expira_em)
+        self._assinantes = {}  # aluno -> set de callbacks
+        self._lock = threading.Lock()
+
+    def publicar(self, aluno: str, dados: dict, ttl: int = SESSOES_AULA_TTL):
+        with self._lock:
+            self._sessoes[aluno] = (dados, time.time() + ttl)
+            callbacks = list(self._assinantes.get(aluno, ()))
+        for callback in callbacks:
+            callback(dados)
+
+    def obter(self, aluno: str) -> Optional[dict]:
+        with self._lock:
+            entrada = self._sessoes.get(aluno)
+            if entrada is None:
+                return None
+            dados, expira_em = entrada
+            if time.time() >= expira_em:
+                del self._sessoes[aluno]
+                return None
+            return dados
+
+    def remover(self, aluno: str):
+        with self._lock:
+            self._sessoes.pop(aluno, None)
+
+    def assinar(self, aluno: str, callback):
+        """callback(dados) a cada publicação; devolve a função que cancela."""
+        with self._lock:
+            self._assinantes.setdefault(aluno, set()).add(callback)
+
+        def cancelar():
+            with self._lock:
+                callbacks = self._assinantes.get(aluno)
+                if callbacks is not None:
+                    callbacks.discard(callback)
+                    if not callbacks:
+                        del self._assinantes[aluno]
+        return cancelar
+
+
+class ArmazemSessoesFirestore:
+    """
+    Armazém partilhado: um documento por aluno em 'sessoes_aula' com 'expira_em'
+    (pode ser usado como campo de uma política TTL do Firestore; as leituras
+    ignoram entradas vencidas de qualquer forma). Os avisos chegam a todos os
+    workers através de on_snapshot no documento do aluno.
+    """
+
+    def _ref(self, aluno: str):
+        return db.collection(SESSOES_AULA_COLECAO).document(quote(aluno, safe=""))
+
+    @staticmethod
+    def _valida(dados: Optional[dict]) -> Optional[dict]:
+        if not dados:
+            return None
+        expira_em = dados.get("expira_em")
+        if expira_em is None or expira_em <= datetime.now(timezone.utc):
+            return None
+        return {k: v for k, v in dados.items() if k != "expira_em"}
+
+    def publicar(self, aluno: str, dados: dict, ttl: int = SESSOES_AULA_TTL):
+        self._ref(aluno).set({
+            **dados,
+            "expira_em": datetime.now(timezone.utc) + timedelta(seconds=ttl)
+        })
+
+    def obter(self, aluno: str) -> Optional[dict]:
+        doc = self._ref(aluno).get()
+        return self._valida(doc.to_dict()) if doc.exists else None
+
+    def remover(self, aluno: str):
+        self._ref(aluno).delete()
+
+    def assinar(self, aluno: str, callback):
+        def ao_mudar(docs, mudancas, lido_em):
+            for doc in docs:
+                dados = self._valida(doc.to_dict()) if doc.exists else None
+                if dados:
+                    callback(dados)
+
+        watch = self._ref(aluno).on_snapshot(ao_mudar)
+        return watch.unsubscribe
+
+
+def criar_armazem_sessoes():
+    backend = os.environ.get("SESSOES_AULA_BACKEND", "firestore" if db is not None else "memoria")
+    if backend == "memoria":
+        return ArmazemSessoesMemoria()
+    return ArmazemSessoesFirestore()
+
+
+sessoes_aula = criar_armazem_sessoes()
+
+
+def chave_sessao_aula(aluno: str) -> str:
+    return chave_aluno(aluno)
 
 class EnviarIdPayload(BaseModel):
     aluno: str
     professor: str
     room_id: str
     prebuilt_link: str   
+    conta: Optional[int] = None   # 'conta_usada' devolvida por /create-room ou /sala-do-vinculo
+
+
+async def conta_da_sala(payload: EnviarIdPayload) -> int:
+    """
+    Conta 100ms a que a sala pertence: a indicada pelo professor, a gravada na
+    sala do pool ou, para salas antigas sem registo, a conta ativa.
+    """
+    if payload.conta in range(len(CONTAS_100MS)):
+        return payload.conta
+    sala = await gestor_salas_100ms.obter(payload.professor, payload.aluno)
+    if sala and sala.get("room_id") == payload.room_id and sala.get("conta") in range(len(CONTAS_100MS)):
+        return sala["conta"]
+    return await alocador_100ms.conta_atual()
 
 
 # ===========================
@@ -5754,20 +9168,20 @@ class EnviarIdPayload(BaseModel):
 # ===========================
 @app.post("/enviar-id-aula")
 async def enviar_id_aula(payload: EnviarIdPayload):
-    aluno_norm = payload.aluno.strip().lower().replace(" ", "")
+    aluno_norm = chave_sessao_aula(payload.aluno)
     professor_norm = payload.professor.strip().lower().replace(" ", "")
 
-    # Buscar conta ativa para este envio
-    conta_atual, _ = await get_current_account()
+    # a sala pode ter sido criada noutra conta que não a ativa (pool de salas)
+    conta_atual = await conta_da_sala(payload)
     conta = CONTAS_100MS[conta_atual]
 
-    ALUNO_ROOM[aluno_norm] = {
+    await em_thread(sessoes_aula.publicar, aluno_norm, {
         "room_id": payload.room_id,
         "professor": professor_norm,
         "prebuilt_link": payload.prebuilt_link,  
         "subdomain": conta["SUBDOMAIN"],        
         "template_id": conta["TEMPLATE"]        
-    }
+    })
 
     return {
         "status": "ok",
@@ -5778,8 +9192,7 @@ async def enviar_id_aula(payload: EnviarIdPayload):
 
 @app.get("/buscar-id-professor")
 async def buscar_id_professor(aluno: str):
-    aluno_norm = aluno.strip().lower().replace(" ", "")
-    data = ALUNO_ROOM.get(aluno_norm)
+    data = await em_thread(sessoes_aula.obter, chave_sessao_aula(aluno))
 
     if not data:
         return {"room_id": None, "prebuilt_link": None}
@@ -5790,8 +9203,54 @@ async def buscar_id_professor(aluno: str):
     }
 
 
+@app.get("/aulas/stream/{aluno}")
+async def stream_aula(request: Request, aluno: str):
+    """
+    Server-Sent Events: o aluno fica à espera e recebe o link assim que o
+    professor o publica (em qualquer worker). Envia um único evento e termina.
+    """
+    aluno_norm = chave_sessao_aula(aluno)
+    loop = asyncio.get_running_loop()
+    fila = asyncio.Queue(maxsize=10)
+
+    def entregar(dados: dict):
+        try:
+            fila.put_nowait(dados)
+        except asyncio.QueueFull:
+            pass
+
+    def ao_publicar(dados: dict):
+        # chamado pelo armazém, possivelmente noutra thread
+        loop.call_soon_threadsafe(entregar, dados)
+
+    cancelar = await em_thread(sessoes_aula.assinar, aluno_norm, ao_publicar)
+
+    async def eventos():
+        try:
+            # link já publicado antes de o aluno abrir a página
+            dados = await em_thread(sessoes_aula.obter, aluno_norm)
+
+            while dados is None and not await request.is_disconnected():
+                try:
+                    dados = await asyncio.wait_for(fila.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+
+            if dados is not None:
+                evento = {"room_id": dados["room_id"], "prebuilt_link": dados["prebuilt_link"]}
+                yield f"data: {json.dumps(evento)}\n\n"
+        finally:
+            await em_thread(cancelar)
+
+    return StreamingResponse(
+        eventos(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @app.post("/registrar-aula")
-async def registrar_aula(data: dict = Body(...)):
+def registrar_aula(data: dict = Body(...)):
     try:
         professor = data.get("professor", "").strip().lower()
         aluno = data.get("aluno", "").strip().lower()
@@ -5801,13 +9260,8 @@ async def registrar_aula(data: dict = Body(...)):
 
         print(f"📘 Registrando aula de {aluno} com {professor}...")
 
-        # 🔹 Busca vínculo aluno-professor
-        query = db.collection("alunos_professor") \
-                  .where("professor", "==", professor) \
-                  .where("aluno", "==", aluno) \
-                  .limit(1).stream()
-
-        doc = next(query, None)
+        # 🔹 Busca vínculo aluno-professor (lido do Firestore: as aulas vão ser regravadas)
+        doc = cache_vinculos.do_par(professor, aluno, fresco=True)
         if not doc:
             raise HTTPException(status_code=404, detail="Vínculo não encontrado")
 
@@ -5857,23 +9311,16 @@ async def registrar_aula(data: dict = Body(...)):
             update_data["valor_passado"] = valor_passado
 
         doc_ref.update(update_data)
+        cache_vinculos.invalidar(aluno)
 
-        # 🔹 Atualiza saldo do professor
-        prof_ref = db.collection("professores_online") \
-                     .where(filter=FieldFilter("email", "==", professor)) \
-                     .limit(1).stream()
-
-        prof_doc = next(prof_ref, None)
+        # 🔹 Atualiza saldo do professor (incremento no servidor: não depende do saldo lido)
+        prof_doc = repositorio_professores.por_email(professor)
         if prof_doc:
             prof_doc_ref = db.collection("professores_online").document(prof_doc.id)
-            prof_data = prof_doc.to_dict() or {}
-            salario_info = prof_data.get("salario", {})
-
-            saldo_atual = int(salario_info.get("saldo_atual", 0)) + valor_mensal
-
             prof_doc_ref.update({
-                "salario.saldo_atual": saldo_atual
+                "salario.saldo_atual": firestore.Increment(valor_mensal)
             })
+            repositorio_professores.invalidar(professor)
 
         print(f"✅ Aula registrada com sucesso.")
         return {
@@ -5887,7 +9334,7 @@ async def registrar_aula(data: dict = Body(...)):
 
 
 @app.get("/ajustar-professores-foto")
-async def ajustar_professores_foto():
+def ajustar_professores_foto():
     professores = db.collection("professores_online").stream()
     count = 0
 
@@ -5897,6 +9344,7 @@ async def ajustar_professores_foto():
             db.collection("professores_online").document(prof.id).update({
                 "foto_perfil": "perfil.png"
             })
+            repositorio_professores.invalidar(dados.get("email"))
             count += 1
 
     return {"status": "ok", "atualizados": count}
@@ -5928,68 +9376,67 @@ async def pagina_erro(
     )
     
 @app.get("/professores-disponiveis")
-async def professores_disponiveis():
+def professores_disponiveis(dia: Optional[str] = None, horario: Optional[str] = None):
     try:
-        # Horários padrão para comparar
-        horarios_padrao = [
-            "7:30 - 8:30",
-            "9:30 - 10:30",
-            "11:30 - 12:30",
-            "13:30 - 14:30",
-            "15:30 - 16:30",
-            "17:30 - 18:30",
-            "19:30 - 20:30"
-        ]
-
-        dias_semana = ["Seg", "Ter", "Qua", "Qui", "Sex", "Sáb", "Dom"]
+        # Filtro opcional: só professores com esta aula livre
+        mascara = 0
+        if dia and horario:
+            mascara = bit_aula(dia, horario)
+            if not mascara:
+                return JSONResponse(status_code=400, content={"detail": "Dia ou horário inválido."})
 
         resposta = []
 
-        # Buscar professores com horário incompleto
-        profs_query = db.collection("professores_online") \
-            .where("horario_completo", "==", False) \
-            .stream()
+        for email, livres in indice_disponibilidade.professores_com_vagas():
+            if livres & mascara != mascara:
+                continue
 
-        for prof_doc in profs_query:
-            prof_data = prof_doc.to_dict()
-            email = prof_data.get("email", "")
-            horario = prof_data.get("horario", {})
-            estado = prof_data.get("horario_estado", {})
+            # Só os dias que ainda têm aulas livres, com as aulas em falta
+            resposta.append({
+                "professor": email,
+                "dias_disponiveis": bits_para_horario(livres)
+            })
 
-            dias_disponiveis = {}
+        return resposta
 
-            # Verificar dias que estão marcados como "False"
-            for dia in dias_semana:
-                if estado.get(dia) is False:
+    except Exception as e:
+        print("🔴 Erro ao consultar professores disponíveis:", e)
+        return JSONResponse(status_code=500, content={"detail": str(e)})
 
-                    # Horários já preenchidos
-                    preenchidos = horario.get(dia, [])
 
-                    # Filtrar os horários que ainda não existem
-                    faltando = [h for h in horarios_padrao if h not in preenchidos]
+@app.get("/disponibilidade-comum/{aluno_nome}/{professor_email}")
+def disponibilidade_comum(aluno_nome: str, professor_email: str):
+    try:
+        livres = indice_disponibilidade.livres(professor_email)
+        if livres is None:
+            return JSONResponse(status_code=404, content={"detail": "Professor sem horário registado."})
 
-                    dias_disponiveis[dia] = faltando
+        aluno_doc = buscar_aluno_por_nome(aluno_nome)
+        if not aluno_doc:
+            return JSONResponse(status_code=404, content={"detail": "Aluno não encontrado."})
 
-            resposta.append({
-                "professor": email,
-                "dias_disponiveis": dias_disponiveis
-            })
+        bits_aluno = bits_do_documento(aluno_doc.to_dict()) or 0
+        comum = bits_aluno & livres
 
-        return resposta
+        return {
+            "aluno": aluno_nome,
+            "professor": professor_email.strip().lower(),
+            "aulas_comuns": bits_para_horario(comum),
+            "total_comum": bin(comum).count("1"),
+            "primeira_aula_comum": primeira_aula(comum)
+        }
 
     except Exception as e:
-        print("🔴 Erro ao consultar professores disponíveis:", e)
+        print("🔴 Erro ao calcular disponibilidade comum:", e)
         return JSONResponse(status_code=500, content={"detail": str(e)})
 
 @app.get("/buscar-professor-nome")
-async def buscar_professor_nome(email: str):
+def buscar_professor_nome(email: str):
     try:
         email_normalizado = email.strip().lower()
 
         # Busca professor pela coleção professores_online
-        query = db.collection("professores_online") \
-                  .where("email", "==", email_normalizado) \
-                  .limit(1).stream()
+        query = repositorio_professores.todos_por_email(email_normalizado)[:1]
 
         for doc in query:
             data = doc.to_dict()
@@ -6020,71 +9467,23 @@ async def buscar_professor_nome(email: str):
         
 
 @app.get("/estatisticas-dashboard")
-async def estatisticas_dashboard():
-    # =========================
-    # 📊 ALUNOS
-    # =========================
-    alunos_ref = db.collection("alunos").stream()
-
-    total_alunos = 0
-    alunos_online = 0
-    alunos_offline = 0
-    alunos_vinculados = 0
-    alunos_nao_vinculados = 0
-
-    for aluno in alunos_ref:
-        dados = aluno.to_dict()
-        total_alunos += 1
-
-        # Online / Offline
-        if dados.get("online") is True:
-            alunos_online += 1
-        else:
-            alunos_offline += 1
-
-        # Vinculado / Não vinculado
-        if dados.get("vinculado") is True:
-            alunos_vinculados += 1
-        else:
-            alunos_nao_vinculados += 1
-
-    # =========================
-    # 📊 PROFESSORES
-    # =========================
-    professores_ref = db.collection("professores_online").stream()
-
-    total_professores = 0
-    professores_online = 0
-    professores_offline = 0
-
-    for prof in professores_ref:
-        dados = prof.to_dict()
-        total_professores += 1
-
-        if dados.get("online") is True:
-            professores_online += 1
-        else:
-            professores_offline += 1
-
-    # =========================
-    # 📞 CHAMADAS AO VIVO
-    # =========================
-    chamadas_ref = db.collection("chamadas_ao_vivo").stream()
+def estatisticas_dashboard():
+    # Uma única leitura: os contadores são mantidos pelas rotas que mudam os estados
+    doc = _estatisticas_ref().get()
+    contadores = doc.to_dict() if doc.exists else None
 
-    chamadas_em_andamento = 0
-    chamadas_pendentes = 0
-    chamadas_recusadas = 0
+    # primeira execução (ou documento apagado): constrói os contadores
+    if not contadores:
+        contadores = reconciliar_estatisticas()
 
-    for chamada in chamadas_ref:
-        dados = chamada.to_dict()
-        status = dados.get("status", "").lower()
+    def valor(campo):
+        return max(0, int(contadores.get(campo, 0)))
 
-        if status == "aceito":
-            chamadas_em_andamento += 1
-        elif status == "pendente":
-            chamadas_pendentes += 1
-        elif status == "recusado":
-            chamadas_recusadas += 1
+    total_alunos = valor("alunos_total")
+    alunos_online = min(valor("alunos_online"), total_alunos)
+    alunos_vinculados = min(valor("alunos_vinculados"), total_alunos)
+    total_professores = valor("professores_total")
+    professores_online = min(valor("professores_online"), total_professores)
 
     # =========================
     # 📦 RESPOSTA FINAL
@@ -6093,41 +9492,30 @@ async def estatisticas_dashboard():
         "alunos": {
             "total": total_alunos,
             "online": alunos_online,
-            "offline": alunos_offline,
+            "offline": total_alunos - alunos_online,
             "vinculados": alunos_vinculados,
-            "nao_vinculados": alunos_nao_vinculados
+            "nao_vinculados": total_alunos - alunos_vinculados
         },
         "professores": {
             "total": total_professores,
             "online": professores_online,
-            "offline": professores_offline
+            "offline": total_professores - professores_online
         },
         "chamadas": {
-            "em_andamento": chamadas_em_andamento,
-            "pendentes": chamadas_pendentes,
-            "recusadas": chamadas_recusadas
+            "em_andamento": valor("chamadas_aceito"),
+            "pendentes": valor("chamadas_pendente"),
+            "recusadas": valor("chamadas_recusado")
         }
     })
 
 @app.get("/logout_aluno")
-async def logout_aluno(request: Request):
+def logout_aluno(request: Request):
     try:
         referer = request.headers.get("referer", "")
 
         if "/perfil/" in referer:
             nome = referer.split("/perfil/")[-1]
-            nome_normalizado = nome.strip().lower()
-
-            query = db.collection("alunos") \
-                .where("nome_normalizado", "==", nome_normalizado) \
-                .limit(1) \
-                .stream()
-
-            for doc in query:
-                doc.reference.update({
-                    "online": False
-                })
-                break
+            presenca.sair("aluno", chave_nome_aluno(unquote(nome)))
 
         return RedirectResponse("/login", status_code=303)
 
@@ -6169,7 +9557,7 @@ def editar_equipa(
 
 
 @app.post("/remover-professor")
-async def remover_professor(payload: dict = Body(...)):
+def remover_professor(payload: dict = Body(...)):
 
     email = payload.get("email")
 
@@ -6188,7 +9576,9 @@ async def remover_professor(payload: dict = Body(...)):
 
     for doc in docs:
         doc.reference.delete()
+        registrar_transicao_professor(doc.to_dict(), None)
         print(f"🗑️ Removido de professores_online: {doc.id}")
+    repositorio_professores.invalidar(email)
 
     # 🔥 SEMPRE sucesso
     return {
@@ -6197,7 +9587,7 @@ async def remover_professor(payload: dict = Body(...)):
     }
 
 @app.post("/remover-aluno")
-async def remover_aluno(payload: dict = Body(...)):
+def remover_aluno(payload: dict = Body(...)):
 
     nome = payload.get("nome")
 
@@ -6216,6 +9606,7 @@ async def remover_aluno(payload: dict = Body(...)):
 
     for doc in docs:
         doc.reference.delete()
+        registrar_transicao_aluno(doc.to_dict(), None)
         print(f"🗑️ Removido de alunos: {doc.id}")
 
     return {
@@ -6253,18 +9644,16 @@ async def recuperar_senha_get(request: Request, success: int = 0):
         )
 
 @app.post("/recuperar-senha")
-async def recuperar_senha_post(
+def recuperar_senha_post(
     request: Request,
     email: str = Form(...)
 ):
     try:
-        alunos_ref = db.collection("alunos")
-
         email_digitado = email.strip().lower()
 
-        alunos = alunos_ref.stream()
+        aluno = buscar_aluno_por_email(email_digitado)
 
-        for aluno in alunos:
+        if aluno:
             dados = aluno.to_dict() or {}
 
             email_banco = str(dados.get("email", "")).strip().lower()
@@ -6278,6 +9667,7 @@ async def recuperar_senha_post(
                     aluno.reference.update({
                         "reset_token": token
                     })
+                    indexar_aluno(aluno.id, {"reset_token": token})
                 except Exception as e:
                     print("Firebase erro:", e)
 
@@ -6346,19 +9736,17 @@ async def resetar_senha_get(request: Request, token: str = None):
         )
 
 @app.post("/resetar-senha")
-async def resetar_senha_post(
+def resetar_senha_post(
     request: Request,
     token: str = Form(...),
     nova_senha: str = Form(...)
 ):
     try:
-        alunos_ref = db.collection("alunos")
-
         nova_senha = nova_senha.strip()
 
-        alunos = alunos_ref.stream()
+        aluno = buscar_aluno_por_token(token)
 
-        for aluno in alunos:
+        if aluno:
             dados = aluno.to_dict() or {}
 
             if dados.get("reset_token") == token:
@@ -6368,6 +9756,7 @@ async def resetar_senha_post(
                         "senha": nova_senha,
                         "reset_token": None
                     })
+                    remover_indice_aluno("token", token)
                 except Exception as e:
                     print("Firebase erro:", e)
 
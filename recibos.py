@@ -0,0 +1,262 @@
+"""
+Geração dos recibos de pagamento (PDF) fora do processo da API.
+
+Este módulo corre dentro dos processos do pool criado em main.py e não
+importa nada de main.py (os workers arrancam com "spawn"). O initializer
+carrega uma vez por processo os estilos e o logotipo já reduzido; cada
+recibo só monta as tabelas e escreve o ficheiro.
+"""
+
+import io
+import os
+
+from reportlab.lib import colors
+from reportlab.lib.enums import TA_CENTER
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.platypus import (
+    SimpleDocTemplate,
+    Paragraph,
+    Spacer,
+    Table,
+    TableStyle,
+    Image
+)
+
+CAMINHO_LOGO = "static/Logo Sabapp Facturas.png"
+
+# tamanho do logotipo no recibo (pontos) e fator de resolução da cópia reduzida
+LOGO_LARGURA = 130
+LOGO_ALTURA = 55
+LOGO_ESCALA = 3
+
+# preenchidos por inicializar_worker() em cada processo
+_estilos = {}
+_logo_png = None
+
+
+# ============================
+# 🔹 INICIALIZAÇÃO DO WORKER
+# ============================
+def _reduzir_logo(caminho: str) -> bytes:
+    """Lê o PNG original (~1 MB) uma vez e guarda uma cópia pequena em memória."""
+    from PIL import Image as PILImage
+
+    with PILImage.open(caminho) as original:
+        original.thumbnail((LOGO_LARGURA * LOGO_ESCALA, LOGO_ALTURA * LOGO_ESCALA))
+        saida = io.BytesIO()
+        original.save(saida, format="PNG", optimize=True)
+        return saida.getvalue()
+
+
+def inicializar_worker(caminho_logo: str = CAMINHO_LOGO):
+    global _logo_png
+
+    _estilos["centralizado"] = ParagraphStyle(
+        "centralizado",
+        alignment=TA_CENTER,
+        fontName="Helvetica",
+        fontSize=10,
+        leading=15
+    )
+
+    _estilos["titulo"] = ParagraphStyle(
+        "titulo",
+        alignment=TA_CENTER,
+        fontName="Helvetica-Bold",
+        fontSize=16,
+        leading=20,
+        textColor=colors.HexColor("#0b2c5f")
+    )
+
+    _estilos["subtitulo"] = ParagraphStyle(
+        "subtitulo",
+        alignment=TA_CENTER,
+        fontName="Helvetica",
+        fontSize=9,
+        textColor=colors.grey
+    )
+
+    _estilos["faixa"] = TableStyle([
+        ("BACKGROUND", (0, 0), (-1, -1), colors.HexColor("#0b2c5f")),
+        ("TEXTCOLOR", (0, 0), (-1, -1), colors.white),
+        ("FONTNAME", (0, 0), (-1, -1), "Helvetica-Bold"),
+        ("FONTSIZE", (0, 0), (-1, -1), 9),
+        ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+        ("TOPPADDING", (0, 0), (-1, -1), 6),
+    ])
+
+    _estilos["dados"] = TableStyle([
+        ("BACKGROUND", (0, 0), (-1, -1), colors.HexColor("#f7f7f7")),
+        ("GRID", (0, 0), (-1, -1), 0.4, colors.lightgrey),
+        ("FONTNAME", (0, 0), (0, -1), "Helvetica-Bold"),
+        ("FONTNAME", (1, 0), (1, -1), "Helvetica"),
+        ("FONTSIZE", (0, 0), (-1, -1), 8.5),
+        ("BOTTOMPADDING", (0, 0), (-1, -1), 6),
+        ("TOPPADDING", (0, 0), (-1, -1), 6),
+    ])
+
+    _estilos["cabecalho"] = TableStyle([
+        ("BACKGROUND", (0, 0), (-1, -1), colors.HexColor("#f2f2f2")),
+        ("GRID", (0, 0), (-1, -1), 0.5, colors.lightgrey),
+        ("FONTNAME", (0, 0), (0, -1), "Helvetica-Bold"),
+        ("FONTNAME", (1, 0), (1, -1), "Helvetica"),
+        ("FONTSIZE", (0, 0), (-1, -1), 9),
+        ("BOTTOMPADDING", (0, 0), (-1, -1), 8),
+        ("TOPPADDING", (0, 0), (-1, -1), 8),
+    ])
+
+    try:
+        _logo_png = _reduzir_logo(caminho_logo)
+    except Exception as e:
+        _logo_png = None
+        print("Erro ao carregar logotipo:", e)
+
+
+def aquecer() -> int:
+    """Tarefa vazia usada no arranque para criar os processos antes do primeiro recibo."""
+    return os.getpid()
+
+
+# ============================
+# 🔹 RECIBO
+# ============================
+def _faixa(texto: str) -> Table:
+    tabela = Table([[texto]], colWidths=[480])
+    tabela.setStyle(_estilos["faixa"])
+    return tabela
+
+
+def _tabela_dados(linhas: list) -> Table:
+    tabela = Table(linhas, colWidths=[150, 330])
+    tabela.setStyle(_estilos["dados"])
+    return tabela
+
+
+def gerar_recibo(pdf_path: str, dados: dict) -> str:
+    """
+    Escreve o recibo em pdf_path e devolve o caminho.
+    'dados' traz os valores já calculados pela rota (nada de Firestore aqui).
+    """
+    if not _estilos:
+        inicializar_worker()
+
+    # escreve num temporário para nunca servir um PDF a meio
+    temporario = f"{pdf_path}.tmp"
+
+    doc = SimpleDocTemplate(
+        temporario,
+        pagesize=A4,
+        topMargin=18,
+        bottomMargin=18,
+        leftMargin=18,
+        rightMargin=18
+    )
+
+    elementos = []
+
+    # =====================================
+    # LOGOTIPO
+    # =====================================
+
+    if _logo_png:
+        logo = Image(io.BytesIO(_logo_png), width=LOGO_LARGURA, height=LOGO_ALTURA)
+        logo.hAlign = "CENTER"
+        elementos.append(logo)
+
+    elementos.append(Spacer(1, 8))
+
+    # =====================================
+    # EMPRESA
+    # =====================================
+
+    elementos.append(Paragraph(
+        """
+        <b>SABI LÍDER - COMÉRCIO E PRESTAÇÃO
+        DE SERVIÇOS (SU) LDA</b>
+        <br/>
+        NIF: 5002232529
+        """,
+        _estilos["titulo"]
+    ))
+
+    elementos.append(Spacer(1, 10))
+
+    elementos.append(Paragraph(
+        """
+        <b>RECIBO DE PAGAMENTO</b>
+        """,
+        _estilos["centralizado"]
+    ))
+
+    elementos.append(Spacer(1, 18))
+
+    # =====================================
+    # CABEÇALHO ESTILO BANCÁRIO
+    # =====================================
+
+    cabecalho = Table(
+        [
+            ["Número do Recibo:", dados["numero_recibo"]],
+            ["Data:", dados["data_pagamento"]],
+            ["Hora:", dados["hora_pagamento"]]
+        ],
+        colWidths=[160, 320]
+    )
+    cabecalho.setStyle(_estilos["cabecalho"])
+
+    elementos.append(cabecalho)
+    elementos.append(Spacer(1, 18))
+
+    # =====================================
+    # DADOS DO BENEFICIÁRIO
+    # =====================================
+
+    elementos.append(_faixa("DADOS DO BENEFICIÁRIO"))
+    elementos.append(_tabela_dados([
+        ["Nome:", "SABI LÍDER COMÉRCIO PREST SERVIÇO SU LDA"],
+        ["Conta / IBAN:", "AO060004000008230978610166"],
+        ["Banco:", "Banco Angolano de Investimentos"],
+        ["NIF:", "5002232529"]
+    ]))
+
+    elementos.append(Spacer(1, 18))
+
+    # =====================================
+    # DADOS DA TRANSFERÊNCIA
+    # =====================================
+
+    elementos.append(_faixa("DADOS DA TRANSFERÊNCIA"))
+    elementos.append(_tabela_dados([
+        ["Aluno:", dados["aluno_nome"].title()],
+        ["Banco Utilizado:", dados["banco"].upper()],
+        ["Número de Meses:", str(dados["meses"])],
+        ["Valor Mensal:", f"{dados['valor_mensal']:,.2f} Kz"],
+        ["Desconto:", f"{dados['desconto_total']:,.2f} Kz"],
+        ["Montante Total:", f"{dados['valor_total']:,.2f} Kz"],
+        ["Comprovativo:", dados["comprovativo"]],
+        ["Estado:", "SUCESSO"],
+        ["Canal:", "Portal SabApp"]
+    ]))
+
+    elementos.append(Spacer(1, 25))
+
+    # =====================================
+    # RODAPÉ
+    # =====================================
+
+    elementos.append(Paragraph(
+        """
+        Documento processado automaticamente pelo
+        <b>SabApp</b>.
+        <br/><br/>
+        Este recibo serve como confirmação oficial
+        do pagamento efectuado.
+        """,
+        _estilos["subtitulo"]
+    ))
+
+    doc.build(elementos)
+    os.replace(temporario, pdf_path)
+
+    return pdf_path
@@ -0,0 +1,172 @@
+"""
+Stub local da API de management do 100ms (HMS_API_BASE).
+
+Responde a POST /rooms e POST /room-codes/room/{room_id} com o mesmo formato
+da API real, com latência e taxas de erro configuráveis, para testar e medir
+o fluxo de início de aula sem depender de api.100ms.live.
+
+    python stub_100ms.py --porta 8765 --latencia-ms 120 --erros 0.02
+    HMS_API_BASE=http://127.0.0.1:8765 uvicorn main:app
+
+Configuração (argumentos ou variáveis de ambiente STUB_100MS_*):
+- latencia-ms / variacao-ms: tempo de resposta médio e variação (uniforme)
+- erros: fração de respostas 500
+- limite: fração de respostas 429 (rate limit)
+- visibilidade-ms: durante este tempo após a criação, room-codes devolve 404
+  (a API real demora a ver salas acabadas de criar)
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import string
+import threading
+import uuid
+from datetime import datetime, timezone
+
+from fastapi import FastAPI, Header, Request
+from fastapi.responses import JSONResponse
+
+
+class ConfigStub:
+    def __init__(self):
+        self.latencia_ms = float(os.environ.get("STUB_100MS_LATENCIA_MS", "120"))
+        self.variacao_ms = float(os.environ.get("STUB_100MS_VARIACAO_MS", "40"))
+        self.erros = float(os.environ.get("STUB_100MS_ERROS", "0"))
+        self.limite = float(os.environ.get("STUB_100MS_LIMITE", "0"))
+        self.visibilidade_ms = float(os.environ.get("STUB_100MS_VISIBILIDADE_MS", "0"))
+
+    def como_dict(self) -> dict:
+        return dict(vars(self))
+
+
+config = ConfigStub()
+app = FastAPI(title="Stub 100ms")
+
+_lock = threading.Lock()
+_salas = {}  # room_id -> (dados da sala, criada_em em segundos do relógio do loop)
+_contadores = {"rooms": 0, "room_codes": 0, "500": 0, "429": 0, "404": 0, "401": 0}
+
+
+def _contar(campo: str):
+    with _lock:
+        _contadores[campo] = _contadores.get(campo, 0) + 1
+
+
+def _agora_iso() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _codigo_sala() -> str:
+    letras = string.ascii_lowercase
+    return "-".join("".join(random.choices(letras, k=n)) for n in (3, 4, 3))
+
+
+async def _simular(authorization: str):
+    """Latência e erros comuns aos dois endpoints; devolve a resposta de erro ou None."""
+    espera = config.latencia_ms + random.uniform(-config.variacao_ms, config.variacao_ms)
+    await asyncio.sleep(max(0.0, espera) / 1000)
+
+    if not authorization.startswith("Bearer "):
+        _contar("401")
+        return JSONResponse(status_code=401, content={"code": 401, "message": "unauthorized"})
+
+    sorteio = random.random()
+    if sorteio < config.erros:
+        _contar("500")
+        return JSONResponse(status_code=500, content={"code": 500, "message": "internal error (stub)"})
+    if sorteio < config.erros + config.limite:
+        _contar("429")
+        return JSONResponse(status_code=429, content={"code": 429, "message": "rate limit exceeded (stub)"})
+    return None
+
+
+@app.post("/rooms")
+async def criar_sala(request: Request, authorization: str = Header("")):
+    erro = await _simular(authorization)
+    if erro:
+        return erro
+
+    corpo = await request.json()
+    room_id = uuid.uuid4().hex[:24]
+    sala = {
+        "id": room_id,
+        "name": corpo.get("name") or room_id,
+        "enabled": True,
+        "template_id": corpo.get("template_id"),
+        "region": "eu",
+        "created_at": _agora_iso(),
+        "updated_at": _agora_iso(),
+    }
+    with _lock:
+        _salas[room_id] = (sala, asyncio.get_running_loop().time())
+    _contar("rooms")
+    return sala
+
+
+@app.post("/room-codes/room/{room_id}")
+async def criar_codigos(room_id: str, request: Request, authorization: str = Header("")):
+    erro = await _simular(authorization)
+    if erro:
+        return erro
+
+    with _lock:
+        registo = _salas.get(room_id)
+    visivel_em = registo[1] + config.visibilidade_ms / 1000 if registo else None
+    if registo is None or asyncio.get_running_loop().time() < visivel_em:
+        _contar("404")
+        return JSONResponse(status_code=404, content={"code": 404, "message": "room not found"})
+
+    corpo = await request.json()
+    roles = corpo.get("roles") or ["host", "guest"]
+    _contar("room_codes")
+    return {
+        "data": [
+            {
+                "code": _codigo_sala(),
+                "room_id": room_id,
+                "role": role,
+                "enabled": True,
+                "created_at": _agora_iso(),
+                "updated_at": _agora_iso(),
+            }
+            for role in roles
+        ]
+    }
+
+
+@app.get("/stub/estado")
+def estado():
+    with _lock:
+        return {"config": config.como_dict(), "salas": len(_salas), "respostas": dict(_contadores)}
+
+
+@app.post("/stub/config")
+async def alterar_config(request: Request):
+    """Altera a latência/erros sem reiniciar (ex.: entre cenários de um benchmark)."""
+    for campo, valor in (await request.json()).items():
+        if hasattr(config, campo):
+            setattr(config, campo, float(valor))
+    return config.como_dict()
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Stub local da API de management do 100ms.")
+    parser.add_argument("--porta", type=int, default=8765)
+    parser.add_argument("--latencia-ms", type=float, default=config.latencia_ms)
+    parser.add_argument("--variacao-ms", type=float, default=config.variacao_ms)
+    parser.add_argument("--erros", type=float, default=config.erros)
+    parser.add_argument("--limite", type=float, default=config.limite)
+    parser.add_argument("--visibilidade-ms", type=float, default=config.visibilidade_ms)
+    args = parser.parse_args()
+
+    config.latencia_ms = args.latencia_ms
+    config.variacao_ms = args.variacao_ms
+    config.erros = args.erros
+    config.limite = args.limite
+    config.visibilidade_ms = args.visibilidade_ms
+
+    uvicorn.run(app, host="127.0.0.1", port=args.porta, log_level="warning")